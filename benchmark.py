@@ -0,0 +1,723 @@
+#!/usr/bin/env python3
+
+import sqlite3, time, re, sys, os, json, shutil, tempfile, platform, subprocess, multiprocessing, contextlib, threading, random, collections, socket, pyquery
+from pyquery import PyQuery
+from typing import List, Tuple, Dict, Callable
+from functools import cmp_to_key
+import commens, poem, hotwords
+from spider import PageCodec, WebpageSpider, FetchError
+from extract import parse_html
+from export import get_peak_memory
+
+class commands(object):
+    extract = 'extract'
+    fixture = 'fixture'
+    pipeline = 'pipeline'
+    throttle = 'throttle'
+    check_throttle = 'check-throttle'
+    redundants = 'redundants'
+
+    @classmethod
+    def option_chocies(cls):
+        choice_list = []
+        for name, value in vars(cls).items():
+            if name.replace('_', '-') == value: choice_list.append(value)
+        return choice_list
+
+# PyQuery extractors as they were before extract.py, kept as the reference for equivalence and speed
+def legacy_parse_discuss(url:str, html:pyquery.PyQuery)->Tuple[Dict[str, List[Tuple]], List[Tuple[str, str]]]:
+    user_list, discuss_list = [], []
+    post_node = html.find('div.post-content div#link-report')
+    if post_node:
+        post_title = html.find('div#content h1').text()
+        post_cid = url.split('?')[0].split('/')[-2]
+        author_node = post_node.find('div.post-author')
+        post_node.find('style').remove()
+        post_content = author_node.next().text()
+        post_author_url = author_node.find('div.post-author-avatar a').attr('href') # type: str
+        post_author_uid = post_author_url.split('/')[-2]
+        post_author_avatar = author_node.find('div.post-author-avatar img').attr('src')
+        post_author_status = author_node.find('span.post-author-name').contents()[2] # type: str
+        post_author_status = post_author_status.replace('\n', '').strip()
+        post_author = author_node.find('span.post-author-name a').text()
+        post_time_data = author_node.find('span.post-publish-date').text()
+        post_time = commens.decode_date(value=post_time_data)
+        post_text = '|{}|{}'.format(post_title, post_content)
+        user_list.append((post_author_uid, post_author, post_author_status, post_author_url, post_author_avatar))
+        discuss_list.append((post_cid, post_cid, post_text, post_time, post_author_uid, post_author, 0, None, None, None, None))
+    for item in html.find('div.comment-item'):
+        node = pyquery.PyQuery(item)
+        author_node = node.find('div.author')
+        comment_cid = node.attr('data-cid')
+        comment_discuss_cid = node.attr('data-target_id')
+        comment_time_data = author_node.find('span').text()
+        comment_time = commens.decode_date(value=comment_time_data)
+        comment_author = author_node.find('a').text()
+        comment_author_url = author_node.find('a').attr('href') # type: str
+        comment_author_uid = comment_author_url.split('/')[-2]
+        comment_author_status = author_node.contents()[-1]
+        comment_author_avatar = node.find('div.pic img').attr('src')
+        comment_text = node.find('div.content p').text()
+
+        user_item = (comment_author_uid, comment_author, comment_author_status, comment_author_url, comment_author_avatar)
+        user_list.append(user_item)
+
+        vote_num = 0
+        vote_data = re.search('\((\d+)\)', node.find('div.op-lnks a.comment-vote').text())
+        if vote_data: vote_num = int(vote_data.group(1))
+
+        quote_node = node.find('div.reply-quote')
+        comment_reply_quote, comment_reply_author, comment_reply_author_uid = None, None, None
+        if quote_node:
+            comment_reply_quote = quote_node.find('div.all span').text()
+            comment_reply_author = quote_node.find('span.pubdate a').text()
+            comment_reply_author_url = quote_node.find('span.pubdate a').attr('href') # type: str
+            comment_reply_author_uid = comment_reply_author_url.split('/')[-2]
+
+        discuss_item = (comment_cid, comment_discuss_cid, comment_text, comment_time,
+                        comment_author_uid, comment_author, vote_num,
+                        None, comment_reply_quote, comment_reply_author_uid, comment_reply_author)
+        discuss_list.append(discuss_item)
+    links = []
+    paginator = html.find('div.paginator span.next a')
+    if paginator:
+        links.append((paginator.attr('href'), commens.kinds.discuss))
+    return {commens.tables.discuss: discuss_list, commens.tables.user: user_list}, links
+
+def legacy_parse_subject_discuss(url:str, html:pyquery.PyQuery)->Tuple[Dict[str, List[Tuple]], List[Tuple[str, str]]]:
+    links = []
+    for item in html.find('div.article table#posts-table tr'):
+        node = pyquery.PyQuery(item)
+        if not node.attr('data-id'): continue
+        links.append((node.find('td a').attr('href'), commens.kinds.discuss))
+    paginator = html.find('div.paginator span.next a')
+    if paginator:
+        links.append((url.split('?')[0] + paginator.attr('href'), commens.kinds.subject_discuss))
+    return {}, links
+
+def legacy_parse_review_comments(url:str, html:pyquery.PyQuery)->Tuple[Dict[str, List[Tuple]], List[Tuple[str, str]]]:
+    review_url = url.split('?')[0]
+    review_aid = review_url.split('/')[-2]
+    review_title = html.find('div.article h1 span').text()
+    pointer = html.find('header.main-hd').children('a span')
+    review_author = pointer.text()
+    pointer = pointer.parent()
+    review_author_url = pointer.attr('href') # type: str
+    review_author_uid = review_author_url.split('/')[-2]
+    pointer = pointer.next()
+    review_subject = pointer.text()
+    review_subject_url = pointer.attr('href') # type: str
+    review_subject_sid = review_subject_url.split('/')[-2]
+    pointer = pointer.next()
+    if pointer.parent().find('.main-title-rating'):
+        pointer = pointer.next()
+        review_subject_pts = pointer.text()
+        review_subject_pts = float(review_subject_pts) if review_subject_pts else 0
+        pointer = pointer.next()
+    else:
+        review_subject_pts = -1
+    review_time = commens.decode_date(value=pointer.text())
+    subject_list = [(review_subject_sid, review_subject, review_subject_url)]
+    review_list = [(review_aid, review_title, review_url, review_time,
+                    review_author_uid,review_author,review_author_url,
+                    review_subject,review_subject_pts,review_subject_url)]
+    comment_list, user_list = [], []
+    for item in html.find('.comment-item'):
+        node = pyquery.PyQuery(item)
+        comment_cid = node.attr('data-cid')
+        comment_text = node.find('.comment-text').text()
+        reply_cid = node.attr('data-ref_cid').strip()
+        if not reply_cid or reply_cid == '0': reply_cid = None
+        reply_author_uid, reply_author = None, None
+        if reply_cid:
+            reply_node = node.find('span.pubdate a')
+            reply_author_url = reply_node.attr('href') # type: str
+            reply_author_uid = reply_author_url.split('/')[-2]
+            reply_author = reply_node.text()
+        review_aid = node.attr('data-target_id')
+        comment_author_avatar = node.find('div.avatar img').attr('src')
+        header_node = node.find('div.header')
+        comment_author_url = node.attr('data-user_url')
+        comment_author_uid = comment_author_url.split('/')[-2]
+        comment_author = header_node.find('a').text()
+        comment_author_state = header_node.contents()[2].strip()
+        if not comment_author_state: comment_author_state = None
+        comment_time_data = header_node.find('span').text()
+        comment_time = commens.decode_date(value=comment_time_data)
+        comment_record = (comment_cid, comment_text, comment_time,
+                comment_author_uid, comment_author,
+                review_aid,
+                reply_cid, reply_author_uid, reply_author)
+        comment_list.append(comment_record)
+        user_record = (comment_author_uid, comment_author, comment_author_state, comment_author_url, comment_author_avatar)
+        user_list.append(user_record)
+    links = []
+    paginator = html.find('div.paginator span.next a')
+    if paginator:
+        links.append((review_url + paginator.attr('href'), commens.kinds.review))
+    return {commens.tables.subject: subject_list, commens.tables.review: review_list, commens.tables.comment: comment_list, commens.tables.user: user_list}, links
+
+def legacy_parse_subject_comments(url:str, html:pyquery.PyQuery)->Tuple[Dict[str, List[Tuple]], List[Tuple[str, str]]]:
+    links = []
+    for review in html.find('div.review-list div.review-item'):
+        node = pyquery.PyQuery(review)
+        links.append((node.find('.main-bd h2 a').attr('href'), commens.kinds.review))
+    paginator = html.find('div.paginator span.next a')
+    if paginator:
+        links.append((url.split('?')[0] + paginator.attr('href'), commens.kinds.subject_reviews))
+    return {}, links
+
+def legacy_parse_author_poems(url:str, html:PyQuery)->Tuple[List[Tuple], List[str]]:
+    if url.rfind('?') > 0:
+        params = poem.decode_params(url)
+        uid = params['id']
+        pid = params['page']
+    else:
+        data = url.split('/')[-1].split('_')[-1].split('.')[0]
+        pattern = re.compile(r'A(\d+)$')
+        uid = pattern.sub('', data)
+        pid = pattern.search(data).group(1)
+    poem_list = []
+    for item in html.find('div.main3 div.left div.sons'):
+        node = PyQuery(item)
+        content_node = node.find('div.cont')
+        title = PyQuery(content_node.find('div.yizhu')[0]).next().text()
+        author = PyQuery(content_node.find('p.source')[0]).text().replace('：','-')
+        poem_text = PyQuery(content_node.find('div.contson')[0]).text()
+        tags_node = node.find('div.tag')
+        if tags_node:
+            tags = PyQuery(tags_node[0]).text().replace(' ', '').replace('，', ';')
+        else:
+            tags = None
+        id = node.find('div.yizhu img').attr('onclick').split('\'')[1]
+        poem_list.append((id, title, author, poem_text, tags, pid, uid))
+    links = []
+    paginator = html.find('div.pagesright a.amore')
+    if paginator and paginator.attr('href'):
+        next_page_link = paginator.attr('href') # type: str
+        if not next_page_link.startswith('http'):
+            next_page_link = 'https://so.gushiwen.org' + next_page_link
+        links.append(next_page_link)
+    return poem_list, links
+
+# hotwords.strip_redundants as it was before the sorted reversed words
+def legacy_strip_redundants(data_list:List[Tuple[str, int]]):
+    temp_list = [] # type: list[tuple[str, str, int]]
+    for item in data_list:
+        temp_list.append((item[0][-1:-3:-1], item[0], item[1]))
+    def reverse_rank_sort(a, b):
+        if a[0] != b[0]: return 1 if a[0] > b[0] else -1
+        if a[-1] != b[-1]: return -1 if a[-1] > b[-1] else 1
+        return -1 if len(a[1]) > len(b[1]) else 1
+    temp_list.sort(key=cmp_to_key(reverse_rank_sort))
+    result, keytag, depth = [], None, 0
+    for n in range(len(temp_list)):
+        tag, word, num = temp_list[n]
+        if keytag != tag: keytag, depth = tag, 0
+        depth += 1
+        redundant = False
+        for r in range(0, min(depth, len(result))):
+            hotword, _ = result[r] # type: str
+            if hotword.endswith(word):
+                redundant = True
+                break
+        if not redundant:
+            result.insert(0, (word, num))
+    return result
+
+parsers = [
+    ('review', re.compile(r'/review/\d+/'), legacy_parse_review_comments, commens.parse_review_comments),
+    ('review-list', re.compile(r'/reviews'), legacy_parse_subject_comments, commens.parse_subject_comments),
+    ('discuss', re.compile(r'/discussion/\d+/'), legacy_parse_discuss, commens.parse_discuss),
+    ('discuss-list', re.compile(r'/discussion/(\?|$)'), legacy_parse_subject_discuss, commens.parse_subject_discuss),
+    ('author-poems', re.compile(r'authorvsw'), legacy_parse_author_poems, poem.parse_author_poems)
+]
+
+def classify_page(link:str)->Tuple[str, Callable, Callable]:
+    for name, pattern, legacy_parser, parser in parsers:
+        if pattern.search(link): return name, legacy_parser, parser
+    return None, None, None
+
+def load_pages(database:str, limit:int)->List[Tuple[str, str]]:
+    connection = sqlite3.connect(database)
+    dictionaries = dict(connection.execute('SELECT id,dictionary FROM codec').fetchall()) if connection.execute(
+        'SELECT name FROM sqlite_master WHERE type=\'table\' AND name=\'codec\'').fetchone() else {}
+    codec = PageCodec(dictionaries=dictionaries)
+    command = 'SELECT link,html FROM page' + (' LIMIT {}'.format(limit) if limit > 0 else '')
+    pages = [(link, codec.decode(data)) for link, data in connection.execute(command)]
+    connection.close()
+    return pages
+
+def same_extract(legacy_result:Tuple[Dict, List], result:Tuple[Dict, List])->bool:
+    # first listing pages queue every later page up front while the legacy copies only follow the next link
+    if legacy_result[0] != result[0]: return False
+    legacy_links, links = legacy_result[1], result[1]
+    if legacy_links == links: return True
+    listing_kinds = (commens.kinds.subject_discuss, commens.kinds.subject_reviews)
+    extra_links = set(links) - set(legacy_links)
+    return set(legacy_links) <= set(links) and all(kind in listing_kinds for _, kind in extra_links)
+
+def benchmark_extract(database:str, limit:int = 0, repeat:int = 3):
+    page_map = {} # type: Dict[str, List[Tuple[str, str]]]
+    for link, html_content in load_pages(database, limit):
+        name, _, _ = classify_page(link)
+        if name: page_map.setdefault(name, []).append((link, html_content))
+    print('{:14s} {:>6s} {:>10s} {:>10s} {:>8s} {}'.format('page', 'num', 'pyquery', 'lxml', 'speedup', 'equal'))
+    for name, _, legacy_parser, parser in parsers:
+        pages = page_map.get(name)
+        if not pages: continue
+        legacy_time, lxml_time, equal = float('inf'), float('inf'), True
+        for _ in range(repeat):
+            elapse = time.perf_counter()
+            legacy_result = [legacy_parser(link, PyQuery(html_content)) for link, html_content in pages]
+            legacy_time = min(legacy_time, time.perf_counter() - elapse)
+            elapse = time.perf_counter()
+            result = [parser(link, parse_html(html_content)) for link, html_content in pages]
+            lxml_time = min(lxml_time, time.perf_counter() - elapse)
+            equal = equal and all(same_extract(x, y) for x, y in zip(legacy_result, result))
+        print('{:14s} {:6d} {:8.2f}ms {:8.2f}ms {:7.2f}x {}'.format(
+            name, len(pages), 1000 * legacy_time / len(pages), 1000 * lxml_time / len(pages), legacy_time / lxml_time, equal))
+
+def fixture_word_list(size:int, seed:int = 42)->List[Tuple[str, int]]:
+    # unique words over a small alphabet, every other one grown from an earlier word so suffixes are shared
+    generator = random.Random(seed)
+    alphabet = [chr(0x4e00 + n) for n in range(200)]
+    word_map = {} # type: Dict[str, int]
+    word_list = [] # type: List[str]
+    while len(word_list) < size:
+        if word_list and generator.random() < 0.5:
+            word = ''.join(generator.choices(alphabet, k=generator.randint(1, 3))) + generator.choice(word_list)
+            if len(word) > 12: continue
+        else:
+            word = ''.join(generator.choices(alphabet, k=generator.randint(2, 6)))
+        if word in word_map: continue
+        word_map[word] = generator.randint(2, 50)
+        word_list.append(word)
+    return [(x, word_map[x]) for x in word_list]
+
+def benchmark_redundants(sizes:List[int], legacy_limit:int = 100000, repeat:int = 3):
+    print('{:>8s} {:>8s} {:>10s} {:>10s} {:>8s} {}'.format('words', 'kept', 'legacy', 'sorted', 'speedup', 'equal'))
+    for size in sizes:
+        data_list = fixture_word_list(size)
+        sorted_time = float('inf')
+        for _ in range(repeat):
+            elapse = time.perf_counter()
+            result = hotwords.strip_redundants(data_list)
+            sorted_time = min(sorted_time, time.perf_counter() - elapse)
+        if size > legacy_limit:
+            # the prepending scan is quadratic, past the limit it would run for hours
+            print('{:8d} {:8d} {:>10s} {:8.2f}ms {:>8s} -'.format(size, len(result), '-', 1000 * sorted_time, '-'))
+            continue
+        elapse = time.perf_counter()
+        legacy_result = legacy_strip_redundants(data_list)
+        legacy_time = time.perf_counter() - elapse
+        print('{:8d} {:8d} {:8.2f}ms {:8.2f}ms {:7.2f}x {}'.format(
+            size, len(result), 1000 * legacy_time, 1000 * sorted_time, legacy_time / sorted_time, sorted(result) == sorted(legacy_result)))
+
+fixture_subject_url = 'https://movie.douban.com/subject/42/'
+
+def fixture_review_comment(index:int, aid:int)->str:
+    ref = str(index - 1) if index % 2 else '0'
+    reply = '<span class="pubdate"><a href="https://www.douban.com/people/u{0}/">回复者{0}</a></span>'.format(index - 1) if ref != '0' else ''
+    return """<div class="comment-item" data-cid="{cid}" data-ref_cid="{ref}" data-target_id="{aid}" data-user_url="https://www.douban.com/people/u{uid}/">
+<div class="avatar"><img src="https://img/u{uid}.jpg"/></div>
+<div class="content"><div class="header">
+<a href="https://www.douban.com/people/u{uid}/">用户{uid}</a> 常居北京 <span>2019-03-{day:02d} 12:{minute:02d}:{minute:02d}</span></div>
+{reply}<p class="comment-text">这部电影真的很好看 {index} 喜欢导演的镜头语言</p></div></div>""".format(
+        cid=aid * 1000 + index, ref=ref, aid=aid, uid=index % 50, day=1 + index % 28, minute=index % 60, reply=reply, index=index)
+
+def fixture_review_page(aid:int, start:int, total:int)->str:
+    items = ''.join([fixture_review_comment(start + n, aid) for n in range(min(100, total - start))])
+    paginator = '<div class="paginator"><span class="next"><a href="?start={}">后页</a></span></div>'.format(start + 100) if start + 100 < total else ''
+    return """<html><body><div class="article"><h1><span>影评标题{0}</span></h1>
+<header class="main-hd"><a href="https://www.douban.com/people/a{0}/"><span>作者{0}</span></a><a href="{1}">电影</a><span class="allstar40 main-title-rating" title="推荐"></span><span>4</span><span class="main-meta">2019-01-01 10:00:00</span></header>
+{2}{3}</div></body></html>""".format(aid, fixture_subject_url, items, paginator)
+
+def fixture_listing_paginator(start:int, total:int, step:int)->str:
+    # douban listings show the first pages, a break and the last two pages
+    page_num = (total + step - 1) // step
+    current = start // step
+    pages = sorted(set([x for x in list(range(min(page_num, 9))) + [page_num - 2, page_num - 1] if x >= 0]))
+    items = []
+    for page in pages:
+        if page == current: items.append('<span class="thispage" data-total-page="{}">{}</span>'.format(page_num, page + 1))
+        else: items.append('<a href="?start={}">{}</a>'.format(page * step, page + 1))
+        if page == 8 and page_num > 11: items.append('<span class="break">...</span>')
+    if start + step < total:
+        items.append('<span class="next"><link rel="next" href="?start={0}"/><a href="?start={0}">后页&gt;</a></span>'.format(start + step))
+    return '<div class="paginator">{}<span class="count">(共{}条)</span></div>'.format(''.join(items), total)
+
+def fixture_review_list_page(start:int, total:int, review_ids:List[int])->str:
+    items = ''.join(['<div class="review-item"><div class="main-bd"><h2><a href="https://movie.douban.com/review/{}/">r</a></h2></div></div>'.format(x) for x in review_ids])
+    return '<html><body><div class="review-list">{}</div>{}</body></html>'.format(items, fixture_listing_paginator(start, total, 20))
+
+def fixture_discuss_comment(index:int, tid:int)->str:
+    quote = '<div class="reply-quote"><span class="all"><span>引用内容{0}</span></span><span class="pubdate"><a href="https://www.douban.com/people/q{1}/">被引用{1}</a></span></div>'.format(index, index % 7) if index % 3 == 0 else ''
+    return """<div class="comment-item" data-cid="{cid}" data-target_id="{tid}">
+<div class="pic"><img src="https://img/d{uid}.jpg"/></div>
+<div class="reply-doc content"><div class="bg-img-green"><h4><div class="author"><a href="https://www.douban.com/people/d{uid}/">讨论者{uid}</a> <span>2019-04-{day:02d} 08:{minute:02d}:00</span> (长居上海)</div></h4></div>
+{quote}<p>我觉得第{index}楼说得对，结局很感人</p>
+<div class="op-lnks"><a class="comment-vote">赞 ({vote})</a></div></div></div>""".format(
+        cid=tid * 1000 + index, tid=tid, uid=index % 30, day=1 + index % 28, minute=index % 60, quote=quote, index=index, vote=index % 11)
+
+def fixture_discuss_page(tid:int, start:int, total:int)->str:
+    post = ''
+    if start == 0:
+        post = """<div id="content"><h1>讨论标题{0}</h1></div>
+<div class="post-content"><div id="link-report"><div class="post-author"><div class="post-author-avatar"><a href="https://www.douban.com/people/p{0}/"><img src="https://img/p{0}.jpg"/></a></div>
+<span class="post-author-name">
+<a href="https://www.douban.com/people/p{0}/">楼主{0}</a> (北京)</span><span class="post-publish-date">2019-04-01 09:00:00</span></div>
+<div class="post-body"><style>.x{{color:red}}</style><p>正文第一段 {0}</p><p>正文第二段</p></div></div></div>""".format(tid)
+    items = ''.join([fixture_discuss_comment(start + n, tid) for n in range(min(100, total - start))])
+    paginator = '<div class="paginator"><span class="next"><a href="{}discussion/{}/?start={}">后页</a></span></div>'.format(fixture_subject_url, tid, start + 100) if start + 100 < total else ''
+    return '<html><body>{}{}{}</body></html>'.format(post, items, paginator)
+
+def fixture_discuss_list_page(start:int, total:int, topic_ids:List[int])->str:
+    rows = ''.join(['<tr data-id="{0}"><td><a href="{1}discussion/{0}/">t</a></td></tr>'.format(x, fixture_subject_url) for x in topic_ids])
+    return '<html><body><div class="article"><table id="posts-table"><tr class="th"><td>h</td></tr>{}</table></div>{}</body></html>'.format(rows, fixture_listing_paginator(start, total, 20))
+
+def fixture_poem(index:int, uid:str)->str:
+    tags = '<div class="tag"><a>写景</a>，<a>抒情</a></div>' if index % 2 else ''
+    return """<div class="sons"><div class="cont"><div class="yizhu"><img onclick="OnYizhu('{0}{1:05x}')"/></div>
+<p><a><b>诗题{1}</b></a></p><p class="source"><a>唐代</a><span>：</span><a>作者{0}</a></p>
+<div class="contson">床前明月光，疑是地上霜。<br/>举头望明月，低头思故乡。{1}</div></div>{2}</div>""".format(uid, index, tags)
+
+def fixture_author_poems_page(uid:str, page:int, pages:int)->str:
+    items = ''.join([fixture_poem(page * 10 + n, uid) for n in range(10)])
+    paginator = '<div class="pagesright"><a class="amore" href="/authors/authorvsw.aspx?page={}&amp;id={}">下一页</a></div>'.format(page + 1, uid) if page < pages else ''
+    return '<html><body><div class="main3"><div class="left">{}{}</div></div></body></html>'.format(items, paginator)
+
+def fixture_authors_page(author_ids:List[str])->str:
+    links = ''.join(['<a href="/authors/authorv_{}.aspx">作者{}</a>'.format(x, x) for x in author_ids])
+    return '<html><body><div class="main3"><div class="right"><div class="cont">{}</div></div></div></body></html>'.format(links)
+
+def create_fixture(database:str, scale:int = 1):
+    # a self-contained page cache that commens.py and poem.py can crawl with --offline
+    if os.path.exists(database): os.remove(database)
+    connection = sqlite3.connect(database)
+    connection.execute('CREATE TABLE page (link text NOT NULL UNIQUE ON CONFLICT IGNORE, html text NOT NULL)')
+    pages = [] # type: List[Tuple[str, str]]
+    review_num, review_comment_num = 40 * scale, 500
+    review_ids = list(range(1000, 1000 + review_num))
+    for start in range(0, review_num, 20):
+        link = fixture_subject_url + 'reviews' + ('?start={}'.format(start) if start else '')
+        pages.append((link, fixture_review_list_page(start, review_num, review_ids[start:start + 20])))
+    for aid in review_ids:
+        for start in range(0, review_comment_num, 100):
+            link = 'https://movie.douban.com/review/{}/'.format(aid) + ('?start={}'.format(start) if start else '')
+            pages.append((link, fixture_review_page(aid, start, review_comment_num)))
+    topic_num, discuss_comment_num = 20 * scale, 250
+    topic_ids = list(range(500, 500 + topic_num))
+    for start in range(0, topic_num, 20):
+        link = fixture_subject_url + 'discussion/' + ('?start={}'.format(start) if start else '')
+        pages.append((link, fixture_discuss_list_page(start, topic_num, topic_ids[start:start + 20])))
+    for tid in topic_ids:
+        for start in range(0, discuss_comment_num, 100):
+            link = '{}discussion/{}/'.format(fixture_subject_url, tid) + ('?start={}'.format(start) if start else '')
+            pages.append((link, fixture_discuss_page(tid, start, discuss_comment_num)))
+    author_ids = ['a{:03d}'.format(n) for n in range(4 * scale)]
+    pages.append(('https://so.gushiwen.org/authors/', fixture_authors_page(author_ids)))
+    for uid in author_ids:
+        for page in range(1, 6):
+            link = 'https://so.gushiwen.org/authors/authorvsw.aspx?page={}&id={}'.format(page, uid)
+            pages.append((link, fixture_author_poems_page(uid, page, 5)))
+    connection.executemany('INSERT INTO page VALUES (?,?)', pages)
+    connection.commit()
+    connection.close()
+    print('{} fixture pages written to {}'.format(len(pages), database))
+
+class StageTimer(object):
+    def __init__(self):
+        self.stages = {} # type: Dict[str, float]
+
+    def wrap(self, stage:str, method:Callable)->Callable:
+        def timed(*args, **kwargs):
+            elapse = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.stages[stage] = self.stages.get(stage, 0.0) + time.perf_counter() - elapse
+        return timed
+
+    def patch(self, stage:str, owner, names:List[str]):
+        for name in names: setattr(owner, name, self.wrap(stage, getattr(owner, name)))
+
+scenarios = [
+    ('dump-subject', commens.commands.dump_subject),
+    ('dump-discuss', commens.commands.dump_discuss),
+    ('dump-poem', poem.commands.dump_poem)
+]
+
+def count_table_rows(database:str, names:List[str])->Dict[str, int]:
+    connection = sqlite3.connect(database)
+    result = {}
+    for name in names:
+        if connection.execute('SELECT name FROM sqlite_master WHERE type=\'table\' AND name=?', (name,)).fetchone():
+            result[name] = connection.execute('SELECT count(*) FROM {}'.format(name)).fetchone()[0]
+    connection.close()
+    return result
+
+def run_scenario(fixture:str, command:str, concurrency:int)->Dict:
+    # runs in a fresh process so that the memory peak belongs to this scenario only
+    workspace = tempfile.mkdtemp(prefix='douban-bench-')
+    database = os.path.join(workspace, 'bench.sqlite')
+    shutil.copyfile(fixture, database)
+    timer = StageTimer()
+    baseline_memory = get_peak_memory()
+    try:
+        if command == poem.commands.dump_poem:
+            poem.database_name = database
+            poem.open_database(poem.ArgumentOptions(data=poem.create_argument_parser().parse_args(
+                ['--offline', '-c', command, '-j', str(concurrency), '--progress', '0'])))
+            timer.patch('fetch', poem.spider, ['fetch_html_content', 'prefetch'])
+            timer.patch('parse', poem, ['parse_html', 'parse_author_poems'])
+            timer.patch('store', poem.spider, ['insert_table'])
+            elapse = time.perf_counter()
+            with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+                poem.dump_poems()
+            summary = poem.frontier.summary()
+            poem.spider.commit(close_sqlite=True)
+            elapse = time.perf_counter() - elapse
+            row_map = count_table_rows(database, [poem.tables.poem])
+        else:
+            commens.database_name = database
+            commens.open_database(commens.ArgumentOptions(data=commens.create_argument_parser().parse_args(
+                ['--offline', '-c', command, '-t', '0', '-j', str(concurrency), '--progress', '0'])))
+            douban_url, seed_kind = commens.resolve_seed(fixture_subject_url, command)
+            timer.patch('fetch', commens.spider, ['fetch_html_content', 'prefetch'])
+            timer.patch('parse', commens, ['parse_html', 'parse_review_comments', 'parse_subject_comments', 'parse_discuss', 'parse_subject_discuss'])
+            timer.patch('store', commens, ['store_records'])
+            elapse = time.perf_counter()
+            with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+                commens.crawl_seed(douban_url, seed_kind)
+            summary = commens.frontier.summary(seed=douban_url)
+            commens.spider.commit(close_sqlite=True)
+            elapse = time.perf_counter() - elapse
+            # the writer thread overlaps with fetch and parse, so its time is reported beside the stages
+            timer.stages['writer'] = commens.writer.busy_time
+            row_map = count_table_rows(database, [commens.tables.comment, commens.tables.discuss, commens.tables.user, commens.tables.review, commens.tables.subject])
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+    page_num, row_num = summary.get('done', 0), sum(row_map.values())
+    timer.stages['other'] = max(0.0, elapse - sum([v for k, v in timer.stages.items() if k != 'writer']))
+    return {
+        'pages': page_num,
+        'failed': summary.get('failed', 0),
+        'rows': row_num,
+        'tables': row_map,
+        'seconds': round(elapse, 4),
+        'pages_per_sec': round(page_num / elapse, 2),
+        'rows_per_sec': round(row_num / elapse, 2),
+        'stages': {k: round(v, 4) for k, v in timer.stages.items()},
+        'peak_rss_kb': get_peak_memory(),
+        'baseline_rss_kb': baseline_memory
+    }
+
+def get_git_commit()->str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark_pipeline(database:str, scale:int = 1, repeat:int = 1, concurrency:int = 4, output:str = None):
+    if not os.path.exists(database): create_fixture(database, scale=scale)
+    report = {
+        'commit': get_git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'fixture': os.path.abspath(database),
+        'concurrency': concurrency,
+        'time': int(time.time()),
+        'scenarios': {}
+    }
+    context = multiprocessing.get_context('spawn')
+    print('{:14s} {:>6s} {:>8s} {:>9s} {:>10s} {:>8s} {:>8s} {:>8s} {:>8s} {:>9s}'.format(
+        'scenario', 'pages', 'rows', 'pages/s', 'rows/s', 'fetch', 'parse', 'store', 'writer', 'peak'))
+    for name, command in scenarios:
+        best = None
+        for _ in range(repeat):
+            with context.Pool(processes=1) as pool:
+                result = pool.apply(run_scenario, (os.path.abspath(database), command, concurrency))
+            if not best or result['seconds'] < best['seconds']: best = result
+        report['scenarios'][name] = best
+        stages = best['stages']
+        print('{:14s} {:6d} {:8d} {:9.1f} {:10.1f} {:7.2f}s {:7.2f}s {:7.2f}s {:7.2f}s {:7.1f}MB'.format(
+            name, best['pages'], best['rows'], best['pages_per_sec'], best['rows_per_sec'], stages.get('fetch', 0),
+            stages.get('parse', 0), stages.get('store', 0), stages.get('writer', 0), best['peak_rss_kb'] / 1024))
+    if output:
+        with open(output, 'w') as fp:
+            json.dump(report, fp, indent=2, ensure_ascii=False)
+        print('report written to {}'.format(output))
+    return report
+
+class StubServer(object):
+    # local http server that tolerates capacity requests per second, answers 429 above that
+    # and fails error_rate of the accepted requests with a 503
+    def __init__(self, capacity:float, error_rate:float = 0.0, retry_after:int = 0):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.status_map = {} # type: Dict[int, int]
+        self.__window = collections.deque()
+        self.__lock = threading.Lock()
+        server = self
+        class StubHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status = server.admit()
+                self.send_response(status)
+                if status == 429 and server.retry_after: self.send_header('Retry-After', str(server.retry_after))
+                body = '<html><body><p>{} {}</p></body></html>'.format(status, self.path).encode('utf-8')
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        self.__server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+
+    @property
+    def url(self)->str:
+        return 'http://127.0.0.1:{}'.format(self.__server.server_address[1])
+
+    def admit(self)->int:
+        with self.__lock:
+            now = time.monotonic()
+            while self.__window and now - self.__window[0] > 1.0: self.__window.popleft()
+            if len(self.__window) >= self.capacity:
+                status = 429
+            else:
+                self.__window.append(now)
+                status = 503 if random.random() < self.error_rate else 200
+            self.status_map[status] = self.status_map.get(status, 0) + 1
+        return status
+
+    def __enter__(self):
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+def benchmark_throttle(capacity:float = 20, error_rate:float = 0.005, retry_after:int = 0, page_num:int = 600,
+                       rate:float = 2.0, max_rate:float = 100.0, concurrency:int = 8, output:str = None)->Dict:
+    with StubServer(capacity=capacity, error_rate=error_rate, retry_after=retry_after) as server:
+        spider = WebpageSpider(connection=sqlite3.connect(':memory:'), rate=rate, burst=1, concurrency=concurrency,
+                               max_rate=max_rate, retries=5, retry_backoff=0.2)
+        urls = ['{}/page/{}'.format(server.url, n) for n in range(page_num)]
+        timeline, failed_num = [], 0
+        elapse = time.perf_counter()
+        report_time = elapse
+        batch_size = concurrency * 2
+        for n in range(0, len(urls), batch_size):
+            try:
+                spider.prefetch(urls[n:n + batch_size])
+            except FetchError as error:
+                failed_num += 1
+                print('[failed] {}'.format(error))
+            now = time.perf_counter()
+            if now - report_time >= 1.0 or n + batch_size >= len(urls):
+                report_time = now
+                bucket_rate = spider.limiter.bucket(server.url).rate
+                timeline.append((round(now - elapse, 2), min(n + batch_size, len(urls)), round(bucket_rate, 2), dict(server.status_map)))
+                print('{:6.1f}s pages={:<5d} rate={:6.2f}/s server={}'.format(*timeline[-1]))
+        elapse = time.perf_counter() - elapse
+        spider.commit(close_sqlite=True)
+    report = {
+        'commit': get_git_commit(),
+        'capacity': capacity,
+        'error_rate': error_rate,
+        'retry_after': retry_after,
+        'pages': page_num,
+        'failed_batches': failed_num,
+        'seconds': round(elapse, 3),
+        'pages_per_sec': round(page_num / elapse, 2),
+        'final_rate': timeline[-1][2] if timeline else None,
+        'server': server.status_map,
+        'retries': spider.metrics.total('retries_total'),
+        'timeline': timeline
+    }
+    print('{} pages in {:.1f}s, {:.1f} pages/s against a capacity of {}/s, {:.0f} retries, {} failed batches, server={}'.format(
+        page_num, elapse, report['pages_per_sec'], capacity, report['retries'], failed_num, server.status_map))
+    if output:
+        with open(output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    return report
+
+def check_throttle(max_retry_wait:float = 1.0)->bool:
+    # the retry and rate guarantees of WebpageSpider against the stub server, the exit status tells whether they hold
+    failures = []
+    def check(name:str, passed:bool, detail:str):
+        print('{:24s} {:6s} {}'.format(name, 'ok' if passed else 'FAILED', detail))
+        if not passed: failures.append(name)
+    # a hostile Retry-After holds the host back no longer than max_retry_wait
+    with StubServer(capacity=0, retry_after=10 ** 6) as server:
+        spider = WebpageSpider(connection=sqlite3.connect(':memory:'), rate=10, retries=1, retry_backoff=0.1, max_retry_wait=max_retry_wait)
+        with contextlib.redirect_stdout(None):
+            try:
+                spider.fetch_html_content('{}/page/0'.format(server.url))
+            except FetchError:
+                pass
+        bucket = spider.limiter.bucket(server.url)
+        delay = bucket.reserve()
+        check('retry-after capped', delay <= max_retry_wait + 1 / bucket.rate, '{:.2f}s wait after Retry-After: {}'.format(delay, 10 ** 6))
+    # network errors are retried without slowing the host down
+    with contextlib.closing(socket.socket()) as closed:
+        closed.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:{}/page/0'.format(closed.getsockname()[1])
+    spider = WebpageSpider(connection=sqlite3.connect(':memory:'), rate=10, retries=2, retry_backoff=0.05)
+    try:
+        spider.fetch_html_content(url)
+        failed = False
+    except FetchError:
+        failed = True
+    rate = spider.limiter.bucket(url).rate
+    check('network error keeps rate', failed and rate == 10, 'rate {:.2f}/s after {:.0f} retries'.format(rate, spider.metrics.total('retries_total')))
+    # 429s above the capacity halve the rate, the pages still come through
+    with StubServer(capacity=5) as server:
+        spider = WebpageSpider(connection=sqlite3.connect(':memory:'), rate=20, max_rate=40, retries=8, retry_backoff=0.2)
+        failed_num = 0
+        for n in range(0, 40, 8):
+            try:
+                spider.prefetch(['{}/page/{}'.format(server.url, x) for x in range(n, n + 8)])
+            except FetchError:
+                failed_num += 1
+        rate = spider.limiter.bucket(server.url).rate
+        check('pushback lowers rate', rate < 20 and not failed_num, 'rate {:.2f}/s, {} failed batches, server={}'.format(rate, failed_num, server.status_map))
+    return not failures
+
+if __name__ == '__main__':
+    import argparse
+    arguments = argparse.ArgumentParser()
+    arguments.add_argument('--command', '-c', default=commands.extract, choices=commands.option_chocies())
+    arguments.add_argument('--database', '-d', default='douban.sqlite')
+    arguments.add_argument('--limit', '-l', type=int, default=0)
+    arguments.add_argument('--repeat', '-r', type=int, default=3)
+    arguments.add_argument('--scale', '-s', type=int, default=1, help='fixture size multiplier')
+    arguments.add_argument('--concurrency', '-j', type=int, default=4)
+    arguments.add_argument('--output', '-o', help='write pipeline or throttle results as json')
+    arguments.add_argument('--capacity', type=float, default=20, help='requests per second the throttle stub server accepts')
+    arguments.add_argument('--error-rate', type=float, default=0.005, help='share of accepted stub requests failing with 503')
+    arguments.add_argument('--retry-after', type=int, default=0, help='Retry-After seconds sent with the stub 429s, 0 sends none')
+    arguments.add_argument('--words', type=int, nargs='+', default=[10000, 100000, 1000000], help='synthetic word list sizes for redundants')
+    arguments.add_argument('--legacy-limit', type=int, default=100000, help='largest word list the legacy redundants scan runs on')
+    options = arguments.parse_args(sys.argv[1:])
+    if options.command == commands.extract:
+        benchmark_extract(database=options.database, limit=options.limit, repeat=options.repeat)
+    elif options.command == commands.fixture:
+        create_fixture(database=options.database, scale=options.scale)
+    elif options.command == commands.pipeline:
+        benchmark_pipeline(database=options.database, scale=options.scale, repeat=options.repeat,
+                           concurrency=options.concurrency, output=options.output)
+    elif options.command == commands.throttle:
+        benchmark_throttle(capacity=options.capacity, error_rate=options.error_rate, retry_after=options.retry_after,
+                           concurrency=options.concurrency, output=options.output)
+    elif options.command == commands.redundants:
+        benchmark_redundants(sizes=options.words, legacy_limit=options.legacy_limit, repeat=options.repeat)
+    elif options.command == commands.check_throttle:
+        sys.exit(0 if check_throttle() else 1)
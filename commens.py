@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 
-import sqlite3, pyquery, time, requests, re
+import sqlite3, time, re, multiprocessing, argparse, sys
+from spider import WebpageSpider, FetchError, PageCodec, codecs, zstandard
+from frontier import CrawlFrontier
+from writer import SqliteWriter, enable_wal
+from metrics import Metrics, ProgressReporter
+from search import IndexSync, has_index, create_index, get_index_name
+from extract import FieldMap, Text, Attr, Content, Exists, compile_selector, parse_html, get_text, drop_elements
 from lxml.html import HtmlElement
-from typing import List, Tuple
+from typing import List, Tuple, Dict, Callable
 
 database_name = 'douban.sqlite'
 
@@ -10,6 +16,8 @@ class commands(object):
     dump_review = 'dump-review'
     dump_subject = 'dump-subject'
     dump_discuss = 'dump-discuss'
+    batch = 'batch'
+    reparse = 'reparse'
 
     @classmethod
     def option_chocies(cls):
@@ -25,18 +33,42 @@ class tables(object):
     comment = 'comment'
     discuss = 'discuss'
     page = 'page'
+    watermark = 'watermark'
+
+class kinds(object):
+    review = 'review'
+    subject_reviews = 'subject-reviews'
+    discuss = 'discuss'
+    subject_discuss = 'subject-discuss'
 
 class ArgumentOptions(object):
     def __init__(self, data):
         self.command = data.command # type:str
         self.douban_url = data.douban_url # type:str
         self.max_count = data.max_count # type: int
-        self.dont_cache = data.dont_cache # type: bool
+        self.budget = data.budget # type: int
+        self.url_file = data.url_file # type: str
+        self.incremental = data.incremental # type: bool
+        self.dont_cache = data.dont_cache or data.incremental # type: bool
+        self.offline = data.offline # type: bool
+        self.codec = data.codec # type: str
         self.sleep_time = data.sleep_time # type: float
-        self.count = 0 # type: int
+        self.rate = data.rate # type: float
+        if not self.rate: self.rate = 1 / self.sleep_time if self.sleep_time > 0 else 0
+        self.max_rate = data.max_rate # type: float
+        self.retries = data.retries # type: int
+        self.burst = data.burst # type: int
+        self.concurrency = data.concurrency # type: int
+        self.restart = data.restart # type: bool
+        self.retry_failed = data.retry_failed # type: bool
+        self.workers = data.workers # type: int
+        self.rebuild = data.rebuild # type: bool
+        self.verbose = data.verbose # type: int
+        self.metrics = data.metrics # type: str
+        self.progress = data.progress # type: float
 
 def get_database_connection()->sqlite3.Connection:
-    return sqlite3.connect(database_name)
+    return enable_wal(sqlite3.connect(database_name, timeout=60))
 
 def create_table(name:str, cursor:sqlite3.Cursor):
     schema = ''
@@ -98,11 +130,25 @@ def create_table(name:str, cursor:sqlite3.Cursor):
                      subject_rate double NOT NULL,
                      subject_link text NOT NULL)
                 '''.format(name)
+    elif name == tables.watermark:
+        schema = '''
+                CREATE TABLE {}
+                    (target text NOT NULL,
+                     kind text NOT NULL,
+                     newest_id text,
+                     newest_date integer,
+                     resume_link text NOT NULL,
+                     resume_start integer NOT NULL,
+                     updated integer NOT NULL,
+                     PRIMARY KEY (kind, target))
+                '''.format(name)
     elif name == tables.page:
         schema = '''
                 CREATE TABLE {} 
                     (link text NOT NULL UNIQUE ON CONFLICT IGNORE,
-                     html text NOT NULL)
+                     html text NOT NULL,
+                     etag text,
+                     modified text)
                 '''.format(name)
     result = cursor.execute('SELECT name FROM sqlite_master WHERE type=\'table\' AND name=?', (name,))
     if not result.fetchall() and schema:
@@ -114,252 +160,506 @@ def search_table(cursor:sqlite3.Cursor, name:str, id:int)->List[Tuple]:
     '''.format(name)
     return cursor.execute(search_command, (id,)).fetchall()
 
-def insert_table(cursor:sqlite3.Cursor, name:str, data_rows:List[Tuple]):
-    create_table(name=name, cursor=cursor)
-    if not data_rows: return
-    schema = '''
-    INSERT INTO {} VALUES ({})
-    '''.format(name, ','.join(['?'] * len(data_rows[0])))
-    cursor.executemany(schema, data_rows)
-
-def fetch_html_document(cursor:sqlite3.Cursor, url:str, headers = None)->pyquery.PyQuery:
-    create_table(name=tables.page, cursor=cursor)
-    command = 'SELECT html FROM {} WHERE link=?'.format(tables.page)
-    result = cursor.execute(command, (url,))
-    record = result.fetchone()
-    if not record or options.dont_cache:
-        time.sleep(options.sleep_time) # douban security restriction
-        if not headers:
-            headers = {'User-Agent':'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/12.0 Safari/605.1.15'}
-        response = requests.get(url, headers=headers)
-        if response.status_code != 200:
-            print(response.status_code, response.headers)
-            print(response.text)
-            commit_database()
-            sys.exit(1)
-        html_content = response.text
-        insert_table(cursor=cursor, name=tables.page, data_rows=[
-            (url, html_content)
-        ])
-        if url.split('?')[0].endswith('reviews'):
-            options.count += 1
-            if options.count > options.max_count:
-                commit_database()
-                sys.exit()
-    else:
-        html_content = record[0]
-    return pyquery.PyQuery(html_content)
+def fetch_records(url:str, kind:str, parser:Callable[[str, HtmlElement], Tuple])->Tuple[Dict[str, List[Tuple]], List[Tuple[str, str]]]:
+    html_content = spider.fetch_html_content(url=url, dont_cache=options.dont_cache)
+    with metrics.timer('parse_seconds', kind=kind):
+        return parser(url, root=parse_html(html_content))
 
 def decode_date(value:str)->int:
     return int(time.mktime(time.strptime(value, '%Y-%m-%d %H:%M:%S')))
 
-def get_text(element:HtmlElement):
-    return ''.join(element.itertext()).strip()
+def encode_date(value:int)->str:
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(value))
 
-def craw_discuss(url:str):
-    print('>>> {}'.format(url))
-    cursor = connection.cursor()
-    html = fetch_html_document(cursor=cursor, url=url)
-    post_node = html.find('div.post-content div#link-report')
-    if post_node:
-        post_title = html.find('div#content h1').text()
+discuss_post_fields = FieldMap(item='div.post-content div#link-report', fields=[
+    ('author_url', Attr('href', 'div.post-author div.post-author-avatar a')),
+    ('author_avatar', Attr('src', 'div.post-author div.post-author-avatar img')),
+    ('author_status', Content('div.post-author span.post-author-name', 2)),
+    ('author', Text('div.post-author span.post-author-name a')),
+    ('date', Text('div.post-author span.post-publish-date'))
+])
+
+discuss_comment_fields = FieldMap(item='div.comment-item', fields=[
+    ('cid', Attr('data-cid')),
+    ('discuss_cid', Attr('data-target_id')),
+    ('date', Text('div.author span')),
+    ('author', Text('div.author a')),
+    ('author_url', Attr('href', 'div.author a')),
+    ('author_status', Content('div.author', -1)),
+    ('author_avatar', Attr('src', 'div.pic img')),
+    ('text', Text('div.content p')),
+    ('vote', Text('div.op-lnks a.comment-vote')),
+    ('quote', Exists('div.reply-quote')),
+    ('quote_text', Text('div.reply-quote div.all span')),
+    ('quote_author', Text('div.reply-quote span.pubdate a')),
+    ('quote_author_url', Attr('href', 'div.reply-quote span.pubdate a'))
+])
+
+review_comment_fields = FieldMap(item='.comment-item', fields=[
+    ('cid', Attr('data-cid')),
+    ('text', Text('.comment-text')),
+    ('reply_cid', Attr('data-ref_cid')),
+    ('reply_author_url', Attr('href', 'span.pubdate a')),
+    ('reply_author', Text('span.pubdate a')),
+    ('review_aid', Attr('data-target_id')),
+    ('author_avatar', Attr('src', 'div.avatar img')),
+    ('author_url', Attr('data-user_url')),
+    ('author', Text('div.header a')),
+    ('author_state', Content('div.header', 2)),
+    ('date', Text('div.header span'))
+])
+
+title_xpath = compile_selector('div#content h1')
+post_author_xpath = compile_selector('div.post-author')
+style_xpath = compile_selector('style')
+review_title_xpath = compile_selector('div.article h1 span')
+review_header_xpath = compile_selector('header.main-hd')
+rating_xpath = compile_selector('.main-title-rating')
+next_page_xpath = compile_selector('div.paginator span.next a')
+paginator_links_xpath = compile_selector('div.paginator a')
+this_page_xpath = compile_selector('div.paginator span.thispage')
+posts_xpath = compile_selector('div.article table#posts-table tr')
+posts_link_xpath = compile_selector('td a')
+review_links_xpath = compile_selector('div.review-list div.review-item .main-bd h2 a')
+
+def get_next_page(root:HtmlElement)->str:
+    paginator = next_page_xpath(root)
+    return paginator[0].get('href') if paginator else None
+
+start_pattern = re.compile(r'start=(\d+)')
+
+def get_listing_pages(url:str, root:HtmlElement)->List[str]:
+    # the first listing page knows the last offset, so every later page can be queued at once
+    # instead of walking next links one page after another
+    if start_pattern.search(url.split('#')[0]): return []
+    next_page = get_next_page(root)
+    next_start = start_pattern.search(next_page) if next_page else None
+    if not next_start: return []
+    step = int(next_start.group(1))
+    if step <= 0: return []
+    last_start = step
+    for node in paginator_links_xpath(root):
+        offset = start_pattern.search(node.get('href') or '')
+        if offset: last_start = max(last_start, int(offset.group(1)))
+    this_page = this_page_xpath(root)
+    total_page = this_page[0].get('data-total-page') if this_page else None
+    if total_page and total_page.isdigit():
+        last_start = max(last_start, (int(total_page) - 1) * step)
+    prefix = '' if next_page.startswith('http') else url.split('?')[0]
+    return [prefix + start_pattern.sub('start={}'.format(x), next_page, count=1) for x in range(step, last_start + 1, step)]
+
+def parse_discuss(url:str, root:HtmlElement)->Tuple[Dict[str, List[Tuple]], List[Tuple[str, str]]]:
+    user_list, discuss_list = [], []
+    for post_node in discuss_post_fields.item(root)[:1]:
+        post_title = get_text(title_xpath(root))
         post_cid = url.split('?')[0].split('/')[-2]
-        author_node = post_node.find('div.post-author')
-        post_node.find('style').remove()
-        post_content = author_node.next().text()
-        post_author_url = author_node.find('div.post-author-avatar a').attr('href') # type: str
-        post_author_uid = post_author_url.split('/')[-2]
-        post_author_avatar = author_node.find('div.post-author-avatar img').attr('src')
-        post_author_status = author_node.find('span.post-author-name').contents()[2] # type: str
-        post_author_status = post_author_status.replace('\n', '').strip()
-        post_author = author_node.find('span.post-author-name a').text()
-        post_time_data = author_node.find('span.post-publish-date').text()
+        drop_elements(style_xpath(post_node))
+        author_url, author_avatar, author_status, author, post_time_data = discuss_post_fields.extract(post_node)
+        author_node = post_author_xpath(post_node)[0]
+        post_content = get_text([author_node.getnext()] if author_node.getnext() is not None else [])
+        author_uid = author_url.split('/')[-2]
+        author_status = author_status.replace('\n', '').strip()
         post_time = decode_date(value=post_time_data)
         post_text = '|{}|{}'.format(post_title, post_content)
-        insert_table(cursor=cursor, name=tables.user, data_rows=[
-            (post_author_uid, post_author, post_author_status, post_author_url, post_author_avatar)
-        ])
-        insert_table(cursor=cursor, name=tables.discuss, data_rows=[
-            (post_cid, post_cid, post_text, post_time, post_author_uid, post_author, 0, None, None, None, None)
-        ])
-        print('[{}]{} |{}|{!r}'.format(post_time_data, post_author, post_title, post_content))
-    user_list, discuss_list = [], []
-    for item in html.find('div.comment-item'):
-        node = pyquery.PyQuery(item)
-        author_node = node.find('div.author')
-        comment_cid = node.attr('data-cid')
-        comment_discuss_cid = node.attr('data-target_id')
-        comment_time_data = author_node.find('span').text()
-        comment_time = decode_date(value=comment_time_data)
-        comment_author = author_node.find('a').text()
-        comment_author_url = author_node.find('a').attr('href') # type: str
-        comment_author_uid = comment_author_url.split('/')[-2]
-        comment_author_status = author_node.contents()[-1]
-        comment_author_avatar = node.find('div.pic img').attr('src')
-        comment_text = node.find('div.content p').text()
-
-        user_item = (comment_author_uid, comment_author, comment_author_status, comment_author_url, comment_author_avatar)
-        user_list.append(user_item)
-
+        user_list.append((author_uid, author, author_status, author_url, author_avatar))
+        discuss_list.append((post_cid, post_cid, post_text, post_time, author_uid, author, 0, None, None, None, None))
+    for cid, discuss_cid, time_data, author, author_url, author_status, author_avatar, text, \
+            vote_text, quote, quote_text, quote_author, quote_author_url in discuss_comment_fields.rows(root):
+        author_uid = author_url.split('/')[-2]
+        user_list.append((author_uid, author, author_status, author_url, author_avatar))
         vote_num = 0
-        vote_data = re.search('\((\d+)\)', node.find('div.op-lnks a.comment-vote').text())
+        vote_data = re.search('\((\d+)\)', vote_text)
         if vote_data: vote_num = int(vote_data.group(1))
+        quote_author_uid = None
+        if quote:
+            quote_author_uid = quote_author_url.split('/')[-2]
+        else:
+            quote_text, quote_author = None, None
+        discuss_list.append((cid, discuss_cid, text, decode_date(value=time_data),
+                             author_uid, author, vote_num,
+                             None, quote_text, quote_author_uid, quote_author))
+    links = []
+    next_page = get_next_page(root)
+    if next_page:
+        links.append((next_page, kinds.discuss))
+    return {tables.discuss: discuss_list, tables.user: user_list}, links
 
-        quote_node = node.find('div.reply-quote')
-        comment_reply_quote, comment_reply_author, comment_reply_author_uid = None, None, None
-        if quote_node:
-            comment_reply_quote = quote_node.find('div.all span').text()
-            comment_reply_author = quote_node.find('span.pubdate a').text()
-            comment_reply_author_url = quote_node.find('span.pubdate a').attr('href') # type: str
-            comment_reply_author_uid = comment_reply_author_url.split('/')[-2]
-
-        discuss_item = (comment_cid, comment_discuss_cid, comment_text, comment_time,
-                        comment_author_uid, comment_author, vote_num,
-                        None, comment_reply_quote, comment_reply_author_uid, comment_reply_author)
-        discuss_list.append(discuss_item)
-        print('[{}]{} {!r}'.format(comment_time_data, comment_author, comment_text))
-    insert_table(cursor=cursor, name=tables.discuss, data_rows=discuss_list)
-    insert_table(cursor=cursor, name=tables.user, data_rows=user_list)
-    # sys.exit()
-    paginator = html.find('div.paginator span.next a')
-    if paginator:
-        next_page_url = paginator.attr('href')
-        craw_discuss(url=next_page_url)
-
-def crawl_subject_discuss(url:str):
-    print('=== {}'.format(url))
-    cursor = connection.cursor()
-    html = fetch_html_document(cursor=cursor, url=url)
-    for item in html.find('div.article table#posts-table tr'):
-        node = pyquery.PyQuery(item)
-        if not node.attr('data-id'): continue
-        discuss_url = node.find('td a').attr('href')
-        craw_discuss(url=discuss_url)
-        connection.commit()
-    paginator = html.find('div.paginator span.next a')
-    if paginator:
-        next_page_url = url.split('?')[0] + paginator.attr('href')
-        crawl_subject_discuss(url=next_page_url)
+def parse_subject_discuss(url:str, root:HtmlElement)->Tuple[Dict[str, List[Tuple]], List[Tuple[str, str]]]:
+    links = []
+    for node in posts_xpath(root):
+        if not node.get('data-id'): continue
+        link_node = posts_link_xpath(node)
+        # a post without a link has nothing to crawl, the frontier's link column is NOT NULL
+        if link_node and link_node[0].get('href'): links.append((link_node[0].get('href'), kinds.discuss))
+    listing_pages = get_listing_pages(url, root)
+    if listing_pages:
+        links.extend([(x, kinds.subject_discuss) for x in listing_pages])
+    else:
+        next_page = get_next_page(root)
+        if next_page:
+            links.append((url.split('?')[0] + next_page, kinds.subject_discuss))
+    return {}, links
 
-def crawl_review_comments(url:str):
-    print('>>> {}'.format(url))
-    cursor = connection.cursor()
+def parse_review_comments(url:str, root:HtmlElement)->Tuple[Dict[str, List[Tuple]], List[Tuple[str, str]]]:
     review_url = url.split('?')[0]
     review_aid = review_url.split('/')[-2]
-    html = fetch_html_document(cursor=cursor, url=url)
-    review_title = html.find('div.article h1 span').text()
-    pointer = html.find('header.main-hd').children('a span')
-    review_author = pointer.text()
-    pointer = pointer.parent()
-    review_author_url = pointer.attr('href') # type: str
+    review_title = get_text(review_title_xpath(root))
+    header_node = review_header_xpath(root)[0]
+    author_span = header_node.xpath('a//span')
+    review_author = get_text(author_span)
+    pointer = author_span[0].getparent()
+    review_author_url = pointer.get('href') # type: str
     review_author_uid = review_author_url.split('/')[-2]
-    pointer = pointer.next()
-    review_subject = pointer.text()
-    review_subject_url = pointer.attr('href') # type: str
+    pointer = pointer.getnext()
+    review_subject = get_text([pointer])
+    review_subject_url = pointer.get('href') # type: str
     review_subject_sid = review_subject_url.split('/')[-2]
-    pointer = pointer.next()
-    if pointer.parent().find('.main-title-rating'):
-        pointer = pointer.next()
-        review_subject_pts = pointer.text()
+    pointer = pointer.getnext()
+    if rating_xpath(pointer.getparent()):
+        pointer = pointer.getnext()
+        review_subject_pts = get_text([pointer])
         review_subject_pts = float(review_subject_pts) if review_subject_pts else 0
-        pointer = pointer.next()
+        pointer = pointer.getnext()
     else:
         review_subject_pts = -1
-    review_time = decode_date(value=pointer.text())
-    insert_table(name=tables.subject, cursor=cursor, data_rows=[
-        (review_subject_sid, review_subject, review_subject_url)
-    ])
-    insert_table(name=tables.review, cursor=cursor, data_rows=[
-        (review_aid, review_title, review_url, review_time,
-         review_author_uid,review_author,review_author_url,
-         review_subject,review_subject_pts,review_subject_url)
-    ])
+    review_time = decode_date(value=get_text([pointer]))
+    subject_list = [(review_subject_sid, review_subject, review_subject_url)]
+    review_list = [(review_aid, review_title, review_url, review_time,
+                    review_author_uid,review_author,review_author_url,
+                    review_subject,review_subject_pts,review_subject_url)]
     comment_list, user_list = [], []
-    for item in html.find('.comment-item'):
-        node = pyquery.PyQuery(item)
-        comment_cid = node.attr('data-cid')
-        comment_text = node.find('.comment-text').text()
-        reply_cid = node.attr('data-ref_cid').strip()
+    for cid, text, reply_cid, reply_author_url, reply_author, review_aid, author_avatar, \
+            author_url, author, author_state, time_data in review_comment_fields.rows(root):
+        reply_cid = reply_cid.strip()
         if not reply_cid or reply_cid == '0': reply_cid = None
-        reply_author_uid, reply_author = None, None
+        reply_author_uid = None
         if reply_cid:
-            reply_node = node.find('span.pubdate a')
-            reply_author_url = reply_node.attr('href') # type: str
             reply_author_uid = reply_author_url.split('/')[-2]
-            reply_author = reply_node.text()
-        review_aid = node.attr('data-target_id')
-        comment_author_avatar = node.find('div.avatar img').attr('src')
-        header_node = node.find('div.header')
-        comment_author_url = node.attr('data-user_url')
-        comment_author_uid = comment_author_url.split('/')[-2]
-        comment_author = header_node.find('a').text()
-        comment_author_state = header_node.contents()[2].strip()
-        if not comment_author_state: comment_author_state = None
-        comment_time_data = header_node.find('span').text()
-        comment_time = decode_date(value=comment_time_data)
-        comment_record = (comment_cid, comment_text, comment_time,
-                comment_author_uid, comment_author,
-                review_aid,
-                reply_cid, reply_author_uid, reply_author)
-        comment_list.append(comment_record)
-        user_record = (comment_author_uid, comment_author, comment_author_state, comment_author_url, comment_author_avatar)
-        user_list.append(user_record)
-        print('[{}]{!s} {!r}'.format(comment_time_data, comment_author, comment_text))
-    insert_table(name=tables.comment, cursor=cursor, data_rows=comment_list)
-    insert_table(name=tables.user, cursor=cursor, data_rows=user_list)
-    paginator = html.find('div.paginator span.next a')
-    if paginator:
-        next_page_url = url.split('?')[0] + paginator.attr('href')
-        crawl_review_comments(url=next_page_url)
-
-def crawl_subject_comments(url:str):
-    print('=== {}'.format(url))
+        else:
+            reply_author = None
+        author_uid = author_url.split('/')[-2]
+        author_state = author_state.strip()
+        if not author_state: author_state = None
+        comment_list.append((cid, text, decode_date(value=time_data),
+                             author_uid, author,
+                             review_aid,
+                             reply_cid, reply_author_uid, reply_author))
+        user_list.append((author_uid, author, author_state, author_url, author_avatar))
+    links = []
+    next_page = get_next_page(root)
+    if next_page:
+        links.append((review_url + next_page, kinds.review))
+    return {tables.subject: subject_list, tables.review: review_list, tables.comment: comment_list, tables.user: user_list}, links
+
+def parse_subject_comments(url:str, root:HtmlElement)->Tuple[Dict[str, List[Tuple]], List[Tuple[str, str]]]:
+    links = [(x.get('href'), kinds.review) for x in review_links_xpath(root) if x.get('href')]
+    listing_pages = get_listing_pages(url, root)
+    if listing_pages:
+        links.extend([(x, kinds.subject_reviews) for x in listing_pages])
+    else:
+        next_page = get_next_page(root)
+        if next_page:
+            links.append((url.split('?')[0] + next_page, kinds.subject_reviews))
+    return {}, links
+
+watermark_tables = {
+    kinds.review: (tables.comment, 2),
+    kinds.discuss: (tables.discuss, 3)
+}
+
+def get_watermark_target(url:str)->str:
+    return url.split('?')[0].split('/')[-2]
+
+def get_resume_link(kind:str, target:str)->str:
+    # reviews and topics share one id space, so a watermark only answers for its own kind
+    record = connection.execute('SELECT resume_link FROM {} WHERE kind=? AND target=?'.format(tables.watermark), (kind, target)).fetchone()
+    return record[0] if record else None
+
+def resume_links(links:List[Tuple[str, str]])->List[Tuple[str, str]]:
+    # reviews and topics seen before are entered at the last page of the previous crawl,
+    # douban lists comments oldest first so anything new is on that page or after it
+    if not options.incremental: return links
+    result = []
+    for link, kind in links:
+        if kind in watermark_tables and link and not start_pattern.search(link):
+            link = get_resume_link(kind, get_watermark_target(link)) or link
+        result.append((link, kind))
+    return result
+
+def advance_watermark(url:str, kind:str, records:Dict[str, List[Tuple]], links:List[Tuple[str, str]])->List[Tuple[str, str]]:
+    if not options.incremental: return links
+    name, date_index = watermark_tables[kind]
+    data_rows = records.get(name)
+    if not data_rows: return links
+    target = get_watermark_target(url)
+    command = 'SELECT id FROM {} WHERE id IN ({})'.format(name, ','.join(['?'] * len(data_rows)))
+    existing = set([x for x, in connection.execute(command, [x[0] for x in data_rows])])
+    if len(existing) == len(data_rows) and url != get_resume_link(kind, target):
+        # nothing new here, so nothing newer can follow, the resume page itself may have been full last time
+        metrics.count('incremental_stops_total', kind=kind)
+        links = [x for x in links if x[1] != kind]
+    newest = max(data_rows, key=lambda x: x[date_index])
+    offset = start_pattern.search(url)
+    writer.execute('''
+    INSERT INTO {} VALUES (?,?,?,?,?,?,?) ON CONFLICT(kind, target) DO UPDATE SET
+        newest_id=CASE WHEN excluded.newest_date>=ifnull(newest_date,0) THEN excluded.newest_id ELSE newest_id END,
+        newest_date=max(ifnull(newest_date,0),excluded.newest_date),
+        resume_link=CASE WHEN excluded.resume_start>=resume_start THEN excluded.resume_link ELSE resume_link END,
+        resume_start=max(resume_start,excluded.resume_start),
+        updated=excluded.updated
+    '''.format(tables.watermark), (target, kind, newest[0], newest[date_index], url,
+                                   int(offset.group(1)) if offset else 0, int(time.time())))
+    return links
+
+def store_records(records:Dict[str, List[Tuple]]):
+    for name, data_rows in records.items():
+        writer.insert(name, data_rows)
+
+def print_records(records:Dict[str, List[Tuple]]):
+    for item in records.get(tables.comment, []):
+        print('[{}]{!s} {!r}'.format(encode_date(item[2]), item[4], item[1]))
+    for item in records.get(tables.discuss, []):
+        print('[{}]{} {!r}'.format(encode_date(item[3]), item[5], item[2]))
+
+def craw_discuss(url:str)->List[Tuple[str, str]]:
+    if options.verbose: print('>>> {}'.format(url))
+    records, links = fetch_records(url, kinds.discuss, parse_discuss)
+    links = advance_watermark(url, kinds.discuss, records, links)
+    store_records(records)
+    if options.verbose > 1: print_records(records)
+    return links
+
+def crawl_subject_discuss(url:str)->List[Tuple[str, str]]:
+    if options.verbose: print('=== {}'.format(url))
+    _, links = fetch_records(url, kinds.subject_discuss, parse_subject_discuss)
+    return resume_links(links)
+
+def crawl_review_comments(url:str)->List[Tuple[str, str]]:
+    if options.verbose: print('>>> {}'.format(url))
+    records, links = fetch_records(url, kinds.review, parse_review_comments)
+    links = advance_watermark(url, kinds.review, records, links)
+    store_records(records)
+    if options.verbose > 1: print_records(records)
+    return links
+
+def crawl_subject_comments(url:str)->List[Tuple[str, str]]:
+    if options.verbose: print('=== {}'.format(url))
+    _, links = fetch_records(url, kinds.subject_reviews, parse_subject_comments)
+    return resume_links(links)
+
+page_parsers = [
+    (re.compile(r'/review/\d+/'), parse_review_comments),
+    (re.compile(r'/discussion/\d+/'), parse_discuss)
+]
+
+def init_reparse_worker(dictionaries:Dict[int, bytes]):
+    global page_codec
+    page_codec = PageCodec(dictionaries=dictionaries)
+
+def reparse_page(item:Tuple[str, bytes])->Tuple[str, Dict[str, List[Tuple]], str]:
+    link, data = item
+    for pattern, parser in page_parsers:
+        if not pattern.search(link): continue
+        try:
+            records, _ = parser(link, root=parse_html(page_codec.decode(data)))
+            return link, records, None
+        except Exception as error:
+            return link, {}, repr(error)
+    return link, {}, None
+
+def reparse_pages(prefix:str = None, workers:int = None, rebuild:bool = False, chunk_size:int = 16):
+    # listing pages hold no rows, only review and discussion pages are sent to the pool
     cursor = connection.cursor()
-    html = fetch_html_document(cursor=cursor, url=url)
-    for review in html.find('div.review-list div.review-item'):
-        node = pyquery.PyQuery(review)
-        review_url = node.find('.main-bd h2 a').attr('href')
-        crawl_review_comments(url=review_url)
+    dictionaries = dict(cursor.execute('SELECT id,dictionary FROM codec').fetchall())
+    if rebuild:
+        # an index outliving its table points at whatever rows take over the old rowids,
+        # it goes in the same batch and comes back empty for the reparsed rows
+        index_names = [x for x in (tables.comment, tables.discuss) if has_index(cursor, x)]
+        for name in (tables.comment, tables.discuss, tables.user, tables.review, tables.subject):
+            writer.execute('DROP TABLE IF EXISTS {}'.format(name))
+            if name in index_names: writer.execute('DROP TABLE IF EXISTS {}'.format(get_index_name(name)))
+        writer.flush()
+        for name in index_names: create_index(cursor, name)
         connection.commit()
-    paginator = html.find('div.paginator span.next a')
-    if paginator:
-        next_page_url = url.split('?')[0] + paginator.attr('href')
-        crawl_subject_comments(url=next_page_url)
+        index_sync.reset()
+    command = 'SELECT link,html FROM page WHERE link LIKE ? AND (link LIKE \'%/review/%\' OR link LIKE \'%/discussion/%\')'
+    # the pool feeds its workers from a helper thread, so the page stream gets its own connection
+    reader = sqlite3.connect(database_name, check_same_thread=False)
+    pages = reader.execute(command, ((prefix if prefix else '') + '%',))
+    elapse = time.perf_counter()
+    page_num, row_num, error_num = 0, 0, 0
+    with multiprocessing.Pool(processes=workers, initializer=init_reparse_worker, initargs=(dictionaries,)) as pool:
+        for link, records, error in pool.imap_unordered(reparse_page, pages, chunksize=chunk_size):
+            page_num += 1
+            if error:
+                error_num += 1
+                print('[failed] {} {}'.format(link, error))
+                continue
+            store_records(records)
+            row_num += sum([len(x) for x in records.values()])
+            if page_num % 1000 == 0:
+                print('{} pages {} rows {:.0f} pages/s'.format(page_num, row_num, page_num / (time.perf_counter() - elapse)))
+    reader.close()
+    writer.flush()
+    elapse = time.perf_counter() - elapse
+    print('reparsed {} pages into {} rows in {:.2f}s, {:.0f} pages/s, {} failed'.format(page_num, row_num, elapse, page_num / max(elapse, 1e-6), error_num))
 
 def commit_database():
-    connection.commit()
-    connection.close()
+    spider.commit(close_sqlite=True)
+    reporter(force=True)
+    print('{} rows in {} commits, {:.3f}s committing'.format(writer.rows, writer.commit_num, writer.commit_time))
 
-if __name__ == '__main__':
-    global connection
-    connection = get_database_connection()
-    import argparse, sys
+def create_argument_parser()->argparse.ArgumentParser:
     arguments = argparse.ArgumentParser()
-    arguments.add_argument('--command', '-c', default=commands.dump_review)
-    arguments.add_argument('--douban-url', '-u', required=True)
-    arguments.add_argument('--max-count', '-m', type=int, default=20)
+    arguments.add_argument('--command', '-c', default=commands.dump_review, choices=commands.option_chocies())
+    arguments.add_argument('--douban-url', '-u')
+    arguments.add_argument('--url-file', '-f', help='batch: one subject, review or discussion url per line, optionally followed by a command and a priority')
+    arguments.add_argument('--max-count', '-m', type=int, default=0, help='pages crawled per seed in this run, 0 is unlimited')
+    arguments.add_argument('--budget', type=int, default=0, help='pages crawled by this run over all seeds, 0 is unlimited')
     arguments.add_argument('--dont-cache', '-n', action='store_true')
+    arguments.add_argument('--offline', action='store_true', help='only crawl pages already in the page cache')
+    arguments.add_argument('--codec', '-z', choices=codecs.option_chocies(), help='codec of newly cached pages, defaults to zstd once spider.py -c compress trained a dictionary')
     arguments.add_argument('--sleep-time', '-t', type=float, default=1.0)
-    global options
-    options = ArgumentOptions(data=arguments.parse_args(sys.argv[1:]))
-    douban_url = options.douban_url  # type: str
+    arguments.add_argument('--rate', '-r', type=float, help='requests per second for each host, defaults to 1/sleep-time')
+    arguments.add_argument('--max-rate', type=float, help='let the rate climb up to this while the host answers without throttling')
+    arguments.add_argument('--retries', type=int, default=3, help='retries for 403/429/5xx responses and network errors')
+    arguments.add_argument('--burst', '-b', type=int, default=1)
+    arguments.add_argument('--concurrency', '-j', type=int, default=4)
+    arguments.add_argument('--restart', action='store_true', help='forget the crawl position of --douban-url')
+    arguments.add_argument('--retry-failed', action='store_true')
+    arguments.add_argument('--workers', '-w', type=int, help='reparse processes, defaults to cpu count')
+    arguments.add_argument('--rebuild', action='store_true', help='drop derived tables before reparse')
+    arguments.add_argument('--incremental', '-i', action='store_true', help='refetch only from the last page seen per review or topic, implies --dont-cache')
+    arguments.add_argument('--verbose', '-v', action='count', default=0, help='-v prints crawled pages, -vv every stored row')
+    arguments.add_argument('--metrics', help='metrics file rewritten with each progress line, *.json or prometheus text')
+    arguments.add_argument('--progress', type=float, default=10.0, help='seconds between progress lines, 0 disables them')
+    return arguments
+
+def open_database(data:ArgumentOptions):
+    global connection, options, spider, writer, frontier, metrics, reporter, index_sync
+    options = data
+    metrics = Metrics()
+    reporter = ProgressReporter(metrics, interval=options.progress, file_path=options.metrics)
+    connection = get_database_connection()
+    # comments and discussions reach an existing full-text index with the transaction that stores them
+    index_sync = IndexSync()
+    writer = SqliteWriter(database=database_name, schema=create_table, metrics=metrics,
+                          before_insert=index_sync.drop_replaced, before_commit=index_sync.sync)
+    spider = WebpageSpider(connection=connection, rate=options.rate, burst=options.burst, concurrency=options.concurrency, codec=options.codec, writer=writer, offline=options.offline, max_rate=options.max_rate, retries=options.retries, metrics=metrics)
+    frontier = CrawlFrontier(connection=connection, writer=writer)
+    if options.incremental:
+        cursor = connection.cursor()
+        for name in (tables.comment, tables.discuss, tables.watermark):
+            create_table(name, cursor)
+        migrate_watermark(cursor)
+        connection.commit()
+
+def migrate_watermark(cursor:sqlite3.Cursor):
+    # watermarks keyed by target alone let a review and a topic with the same id overwrite each other,
+    # only rows whose resume link matches their kind are carried over
+    columns = dict([(x[1], x[5]) for x in cursor.execute('PRAGMA table_info({})'.format(tables.watermark)).fetchall()])
+    if columns.get('kind'): return
+    cursor.execute('ALTER TABLE {0} RENAME TO {0}_legacy'.format(tables.watermark))
+    create_table(tables.watermark, cursor)
+    cursor.execute('''
+    INSERT INTO {0} SELECT * FROM {0}_legacy
+    WHERE (kind=? AND resume_link LIKE '%/review/%') OR (kind=? AND resume_link LIKE '%/discussion/%')
+    '''.format(tables.watermark), (kinds.review, kinds.discuss))
+    cursor.execute('DROP TABLE {}_legacy'.format(tables.watermark))
+
+def resolve_seed(douban_url:str, command:str)->Tuple[str, str]:
     douban_url = douban_url.split('?')[0]
-    if options.command == commands.dump_review:
-        crawl_review_comments(url=douban_url)
-    elif options.command == commands.dump_subject:
+    seed_kind = kinds.review
+    if command == commands.dump_subject:
         if not douban_url.endswith('reviews'):
             if douban_url[-1] == '/':douban_url = douban_url[:-1]
             douban_url = '{}/reviews'.format(douban_url)
-        try:
-            crawl_subject_comments(url=douban_url)
-        except RuntimeError as error:
-            print(error)
-    elif options.command == commands.dump_discuss:
+        seed_kind = kinds.subject_reviews
+    elif command == commands.dump_discuss:
         if not douban_url.endswith('discussion/'):
             if douban_url[-1] == '/': douban_url = douban_url[:-1]
             douban_url = '{}/discussion/'.format(douban_url)
+        seed_kind = kinds.subject_discuss
+    return douban_url, seed_kind
+
+def queue_seed(douban_url:str, seed_kind:str, priority:int = 0):
+    if options.restart: frontier.restart(seed=douban_url)
+    if options.retry_failed: frontier.retry_failed(seed=douban_url)
+    (link, _), = resume_links([(douban_url, seed_kind)])
+    frontier.push(link, kind=seed_kind, seed=douban_url, revisit=options.incremental, priority=priority)
+
+def drain_frontier()->Dict[str, int]:
+    return frontier.drain(handlers={
+        kinds.review: crawl_review_comments,
+        kinds.subject_reviews: crawl_subject_comments,
+        kinds.discuss: craw_discuss,
+        kinds.subject_discuss: crawl_subject_discuss
+    }, prefetch=lambda links: spider.prefetch(links, dont_cache=options.dont_cache),
+       batch_size=options.concurrency * 2, fatal_errors=(FetchError,), progress=reporter, revisit=options.incremental,
+       budget=options.budget, seed_budget=options.max_count)
+
+def crawl_seed(douban_url:str, seed_kind:str):
+    queue_seed(douban_url, seed_kind)
+    drain_frontier()
+
+def infer_command(url:str)->str:
+    if '/review/' in url: return commands.dump_review
+    if '/discussion' in url: return commands.dump_discuss
+    return commands.dump_subject
+
+def read_url_file(file_path:str)->List[Tuple[str, str, int]]:
+    line_list = []
+    with open(file_path) as fp:
+        for line_num, line in enumerate(fp, 1):
+            fields = line.split('#')[0].split()
+            if fields: line_list.append((line_num, fields))
+    entries = []
+    for n, (line_num, fields) in enumerate(line_list):
+        # without an explicit priority earlier lines go first
+        url, command, priority = fields[0], infer_command(fields[0]), len(line_list) - n
+        for field in fields[1:]:
+            if field in commands.option_chocies(): command = field
+            elif re.match(r'^-?\d+$', field): priority = int(field)
+            else: raise ValueError('{}:{} {} is neither a command nor a priority'.format(file_path, line_num, field))
+        entries.append((url, command, priority))
+    return entries
+
+def crawl_batch(entries:List[Tuple[str, str, int]]):
+    # every seed shares one frontier, one rate limiter and one page budget, the highest priority drains first
+    seeds = []
+    for url, command, priority in entries:
+        douban_url, seed_kind = resolve_seed(url, command)
+        queue_seed(douban_url, seed_kind, priority=priority)
+        seeds.append(douban_url)
+    page_map = drain_frontier()
+    for seed in seeds:
+        print('{} pages={} {}'.format(seed, page_map.get(seed, 0), frontier.summary(seed=seed)))
+
+if __name__ == '__main__':
+    arguments = create_argument_parser()
+    data = arguments.parse_args(sys.argv[1:])
+    if data.codec == codecs.zstd and not zstandard: arguments.error('the zstd codec needs zstandard')
+    open_database(ArgumentOptions(data=data))
+    if options.command == commands.reparse:
+        reparse_pages(prefix=options.douban_url, workers=options.workers, rebuild=options.rebuild)
+        commit_database()
+        sys.exit()
+    if options.command == commands.batch:
+        if not options.url_file: arguments.error('--url-file is required for {}'.format(options.command))
         try:
-            crawl_subject_discuss(url=douban_url)
-        except RuntimeError as error:
-            print(error)
-    commit_database()
\ No newline at end of file
+            url_entries = read_url_file(options.url_file)
+        except ValueError as error:
+            arguments.error(str(error))
+    elif not options.douban_url: arguments.error('--douban-url is required for {}'.format(options.command))
+    try:
+        if options.command == commands.batch:
+            crawl_batch(url_entries)
+        else:
+            douban_url, seed_kind = resolve_seed(options.douban_url, options.command)
+            crawl_seed(douban_url, seed_kind)
+            print(frontier.summary(seed=douban_url))
+    except FetchError as error:
+        print(error)
+        commit_database()
+        sys.exit(1)
+    commit_database()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+import sqlite3, time, json, csv, os, argparse, sys
+from typing import List, Tuple, Dict, Iterator
+
+try:
+    import pyarrow, pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+class formats(object):
+    parquet = 'parquet'
+    jsonl = 'jsonl'
+    csv = 'csv'
+
+    @classmethod
+    def option_chocies(cls):
+        choice_list = []
+        for name, value in vars(cls).items():
+            if name.replace('_', '-') == value: choice_list.append(value)
+        return choice_list
+
+class partitions(object):
+    none = 'none'
+    subject = 'subject'
+    month = 'month'
+
+    @classmethod
+    def option_chocies(cls):
+        choice_list = []
+        for name, value in vars(cls).items():
+            if name.replace('_', '-') == value: choice_list.append(value)
+        return choice_list
+
+default_partition = '__HIVE_DEFAULT_PARTITION__'
+
+class JsonlSink(object):
+    def __init__(self, file_path:str, columns:List[Tuple[str, str]]):
+        self.names = [x[0] for x in columns]
+        self.fp = open(file_path, 'w', encoding='utf-8')
+
+    def write(self, data_rows:List[Tuple]):
+        for row in data_rows:
+            self.fp.write(json.dumps(dict(zip(self.names, row)), ensure_ascii=False))
+            self.fp.write('\n')
+
+    def close(self):
+        self.fp.close()
+
+class CsvSink(object):
+    def __init__(self, file_path:str, columns:List[Tuple[str, str]]):
+        self.fp = open(file_path, 'w', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.fp)
+        self.writer.writerow([x[0] for x in columns])
+
+    def write(self, data_rows:List[Tuple]):
+        self.writer.writerows(data_rows)
+
+    def close(self):
+        self.fp.close()
+
+class ParquetSink(object):
+    def __init__(self, file_path:str, columns:List[Tuple[str, str]]):
+        fields = []
+        for name, column_type in columns:
+            column_type = column_type.lower()
+            if name == 'date': data_type = pyarrow.timestamp('s', tz='UTC')
+            elif 'int' in column_type: data_type = pyarrow.int64()
+            elif 'double' in column_type or 'real' in column_type or 'float' in column_type: data_type = pyarrow.float64()
+            else: data_type = pyarrow.string()
+            fields.append(pyarrow.field(name, data_type))
+        self.schema = pyarrow.schema(fields)
+        self.writer = pyarrow.parquet.ParquetWriter(file_path, self.schema, compression='zstd')
+
+    def write(self, data_rows:List[Tuple]):
+        # every chunk becomes one row group, so nothing accumulates between chunks
+        arrays = [pyarrow.array([x[n] for x in data_rows], type=field.type) for n, field in enumerate(self.schema)]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+sink_classes = {formats.jsonl: JsonlSink, formats.csv: CsvSink, formats.parquet: ParquetSink}
+
+def get_table_columns(connection:sqlite3.Connection, table:str)->List[Tuple[str, str]]:
+    return [(x[1], x[2]) for x in connection.execute('PRAGMA table_info({})'.format(table)).fetchall()]
+
+def get_partition_query(connection:sqlite3.Connection, table:str, partition:str)->str:
+    # rows come out sorted by partition so only one output file is open at a time
+    names = [x[0] for x in get_table_columns(connection, table)]
+    columns = ','.join(['t.{}'.format(x) for x in names])
+    if partition == partitions.none:
+        return 'SELECT NULL,{} FROM {} t'.format(columns, table)
+    if partition == partitions.month:
+        if 'date' not in names: raise ValueError('{} has no date column to partition by month'.format(table))
+        return 'SELECT strftime(\'%Y-%m\',t.date,\'unixepoch\') AS part,{} FROM {} t ORDER BY part'.format(columns, table)
+    if table == 'review':
+        return 'SELECT t.subject_link AS part,{} FROM review t ORDER BY part'.format(columns)
+    if table == 'comment':
+        return 'SELECT r.subject_link AS part,{} FROM comment t LEFT JOIN review r ON r.id=t.review_aid ORDER BY part'.format(columns)
+    if table == 'poem':
+        return 'SELECT t.uid AS part,{} FROM poem t ORDER BY part'.format(columns) # poems belong to an author, not a subject
+    raise ValueError('{} can not be partitioned by subject'.format(table))
+
+def get_partition_name(partition:str, value)->str:
+    if value is None: return default_partition
+    if partition == partitions.subject and '/' in value: value = value.rstrip('/').split('/')[-1]
+    return str(value).replace('/', '_')
+
+def iterate_chunks(cursor:sqlite3.Cursor, chunk_size:int)->Iterator[List[Tuple]]:
+    while True:
+        data_rows = cursor.fetchmany(chunk_size)
+        if not data_rows: break
+        yield data_rows
+
+def get_peak_memory()->int:
+    # VmHWM belongs to the current address space, ru_maxrss on linux also carries the peak of the parent over exec
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'): return int(line.split()[1])
+    except OSError:
+        pass
+    # ru_maxrss is reported in kilobytes on linux and bytes on macOS
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == 'darwin' else 1)
+
+def export_table(connection:sqlite3.Connection, table:str, output_path:str, format:str, partition:str = partitions.none, chunk_size:int = 10000)->Tuple[int, int]:
+    columns = get_table_columns(connection, table)
+    if not columns: raise ValueError('no table named {}'.format(table))
+    cursor = connection.execute(get_partition_query(connection, table, partition))
+    file_list = [] # type: List[str]
+    row_num, report_time, elapse = 0, time.perf_counter(), time.perf_counter()
+    current, sink = None, None
+    for data_rows in iterate_chunks(cursor, chunk_size):
+        start = 0
+        while start < len(data_rows):
+            # split the chunk where the partition changes
+            value = data_rows[start][0]
+            end = start
+            while end < len(data_rows) and data_rows[end][0] == value: end += 1
+            if sink is None or value != current:
+                if sink: sink.close()
+                if partition == partitions.none:
+                    file_path = os.path.join(output_path, '{}.{}'.format(table, format))
+                else:
+                    directory = os.path.join(output_path, table, '{}={}'.format(partition, get_partition_name(partition, value)))
+                    if not os.path.exists(directory): os.makedirs(directory)
+                    file_path = os.path.join(directory, 'part-0.{}'.format(format))
+                sink = sink_classes[format](file_path, columns)
+                file_list.append(file_path)
+                current = value
+            sink.write([x[1:] for x in data_rows[start:end]])
+            start = end
+        row_num += len(data_rows)
+        if time.perf_counter() - report_time >= 5:
+            report_time = time.perf_counter()
+            print('{} {:,} rows {:,.0f} rows/s'.format(table, row_num, row_num / (report_time - elapse)))
+    if sink: sink.close()
+    elapse = time.perf_counter() - elapse
+    byte_num = sum([os.path.getsize(x) for x in file_list])
+    print('{} {:,} rows into {} files {:,}B in {:.2f}s, {:,.0f} rows/s {:.1f}MB/s, peak rss {:.1f}MB'.format(
+        table, row_num, len(file_list), byte_num, elapse, row_num / max(elapse, 1e-6),
+        byte_num / max(elapse, 1e-6) / 1024 / 1024, get_peak_memory() / 1024))
+    return row_num, byte_num
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser()
+    arguments.add_argument('--database', '-d', default='douban.sqlite')
+    arguments.add_argument('--table', '-t', nargs='+', default=['comment', 'discuss', 'review', 'user'], help='poem lives in b.sqlite')
+    arguments.add_argument('--format', '-f', default=formats.jsonl, choices=formats.option_chocies())
+    arguments.add_argument('--partition', '-p', default=partitions.none, choices=partitions.option_chocies())
+    arguments.add_argument('--output', '-o', default='export')
+    arguments.add_argument('--chunk-size', '-n', type=int, default=10000)
+    options = arguments.parse_args(sys.argv[1:])
+    if options.format == formats.parquet and not pyarrow: arguments.error('parquet export needs pyarrow')
+    if not os.path.exists(options.output): os.makedirs(options.output)
+    connection = sqlite3.connect(options.database)
+    for table in options.table:
+        try:
+            export_table(connection, table, options.output, options.format, options.partition, options.chunk_size)
+        except ValueError as error:
+            print(error)
+    connection.close()
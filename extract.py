@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import lxml.html
+from lxml import etree
+from cssselect import HTMLTranslator
+from pyquery.text import extract_text
+from typing import List, Tuple, Callable, Iterator
+
+translator = HTMLTranslator()
+
+def compile_selector(selector:str)->etree.XPath:
+    # same translation PyQuery.find() does, but only once per selector instead of once per call
+    return etree.XPath(translator.css_to_xpath(selector, prefix='descendant::'))
+
+def parse_html(html_content:str)->lxml.html.HtmlElement:
+    return lxml.html.fromstring(html_content)
+
+def get_text(elements:List[etree._Element])->str:
+    # matches PyQuery.text(): squashed text of every match joined by a space
+    return ' '.join([extract_text(x) for x in elements])
+
+def drop_elements(elements:List[lxml.html.HtmlElement]):
+    for element in elements: element.drop_tree()
+
+class Field(object):
+    def __init__(self, selector:str = None, convert:Callable = None):
+        self.selector = selector
+        self.xpath = compile_selector(selector) if selector else None
+        self.convert = convert
+
+    def select(self, element:etree._Element)->List[etree._Element]:
+        return self.xpath(element) if self.xpath is not None else [element]
+
+    def value(self, elements:List[etree._Element]):
+        return elements
+
+    def extract(self, element:etree._Element):
+        value = self.value(self.select(element))
+        return self.convert(value) if self.convert else value
+
+class Text(Field):
+    def value(self, elements:List[etree._Element]):
+        return get_text(elements)
+
+class Attr(Field):
+    def __init__(self, name:str, selector:str = None, convert:Callable = None):
+        super(Attr, self).__init__(selector=selector, convert=convert)
+        self.name = name
+
+    def value(self, elements:List[etree._Element]):
+        return elements[0].get(self.name) if elements else None
+
+class Content(Field):
+    def __init__(self, selector:str, index:int, convert:Callable = None):
+        super(Content, self).__init__(selector=selector, convert=convert)
+        self.index = index
+
+    def value(self, elements:List[etree._Element]):
+        # text nodes count as children here, like PyQuery.contents()
+        nodes = []
+        for element in elements:
+            nodes.extend(element.xpath('child::text()|child::*'))
+        return nodes[self.index]
+
+class Exists(Field):
+    def value(self, elements:List[etree._Element]):
+        return len(elements) > 0
+
+class FieldMap(object):
+    def __init__(self, item:str, fields:List[Tuple[str, Field]]):
+        self.item = compile_selector(item) if item else None
+        self.names = [x[0] for x in fields]
+        self.fields = [x[1] for x in fields]
+
+    def extract(self, element:etree._Element)->Tuple:
+        return tuple([x.extract(element) for x in self.fields])
+
+    def rows(self, root:etree._Element)->Iterator[Tuple]:
+        for element in (self.item(root) if self.item is not None else [root]):
+            yield self.extract(element)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import sqlite3, time
+from typing import List, Tuple, Dict, Callable
+from writer import SqliteWriter
+
+class states(object):
+    pending = 'pending'
+    in_flight = 'in-flight'
+    done = 'done'
+    failed = 'failed'
+
+class CrawlFrontier(object):
+    def __init__(self, connection:sqlite3.Connection, name:str = 'frontier', writer:SqliteWriter = None):
+        self.__connection = connection
+        self.__cursor = connection.cursor()
+        self.__table_name = name
+        self.__writer = writer
+        self.__claimed = set()
+        self.__started = int(time.time())
+        result = self.__cursor.execute('SELECT name FROM sqlite_master WHERE type=\'table\' AND name=?', (name,))
+        if not result.fetchall():
+            self.__cursor.execute('''
+            CREATE TABLE {}
+                (link text NOT NULL UNIQUE ON CONFLICT IGNORE,
+                 kind text NOT NULL,
+                 seed text NOT NULL,
+                 state text NOT NULL,
+                 error text,
+                 updated integer NOT NULL,
+                 priority integer NOT NULL DEFAULT 0)
+            '''.format(name))
+            self.__cursor.execute('CREATE INDEX {0}_state ON {0} (state)'.format(name))
+            self.__cursor.execute('CREATE INDEX {0}_seed ON {0} (seed)'.format(name))
+        columns = [x[1] for x in self.__cursor.execute('PRAGMA table_info({})'.format(name)).fetchall()]
+        if 'priority' not in columns:
+            self.__cursor.execute('ALTER TABLE {} ADD COLUMN priority integer NOT NULL DEFAULT 0'.format(name))
+        # pending links are popped by priority, then in the order they were found
+        self.__cursor.execute('CREATE INDEX IF NOT EXISTS {0}_priority ON {0} (state, priority DESC)'.format(name))
+        # pages that were in flight when the last run died have to be crawled again
+        self.__update_state(states.in_flight, states.pending)
+        self.__commit(flush=True)
+
+    def __execute(self, command:str, params_list:List[Tuple]):
+        # with a writer every state change is queued behind the rows of the page it belongs to
+        if self.__writer:
+            self.__writer.execute_many(command, params_list)
+        else:
+            self.__cursor.executemany(command, params_list)
+
+    def __commit(self, flush:bool = False):
+        if not self.__writer:
+            self.__connection.commit()
+        elif flush:
+            self.__writer.flush()
+
+    def __update_state(self, state:str, new_state:str, seed:str = None):
+        command = 'UPDATE {} SET state=?,updated=? WHERE state=?'.format(self.__table_name)
+        params = (new_state, int(time.time()), state)
+        if seed:
+            command += ' AND seed=?'
+            params += (seed,)
+        self.__execute(command, [params])
+
+    def push(self, link:str, kind:str, seed:str = None, revisit:bool = False, priority:int = 0):
+        self.push_many(links=[(link, kind)], seed=seed if seed else link, revisit=revisit, priority=priority)
+
+    def push_many(self, links:List[Tuple[str, str]], seed:str, revisit:bool = False, priority:int = 0):
+        if not links: return
+        now = int(time.time())
+        self.__execute('INSERT INTO {} (link,kind,seed,state,updated,priority) VALUES (?,?,?,?,?,?)'.format(self.__table_name),
+                       [(link, kind, seed, states.pending, now, priority) for link, kind in links])
+        if revisit:
+            # only links finished by an earlier run are crawled again, this run's pages are never requeued
+            self.__execute('UPDATE {} SET state=?,error=NULL,updated=?,priority=? WHERE link=? AND state!=? AND updated<?'.format(self.__table_name),
+                           [(states.pending, now, priority, link, states.in_flight, self.__started) for link, _ in links])
+
+    def __select_pending(self, num:int, skip_seeds:set)->List[Tuple[str, str, str, int]]:
+        # links of exhausted seeds stay pending for the next run, sqlite steps over them
+        command = 'SELECT link,kind,seed,priority FROM {} WHERE state=?{} ORDER BY priority DESC,rowid'.format(
+            self.__table_name, ' AND seed NOT IN ({})'.format(','.join(['?'] * len(skip_seeds))) if skip_seeds else '')
+        records = []
+        for record in self.__cursor.execute(command, (states.pending,) + tuple(skip_seeds)):
+            # links claimed in this run may still be pending on disk while their writes are queued
+            if record[0] in self.__claimed: continue
+            records.append(record)
+            if len(records) >= num: break
+        return records
+
+    def pop(self, num:int = 1, skip_seeds:set = frozenset())->List[Tuple[str, str, str, int]]:
+        records = self.__select_pending(num, skip_seeds)
+        if not records and self.__writer:
+            self.__writer.flush()
+            records = self.__select_pending(num, skip_seeds)
+        self.__claimed.update([x[0] for x in records])
+        self.__mark([x[0] for x in records], states.in_flight)
+        self.__commit()
+        return records
+
+    def __mark(self, links:List[str], state:str, error:str = None):
+        now = int(time.time())
+        self.__execute('UPDATE {} SET state=?,error=?,updated=? WHERE link=?'.format(self.__table_name),
+                       [(state, error, now, link) for link in links])
+
+    def complete(self, link:str):
+        self.__mark([link], states.done)
+
+    def fail(self, link:str, error:str):
+        self.__mark([link], states.failed, error=error)
+
+    def release(self, links:List[str]):
+        self.__claimed.difference_update(links)
+        self.__mark(links, states.pending)
+
+    def retry_failed(self, seed:str = None):
+        self.__update_state(states.failed, states.pending, seed=seed)
+        self.__commit(flush=True)
+
+    def restart(self, seed:str):
+        self.__execute('DELETE FROM {} WHERE seed=?'.format(self.__table_name), [(seed,)])
+        self.__commit(flush=True)
+
+    def summary(self, seed:str = None)->Dict[str, int]:
+        self.__commit(flush=True)
+        command = 'SELECT state,count(*) FROM {} {} GROUP BY state'.format(self.__table_name, 'WHERE seed=?' if seed else '')
+        return dict(self.__cursor.execute(command, (seed,) if seed else ()).fetchall())
+
+    def drain(self, handlers:Dict[str, Callable[[str], List[Tuple[str, str]]]], prefetch:Callable[[List[str]], None] = None, batch_size:int = 8, fatal_errors:Tuple = (), progress:Callable[[], None] = None, revisit:bool = False,
+              budget:int = 0, seed_budget:int = 0)->Dict[str, int]:
+        # each handler crawls one page and returns the (link, kind) pairs it discovered,
+        # its rows, the discovered links and the done mark are committed together.
+        # budget caps the pages of this run, seed_budget the pages of each seed, 0 is unlimited,
+        # links left over stay pending for the next run
+        page_map = {} # type: Dict[str, int]
+        exhausted = set()
+        while True:
+            remain = budget - sum(page_map.values()) if budget else batch_size
+            if remain <= 0: break
+            records = self.pop(num=min(batch_size, remain), skip_seeds=exhausted)
+            if not records: break
+            if seed_budget:
+                # a batch must not prefetch pages beyond what is left of each seed's budget
+                quota_map, overflow = dict(page_map), []
+                for record in records:
+                    quota_map[record[2]] = quota_map.get(record[2], 0) + 1
+                    if quota_map[record[2]] > seed_budget: overflow.append(record[0])
+                if overflow:
+                    self.release(overflow)
+                    records = [x for x in records if x[0] not in overflow]
+            if prefetch:
+                try:
+                    prefetch([x[0] for x in records])
+                except fatal_errors:
+                    self.release([x[0] for x in records])
+                    self.__commit(flush=True)
+                    raise
+                self.__commit()
+            for n in range(len(records)):
+                link, kind, seed, priority = records[n]
+                page_map[seed] = page_map.get(seed, 0) + 1
+                if seed_budget and page_map[seed] >= seed_budget: exhausted.add(seed)
+                try:
+                    links = handlers[kind](link)
+                except fatal_errors:
+                    if not self.__writer: self.__connection.rollback()
+                    self.release([x[0] for x in records[n:]])
+                    self.__commit(flush=True)
+                    raise
+                except Exception as error:
+                    if not self.__writer: self.__connection.rollback()
+                    print('[failed] {} {!r}'.format(link, error))
+                    self.fail(link, error=repr(error))
+                else:
+                    self.push_many(links, seed=seed, revisit=revisit, priority=priority)
+                    self.complete(link)
+                self.__commit()
+                if progress: progress()
+        return page_map
@@ -1,14 +1,35 @@
 #!/usr/bin/env python3
-import argparse, sys, os, io, typing, time, pyquery, requests, math, random
+import argparse, sys, os, io, typing, time, pyquery, math, random, collections, re, mmap, codecs, multiprocessing, heapq, sqlite3, itertools, hashlib, json, struct, pickle, tempfile
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from typing import Tuple, List, Dict
 from functools import cmp_to_key
 import svg
+from spider import http_session
 exclude_signs = '。，；：…（）《》？！、“”—[]【】°'
 exclude_chars = '的了'
 
 class commands(object):
     dump_hotword = 'dump-hotword'
     dump_graph = 'dump-graph'
+    compare_engines = 'compare-engines'
+    build_index = 'build-index'
+
+    @classmethod
+    def option_choices(cls):
+        choice_list= []
+        for name, value in vars(cls).items():
+            if name.replace('_', '-') == value: choice_list.append(value)
+        return choice_list
+
+class engines(object):
+    tree = 'tree'
+    suffix_array = 'suffix-array'
+    numpy = 'numpy'
 
     @classmethod
     def option_choices(cls):
@@ -20,7 +41,21 @@ class commands(object):
 class ArgumentOptions(object):
     def __init__(self, data):
         self.command = data.command # type: str
+        self.engine = data.engine # type: str
+        self.chunk_size = data.chunk_size # type: int
+        self.jobs = data.jobs # type: int
+        self.approximate = data.approximate # type: bool
+        self.capacity = data.capacity # type: int
         self.text_path = data.text_path # type: str
+        self.database = data.database # type: str
+        self.table = data.table # type: str
+        self.subject = data.subject # type: List[str]
+        self.review = data.review # type: List[str]
+        self.author = data.author # type: List[str]
+        self.since = data.since # type: str
+        self.until = data.until # type: str
+        self.per_subject = data.per_subject # type: bool
+        self.index_path = data.index_path # type: str
         self.webpage = data.webpage # type:bool
         self.max_num = data.max_num # type: int
         self.depth = data.depth # type: int
@@ -83,15 +118,78 @@ class TreeNode(object):
                 result.extend(point_list)
         return result
 
+class CountMinSketch(object):
+    multipliers = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0x27D4EB2F165667C5, 0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53)
+
+    def __init__(self, width:int, depth:int = 4):
+        self.width = width
+        self.depth = min(depth, len(self.multipliers))
+        self.rows = [array('q', [0]) * width for _ in range(self.depth)]
+        self.total = 0
+
+    def __indexes(self, item:str)->List[int]:
+        # one hash per item, rows differ by the multiplier mixing it
+        code = hash(item) & 0xFFFFFFFFFFFFFFFF
+        return [((code * x) & 0xFFFFFFFFFFFFFFFF) >> 20 for x in self.multipliers[:self.depth]]
+
+    def add(self, item:str, num:int = 1)->int:
+        estimate = None
+        for row, index in zip(self.rows, self.__indexes(item)):
+            index %= self.width
+            row[index] += num
+            if estimate is None or row[index] < estimate: estimate = row[index]
+        self.total += num
+        return estimate
+
+    def estimate(self, item:str)->int:
+        return min([row[index % self.width] for row, index in zip(self.rows, self.__indexes(item))])
+
+    def error(self)->int:
+        # an estimate exceeds the true count by at most e/width of all adds, with probability 1 - e^-depth
+        return int(math.ceil(math.e * self.total / self.width))
+
+class SpaceSaving(object):
+    def __init__(self, capacity:int):
+        self.capacity = capacity
+        self.counters = {} # type: Dict[str, List[int]]
+        self.__heap = [] # type: List[Tuple[int, str]]
+
+    def minimum(self)->int:
+        if len(self.counters) < self.capacity: return 0
+        # the heap keeps every count an item had, only entries matching the current count are live
+        while True:
+            count, item = self.__heap[0]
+            counter = self.counters.get(item)
+            if counter and counter[0] == count: return count
+            heapq.heappop(self.__heap)
+
+    def add(self, item:str, num:int = 1, estimate:int = None):
+        # estimate, an upper bound of the item's count, replaces the inherited minimum of a newcomer
+        counter = self.counters.get(item)
+        if counter:
+            counter[0] += num
+        elif len(self.counters) < self.capacity:
+            counter = self.counters[item] = [num, 0] if estimate is None else [estimate, estimate - num]
+        else:
+            # the least counted item makes room, its count is the error of the newcomer
+            minimum = self.minimum()
+            del self.counters[heapq.heappop(self.__heap)[1]]
+            count = minimum + num if estimate is None else min(minimum + num, estimate)
+            counter = self.counters[item] = [count, count - num]
+        heapq.heappush(self.__heap, (counter[0], item))
+        if len(self.__heap) > self.capacity * 4:
+            self.__heap = [(x[0], k) for k, x in self.counters.items()]
+            heapq.heapify(self.__heap)
+
 class elapse_dubugger(object):
     def __init__(self):
-        self.__time = time.clock()
+        self.__time = time.perf_counter()
         self.enabled = True
 
     def log(self, name:str):
         if not self.enabled: return
-        print('{:7.3f}ms {}'.format(1000*(time.clock() - self.__time), name))
-        self.__time = time.clock()
+        print('{:7.3f}ms {}'.format(1000*(time.perf_counter() - self.__time), name))
+        self.__time = time.perf_counter()
 
 def char_scope_sort(a:str, b:str):
     for n in range(len(a)):
@@ -121,6 +219,9 @@ def create_hotword_network(buffer:io.StringIO):
     # data_list.sort(key=cmp_to_key(char_scope_sort))
     # print('\n'.join(data_list))
     create_search_tree(char_map.get(root.data)[1], root)
+    draw_hotword_network(root)
+
+def draw_hotword_network(root:TreeNode):
     # root.dump()
     root.walk_tree_graph(position=(0, 0), rotation=0)
     graphics = svg.SvgGraphics()
@@ -153,7 +254,10 @@ def create_hotword_network(buffer:io.StringIO):
         fp.write(repr(graphics))
         fp.close()
 
-def caculate_hotwords(buffer:io.StringIO):
+def is_word_char(char:str)->bool:
+    return ord(char) > 0x7F and char not in exclude_signs
+
+def search_hotwords_tree(buffer:io.StringIO)->List[Tuple[str, int]]:
     char_map = {}
     while True:
         char = buffer.read(1) # type:str
@@ -192,44 +296,576 @@ def caculate_hotwords(buffer:io.StringIO):
         if num == 1: continue
         word_list.append((word, num))
     debug.log('strip-none')
+    return word_list
+
+def create_suffix_array(text:str, depth:int)->array:
+    # prefix doubling, only the first depth chars of each suffix decide its place.
+    # each suffix is sorted as one int, (rank of the first span chars, rank of the next span chars, position)
+    length = len(text)
+    rank = array('q', map(ord, text))
+    shift = max(1, length.bit_length())
+    span, rank_num = 1, 0x10FFFF
+    while True:
+        order = [((rank[x] * (rank_num + 2) + (rank[x + span] + 1 if x + span < length else 0)) << shift) | x for x in range(length)]
+        order.sort()
+        rank_num, previous = -1, None
+        for value in order:
+            if value >> shift != previous:
+                rank_num += 1
+                previous = value >> shift
+            rank[value & ((1 << shift) - 1)] = rank_num
+        if span * 2 >= depth or rank_num == length - 1: break
+        span *= 2
+        del order
+    return array('q', [x & ((1 << shift) - 1) for x in order])
+
+def search_hotwords_suffix_array(buffer:io.StringIO)->List[Tuple[str, int]]:
+    # every word the tree engine reports is a repeated substring of word chars, its count is the
+    # number of occurrences that end there, which are the leaf children of its lcp interval
+    text = buffer.getvalue()
+    length, depth = len(text), HOTWORD_SEARCH_DEPTH + 1
+    # word chars ahead of each position, a match never runs past them
+    run_list = array('i', [0]) * (length + 1)
+    for n in range(length - 1, -1, -1):
+        if is_word_char(text[n]): run_list[n] = run_list[n + 1] + 1
+    char_map = dict([(x, n) for x, n in collections.Counter(text).items() if is_word_char(x)])
+    debug.log('char')
+    suffix_array = array('q', [x for x in create_suffix_array(text, depth) if run_list[x] >= 2])
+    debug.log('suffix-array')
+    lcp_list = array('i', [0]) * (len(suffix_array) + 1) # trailing 0 closes every open interval
+    for n in range(1, len(suffix_array)):
+        a, b = suffix_array[n - 1], suffix_array[n]
+        limit, common = min(run_list[a], run_list[b], depth), 0
+        while common < limit and text[a + common] == text[b + common]: common += 1
+        lcp_list[n] = common
+    debug.log('lcp')
+    word_list = []
+    stack = [[0, 0, 0]] # lcp, left bound, suffixes inside child intervals
+    for n in range(1, len(lcp_list)):
+        left, child_num = n - 1, 0
+        while lcp_list[n] < stack[-1][0]:
+            lcp, left, inner_num = stack.pop()
+            size = n - left
+            word = text[suffix_array[left]:suffix_array[left] + lcp]
+            if lcp >= 2 and size - inner_num >= 2 and char_map[word[0]] > 2 and word[0] not in exclude_chars:
+                word_list.append((word, size - inner_num))
+            if lcp_list[n] <= stack[-1][0]: stack[-1][2] += size
+            else: child_num = size
+        if lcp_list[n] > stack[-1][0]: stack.append([lcp_list[n], left, child_num])
+    debug.log('search-hotword')
+    return word_list
+
+def search_hotwords_numpy(buffer:io.StringIO)->List[Tuple[str, int]]:
+    # same counts as the suffix array engine: occurrences of a repeated n-gram minus those that
+    # continue into a repeated (n+1)-gram. n-grams get exact ids level by level, (id of the
+    # (n-1)-gram, next char) packed into one int64 and numbered by numpy.unique
+    text = buffer.getvalue()
+    depth = HOTWORD_SEARCH_DEPTH + 1
+    codes = numpy.frombuffer(text.encode('utf-32-le'), dtype=numpy.uint32).astype(numpy.int64)
+    length = len(codes)
+    word_mask = (codes > 0x7F) & ~numpy.isin(codes, [ord(x) for x in exclude_signs])
+    index_list = numpy.arange(length)
+    # word chars ahead of each position
+    run_list = numpy.minimum.accumulate(numpy.where(word_mask, length, index_list)[::-1])[::-1] - index_list
+    char_count = numpy.bincount(codes[word_mask], minlength=0x110000)
+    starter_mask = char_count > 2
+    starter_mask[[ord(x) for x in exclude_chars]] = False
+    debug.log('char')
+    positions = numpy.flatnonzero(run_list >= 2)
+    ids = codes[positions]
+    word_list = []
+    previous = None # (size, counts, first positions) of the last level, waiting for their child counts
+    for size in range(2, depth + 1):
+        if not len(positions): break
+        _, first, inverse, counts = numpy.unique((ids << 21) | codes[positions + size - 1], return_index=True, return_inverse=True, return_counts=True)
+        inverse = inverse.reshape(-1)
+        if previous:
+            # occurrences continuing into a repeated longer n-gram are counted there, not at the parent
+            _, parent_counts, parent_first = previous
+            repeated = counts >= 2
+            child_sum = numpy.bincount(ids[first[repeated]], weights=counts[repeated], minlength=len(parent_counts)).astype(numpy.int64)
+            word_list.extend(collect_ngrams(text, size - 1, parent_counts - child_sum, parent_first, parent_counts, codes, starter_mask))
+        previous = size, counts, positions[first]
+        keep = (counts[inverse] >= 2) & (run_list[positions] > size)
+        positions, ids = positions[keep], inverse[keep]
+        debug.log('ngram-{}'.format(size))
+    if previous: word_list.extend(collect_ngrams(text, previous[0], previous[1], previous[2], previous[1], codes, starter_mask))
+    debug.log('search-hotword')
+    return word_list
+
+def collect_ngrams(text:str, size:int, nums, first_positions, counts, codes, starter_mask)->List[Tuple[str, int]]:
+    selected = numpy.flatnonzero((counts >= 2) & (nums >= 2) & starter_mask[codes[first_positions]])
+    return [(text[x:x + size], n) for x, n in zip(first_positions[selected].tolist(), nums[selected].tolist())]
+
+hotword_engines = {
+    engines.tree: search_hotwords_tree,
+    engines.suffix_array: search_hotwords_suffix_array,
+    engines.numpy: search_hotwords_numpy
+}
+
+def split_text_file(file_path:str, chunk_size:int)->List[Tuple[int, int]]:
+    # byte ranges of about chunk_size, each starting at the first byte of an utf-8 char
+    chunk_list = []
+    with open(file_path, 'rb') as fp:
+        if not os.fstat(fp.fileno()).st_size: return chunk_list
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = 0
+            while start < len(data):
+                end = min(len(data), start + chunk_size)
+                while end < len(data) and data[end] & 0xC0 == 0x80: end += 1
+                chunk_list.append((start, end))
+                start = end
+    return chunk_list
+
+def init_chunk_worker(file_path:str, size:int, prefixes:set, spill_dir:str, partitions:int):
+    # the pool of a gram size hands its workers the surviving prefixes once, not with every chunk
+    global chunk_task
+    chunk_task = (file_path, size, prefixes, spill_dir, partitions)
+
+def count_chunk_ngrams(chunk:Tuple[int, int])->Tuple[int, List[int]]:
+    # size-grams of word chars starting inside [start, end), the chunk is read with size - 1 chars of
+    # the next one so grams crossing the boundary are complete. only grams whose (size-1)-gram prefix
+    # and suffix are both repeated are counted, any other gram occurs once in the whole text.
+    # the counts are spilled split by their last char, a merge then loads one share of every chunk
+    file_path, size, prefixes, spill_dir, partitions = chunk_task
+    start, end = chunk
+    with open(file_path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        text = data[start:end].decode('utf-8')
+        boundary = len(text)
+        text += codecs.getincrementaldecoder('utf-8')().decode(data[end:end + (size - 1) * 4])[:size - 1]
+    buckets = [{} for _ in range(partitions)]
+    for gram, num in count_text_ngrams(text, boundary, size, prefixes, suffixes=True).items():
+        buckets[ord(gram[-1]) % partitions][gram] = num
+    offsets = []
+    with open(os.path.join(spill_dir, str(start)), 'wb') as fp:
+        for bucket in buckets:
+            offsets.append(fp.tell())
+            pickle.dump(bucket, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    return start, offsets
+
+def merge_chunk_ngrams(task:Tuple[int, List[Tuple[int, int]]])->Dict[str, int]:
+    # one share of the grams summed over all chunks, only the repeated ones go back
+    spill_dir = chunk_task[3]
+    _, spills = task
+    counter = collections.Counter()
+    for start, offset in spills:
+        with open(os.path.join(spill_dir, str(start)), 'rb') as fp:
+            fp.seek(offset)
+            counter.update(pickle.load(fp))
+    return dict([(x, n) for x, n in counter.items() if n >= 2])
+
+def count_text_ngrams(text:str, boundary:int, size:int, prefixes:set, suffixes:bool = False)->collections.Counter:
+    counter = collections.Counter()
+    pattern = re.compile('[^\\x00-\\x7f{}]{{{},}}'.format(re.escape(exclude_signs), size))
+    for match in pattern.finditer(text):
+        if match.start() >= boundary: break
+        if size == 1:
+            counter.update(text[match.start():min(match.end(), boundary)])
+            continue
+        begin, stop = match.start(), min(match.end() - size + 1, boundary)
+        # each (size-1)-gram is looked up once, it is the prefix of one gram and the suffix of the one before
+        known = [text[n:n + size - 1] in prefixes for n in range(begin, stop + 1)]
+        if suffixes: counter.update([text[n:n + size] for n in range(begin, stop) if known[n - begin] and known[n - begin + 1]])
+        else: counter.update([text[n:n + size] for n in range(begin, stop) if known[n - begin]])
+    return counter
+
+def search_hotwords_chunked(file_path:str, chunk_size:int, jobs:int)->List[Tuple[str, int]]:
+    # map-reduce by gram size: workers count the grams of their chunk, the merged counts decide
+    # which grams are extended at the next size. a gram's word count is its occurrences minus
+    # those continuing into a repeated longer gram, as in the other engines
+    depth = HOTWORD_SEARCH_DEPTH + 1
+    chunk_list = split_text_file(file_path, chunk_size)
+    word_list = []
+    # a share of the grams of every chunk fits in about the memory of a chunk's own counts
+    partitions = max(1, len(chunk_list))
+    def count_repeated(size:int, prefixes:set)->Dict[str, int]:
+        repeated = {}
+        with tempfile.TemporaryDirectory() as spill_dir, \
+             multiprocessing.Pool(processes=jobs, initializer=init_chunk_worker, initargs=(file_path, size, prefixes, spill_dir, partitions)) as pool:
+            spill_list = pool.map(count_chunk_ngrams, chunk_list)
+            tasks = [(n, [(start, offsets[n]) for start, offsets in spill_list]) for n in range(partitions)]
+            for partial in pool.imap_unordered(merge_chunk_ngrams, tasks): repeated.update(partial)
+        return repeated
+    char_map = collections.Counter(count_repeated(1, None))
+    debug.log('char')
+    previous = dict(char_map)
+    for size in range(2, depth + 1):
+        repeated = count_repeated(size, set(previous.keys()))
+        if size > 2:
+            for word, num in repeated.items(): previous[word[:-1]] -= num
+            word_list.extend([(x, n) for x, n in previous.items() if n >= 2])
+        previous = repeated
+        debug.log('ngram-{} {} repeated'.format(size, len(repeated)))
+        if not previous: break
+    word_list.extend([(x, n) for x, n in previous.items() if n >= 2 and len(x) >= 2])
+    return [(x, n) for x, n in word_list if char_map[x[0]] > 2 and x[0] not in exclude_chars]
+
+def search_hotwords_approximate(buffer:io.TextIOBase, capacity:int, block_size:int = 1 << 16)->Tuple[List[Tuple[str, int]], Dict[str, int]]:
+    # one pass in fixed memory. a word's count is the number of its occurrences that end there:
+    # the run of word chars stops, or the next char makes a gram seen only once. grams of each block
+    # are counted exactly, then go through a count-min sketch, whose estimates tell first and second
+    # sightings of a gram apart, and the space-saving counters keep the heaviest of them
+    depth = HOTWORD_SEARCH_DEPTH + 1
+    sketch = CountMinSketch(width=capacity * 64)
+    heavy_hitters = SpaceSaving(capacity)
+    num_map = {} # type: Dict[str, int]
+    doubt_map = {} # type: Dict[str, int]
+    char_map = collections.Counter()
+    pattern = re.compile('[^\\x00-\\x7f{}]+'.format(re.escape(exclude_signs)))
+    tail_pattern = re.compile('[^\\x00-\\x7f{}]+$'.format(re.escape(exclude_signs)))
+    carry = ''
+    while True:
+        block = buffer.read(block_size)
+        text = carry + block
+        # a run of word chars touching the end of the block waits for the next one
+        limit = len(text)
+        if block:
+            match = tail_pattern.search(text)
+            if match: limit = match.start()
+        counters = [collections.Counter() for _ in range(depth + 1)]
+        stop_map = collections.Counter()
+        for match in pattern.finditer(text, 0, limit):
+            start, end = match.span()
+            char_map.update(match.group())
+            for size in range(2, min(depth, end - start) + 1):
+                counters[size].update([text[n:n + size] for n in range(start, end - size + 1)])
+                stop_map[text[end - size:end]] += 1
+        carry = text[limit:]
+        if len(carry) > block_size: carry = carry[-depth:] # a single run longer than a block loses its head
+        sketch_error = sketch.error()
+        for size in range(2, depth + 1):
+            for gram, num in counters[size].items():
+                estimate = sketch.add(gram, num)
+                sightings = estimate - num
+                # grams the sketch puts below every tracked one would be evicted again right away
+                if gram in heavy_hitters.counters or estimate > heavy_hitters.minimum():
+                    heavy_hitters.add(gram, num, estimate=estimate)
+                ending = stop_map.get(gram, 0) if size < depth else num
+                if ending: num_map[gram] = num_map.get(gram, 0) + ending
+                if size == 2: continue
+                # sightings made up by sketch collisions can hide a first or second one, the parent's
+                # count is off by up to 2 for every such doubtful call
+                if sightings and sightings - sketch_error <= 1: doubt_map[gram[:-1]] = doubt_map.get(gram[:-1], 0) + 1
+                # the parent ends here while this gram is single, the second sighting takes it back
+                if sightings == 0 and num == 1: delta = 1
+                elif sightings == 1: delta = -1
+                else: continue
+                num_map[gram[:-1]] = num_map.get(gram[:-1], 0) + delta
+        # only counts of tracked grams are kept
+        for gram in [x for x in num_map if x not in heavy_hitters.counters]: del num_map[gram]
+        for gram in [x for x in doubt_map if x not in heavy_hitters.counters]: del doubt_map[gram]
+        if not block: break
+    debug.log('stream')
+    word_list, error_map = [], {}
+    for gram, (count, error) in heavy_hitters.counters.items():
+        num = num_map.get(gram, 0)
+        if num < 2 or char_map.get(gram[0], 0) <= 2 or gram[0] in exclude_chars: continue
+        # occurrences before the gram was tracked are missing, each one moves its count by at most 1
+        word_list.append((gram, num))
+        error_map[gram] = error + 2 * doubt_map.get(gram, 0)
+    debug.log('search-hotword')
+    return word_list, error_map
+
+# table -> (text, subject, review, author, date, group of --per-subject), None where rows carry no such field.
+# discuss rows only know their topic, it stands in for the review. poems live in b.sqlite
+corpus_tables = {
+    'comment': ('t.text', 'r.subject_link', 't.review_aid', 't.author_uid', 't.date', 'r.subject_link'),
+    'discuss': ('t.text', None, 't.discuss_cid', 't.author_uid', 't.date', 't.discuss_cid'),
+    'poem': ('t.poem', None, None, 't.uid', None, 't.uid')
+}
+
+def get_corpus_query(table:str, subjects:List[str] = None, reviews:List[str] = None, authors:List[str] = None,
+                     since:int = None, until:int = None, grouped:bool = False)->Tuple[str, List]:
+    text_column, subject_column, review_column, author_column, date_column, group_column = corpus_tables[table]
+    conditions, params = [], []
+    def add_condition(name:str, column:str, values:List, condition:str):
+        if not values: return
+        if not column: raise ValueError('{} rows can not be filtered by {}'.format(table, name))
+        conditions.append('(' + ' OR '.join([condition.format(column)] * len(values)) + ')')
+        params.extend(values)
+    # a subject is matched by the id in its link, a full link works as well
+    add_condition('subject', subject_column, ['%/{}/'.format(x.rstrip('/').split('/')[-1]) for x in subjects or []], '{} LIKE ?')
+    add_condition('review', review_column, reviews, '{}=?')
+    add_condition('author', author_column, authors, '{}=?')
+    add_condition('date', date_column, [since] if since is not None else None, '{}>=?')
+    add_condition('date', date_column, [until] if until is not None else None, '{}<?')
+    command = 'SELECT {},{} FROM {} t'.format(group_column if grouped else 'NULL', text_column, table)
+    if table == 'comment' and (subjects or grouped): command += ' LEFT JOIN review r ON r.id=t.review_aid'
+    if conditions: command += ' WHERE ' + ' AND '.join(conditions)
+    if grouped: command += ' ORDER BY 1'
+    return command, params
+
+def decode_day(value:str)->int:
+    return int(time.mktime(time.strptime(value, '%Y-%m-%d'))) if value else None
+
+class CorpusReader(io.TextIOBase):
+    # text column of the query rows as a stream, every row ends with a newline so no gram spans two rows
+    def __init__(self, cursor:sqlite3.Cursor, chunk_size:int = 1000):
+        self.cursor = cursor
+        self.chunk_size = chunk_size # type: int
+        self.__pending = ''
+
+    def readable(self):
+        return True
+
+    def read(self, size:int = -1)->str:
+        while size is None or size < 0 or len(self.__pending) < size:
+            data_rows = self.cursor.fetchmany(self.chunk_size)
+            if not data_rows: break
+            self.__pending += ''.join([x[1] + '\n' for x in data_rows if x[1]])
+        if size is None or size < 0: size = len(self.__pending)
+        text, self.__pending = self.__pending[:size], self.__pending[size:]
+        return text
+
+def open_corpus(connection:sqlite3.Connection, grouped:bool = False)->sqlite3.Cursor:
+    command, params = get_corpus_query(options.table, subjects=options.subject, reviews=options.review, authors=options.author,
+                                       since=decode_day(options.since), until=decode_day(options.until), grouped=grouped)
+    return connection.execute(command, params)
+
+def init_group_worker(depth:int):
+    global HOTWORD_SEARCH_DEPTH, debug
+    HOTWORD_SEARCH_DEPTH = depth
+    debug = elapse_dubugger()
+    debug.enabled = False # workers would interleave their timings
+
+def search_group_hotwords(text:str, engine:str, approximate:bool, capacity:int, limit:int)->List[Tuple]:
+    if approximate:
+        word_list, error_map = search_hotwords_approximate(io.StringIO(text), capacity)
+    else:
+        word_list, error_map = hotword_engines[engine](io.StringIO(text)), None
+    word_list = rank_hotwords(word_list, limit)
+    return [(x, n, error_map[x]) if error_map else (x, n, None) for x, n in word_list]
+
+def caculate_subject_hotwords(cursor:sqlite3.Cursor):
+    # one scan ordered by subject, the text of every subject is counted in the pool while the scan goes on
+    with multiprocessing.Pool(processes=options.jobs, initializer=init_group_worker, initargs=(HOTWORD_SEARCH_DEPTH,)) as pool:
+        pending = collections.deque()
+        def print_group(group:str, row_num:int, result):
+            print('=== {} {} rows'.format(group, row_num))
+            for word, num, error in reversed(result.get()):
+                if error is None: print(word, num)
+                else: print(word, num, '±{}'.format(error))
+        for group, data_rows in itertools.groupby(cursor, key=lambda x: x[0]):
+            text_list = [x[1] + '\n' for x in data_rows if x[1]]
+            result = pool.apply_async(search_group_hotwords, (''.join(text_list), options.engine, options.approximate, options.capacity, MAX_RESULT_NUM))
+            pending.append((group, len(text_list), result))
+            while len(pending) > options.jobs * 2: print_group(*pending.popleft())
+        while pending: print_group(*pending.popleft())
+    debug.log('subjects')
+
+def rank_hotwords(word_list:List[Tuple[str, int]], limit:int)->List[Tuple[str, int]]:
     word_list = strip_redundants(data_list=word_list)
     debug.log('strip-redundants')
-    def hotword_rank_sort(a:Tuple[str, int], b:Tuple[str, int]):
-        if a[1] != b[1]: return 1 if a[1] > b[1] else -1
-        if len(a[0]) != len(b[0]): return 1 if len(a[0]) > len(b[0]) else -1
-        return 1 if a[0] > b[0] else -1
-    word_list.sort(key=cmp_to_key(hotword_rank_sort))
-    debug.log('sort')
-    length = len(word_list)
-    output_limit = MAX_RESULT_NUM if MAX_RESULT_NUM > 0 else length
-    offset = length - output_limit
-    for n in range(offset, length):
-        word, num = word_list[n]
-        print(word, num)
-        if n + 1 - offset >= output_limit: break
-
-def strip_redundants(data_list:List[Tuple[str, int]]):
-    temp_list = [] # type: list[tuple[str, str, int]]
-    for item in data_list:
-        temp_list.append((item[0][-1:-3:-1], item[0], item[1]))
-    def reverse_rank_sort(a, b):
-        if a[0] != b[0]: return 1 if a[0] > b[0] else -1
-        if a[-1] != b[-1]: return -1 if a[-1] > b[-1] else 1
-        return -1 if len(a[1]) > len(b[1]) else 1
-    temp_list.sort(key=cmp_to_key(reverse_rank_sort))
-    result, keytag, depth = [], None, 0
-    for n in range(len(temp_list)):
-        tag, word, num = temp_list[n]
-        if keytag != tag: keytag, depth = tag, 0
-        depth += 1
-        redundant = False
-        for r in range(0, min(depth, len(result))):
-            hotword, _ = result[r] # type: str
-            if hotword.endswith(word):
-                redundant = True
-                break
-        if not redundant:
-            result.insert(0, (word, num))
+    # only the printed words are ordered, they come off a heap instead of sorting every candidate
+    output_limit = limit if limit > 0 else len(word_list)
+    word_list = heapq.nlargest(output_limit, word_list, key=lambda x: (x[1], len(x[0]), x[0]))
+    debug.log('top-k')
+    return word_list
+
+def caculate_hotwords(buffer:io.StringIO):
+    error_map = None
+    if options.approximate:
+        word_list, error_map = search_hotwords_approximate(buffer, options.capacity)
+    elif options.chunk_size > 0 and not options.webpage:
+        word_list = search_hotwords_chunked(options.text_path, options.chunk_size << 20, options.jobs)
+    else:
+        word_list = hotword_engines[options.engine](buffer)
+    word_list = rank_hotwords(word_list, MAX_RESULT_NUM)
+    for word, num in reversed(word_list):
+        if error_map is None: print(word, num)
+        else: print(word, num, '±{}'.format(error_map[word]))
+
+def compare_engines(buffer:io.StringIO):
+    result_map = {}
+    for engine in engines.option_choices():
+        if engine == engines.numpy and not numpy: continue
+        buffer.seek(0)
+        elapse = time.perf_counter()
+        result_map[engine] = dict(hotword_engines[engine](buffer))
+        print('{:>14s} {:9.3f}ms {} words'.format(engine, 1000 * (time.perf_counter() - elapse), len(result_map[engine])))
+    if options.chunk_size > 0 and not options.webpage:
+        elapse = time.perf_counter()
+        result_map['chunked'] = dict(search_hotwords_chunked(options.text_path, options.chunk_size << 20, options.jobs))
+        print('{:>14s} {:9.3f}ms {} words'.format('chunked', 1000 * (time.perf_counter() - elapse), len(result_map['chunked'])))
+    expected = result_map[engines.tree]
+    for engine, word_map in result_map.items():
+        if word_map == expected: continue
+        missing = [x for x in expected if word_map.get(x) != expected[x]]
+        extra = [x for x in word_map if x not in expected]
+        print('{} differs from {}: {} missing/changed {} extra, e.g. {}'.format(
+            engine, engines.tree, len(missing), len(extra), [(x, expected.get(x), word_map.get(x)) for x in (missing + extra)[:5]]))
+        sys.exit(1)
+    print('all engines agree')
+
+index_magic = b'HWIX'
+index_version = 1
+
+def get_corpus_hash()->str:
+    # a database corpus is hashed as the filtered rows it yields
+    digest = hashlib.sha1()
+    if options.database:
+        reader = CorpusReader(open_corpus(sqlite3.connect(options.database)))
+        for block in iter(lambda: reader.read(1 << 20), ''): digest.update(block.encode('utf-8'))
+    else:
+        with open(options.text_path, 'rb') as fp:
+            for block in iter(lambda: fp.read(1 << 20), b''): digest.update(block)
+    return digest.hexdigest()
+
+def read_corpus_text()->str:
+    if options.database: return CorpusReader(open_corpus(sqlite3.connect(options.database))).read()
+    with open(options.text_path, 'r') as fp:
+        return fp.read()
+
+def build_hotword_index(text:str, depth:int, file_path:str, corpus_hash:str):
+    # every gram extending a repeated gram one char shorter, up to depth + 1 chars, sorted by text with its count,
+    # its count minus the repeated grams one char longer, and the order it was first seen among grams of its size.
+    # the words of every depth up to depth are stripped and ranked here, a query only slices them
+    levels, prefixes = [], None # type: List[collections.Counter], set
+    for size in range(1, depth + 2):
+        counter = count_text_ngrams(text, len(text), size, prefixes)
+        if not counter: break
+        levels.append(counter)
+        debug.log('ngram-{} {} grams'.format(size, len(counter)))
+        prefixes = set([x for x, n in counter.items() if n >= 2])
+        if not prefixes: break
+    rest_levels = [dict(x) for x in levels]
+    for rest_map, counter in zip(rest_levels, levels[1:]):
+        for word, num in counter.items():
+            if num >= 2: rest_map[word[:-1]] -= num
+    word_list = sorted(itertools.chain(*levels))
+    id_map = dict([(x, n) for n, x in enumerate(word_list)])
+    counts, rests, firsts = array('I', bytes(4 * len(word_list))), array('I', bytes(4 * len(word_list))), array('I', bytes(4 * len(word_list)))
+    for counter, rest_map in zip(levels, rest_levels):
+        for first, (word, num) in enumerate(counter.items()):
+            n = id_map[word]
+            counts[n], rests[n], firsts[n] = num, rest_map[word], first
+    arrays = [('counts', counts), ('rests', rests), ('firsts', firsts)]
+    char_map = levels[0] if levels else collections.Counter() # a corpus without word chars has no grams at all
+    for size in range(1, depth + 1):
+        candidates = []
+        for counter, rest_map in zip(levels[1:size + 1], rest_levels[1:size + 1]):
+            for word, num in counter.items():
+                if len(word) <= size: num = rest_map[word]
+                if num >= 2 and char_map[word[0]] > 2 and word[0] not in exclude_chars: candidates.append((word, num))
+        candidates = strip_redundants(candidates)
+        candidates.sort(key=lambda x: (x[1], len(x[0]), x[0]), reverse=True)
+        arrays.append(('rank-{}'.format(size), array('I', [id_map[x] for x, _ in candidates])))
+    debug.log('rank')
+    blob = ''.join(word_list).encode('utf-8')
+    arrays.insert(0, ('offsets', array('I', itertools.accumulate([len(x.encode('utf-8')) for x in word_list], initial=0))))
+    meta = {'version': index_version, 'hash': corpus_hash, 'depth': depth, 'grams': len(word_list), 'arrays': {}, 'words': [0, len(blob)]}
+    position = len(blob) + (-len(blob) & 7)
+    for name, data in arrays:
+        meta['arrays'][name] = [position, len(data)]
+        position += len(data) * data.itemsize
+    header = json.dumps(meta).encode('utf-8')
+    temp_path = file_path + '.tmp'
+    with open(temp_path, 'wb') as fp:
+        fp.write(struct.pack('<4sI', index_magic, len(header)))
+        fp.write(header)
+        fp.write(bytes(get_index_base(len(header)) - 8 - len(header)))
+        fp.write(blob)
+        fp.write(bytes(-len(blob) & 7))
+        for _, data in arrays: data.tofile(fp)
+    os.replace(temp_path, file_path)
+    debug.log('write')
+
+def get_index_base(header_size:int)->int:
+    return (8 + header_size + 7) & ~7
+
+class HotwordIndex(object):
+    # arrays are views of the memory-mapped file, nothing is read until a query touches it
+    def __init__(self, file_path:str):
+        self.fp = open(file_path, 'rb')
+        self.data = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, size = struct.unpack('<4sI', self.data[:8]) if len(self.data) >= 8 else (None, 0)
+        if magic != index_magic:
+            self.close()
+            raise ValueError('{} is not a hotword index'.format(file_path))
+        self.meta = json.loads(self.data[8:8 + size].decode('utf-8')) # type: Dict
+        self.depth = self.meta['depth'] # type: int
+        base = get_index_base(size)
+        self.__view = memoryview(self.data)
+        self.words = self.__view[base:base + self.meta['words'][1]]
+        self.arrays = {} # type: Dict[str, memoryview]
+        for name, (position, num) in self.meta['arrays'].items():
+            self.arrays[name] = self.__view[base + position:base + position + num * 4].cast('I')
+        self.offsets, self.counts, self.rests, self.firsts = [self.arrays[x] for x in ('offsets', 'counts', 'rests', 'firsts')]
+
+    def is_valid(self, corpus_hash:str, depth:int)->bool:
+        return self.meta['version'] == index_version and self.meta['hash'] == corpus_hash and self.depth >= depth
+
+    def word(self, n:int)->str:
+        return str(self.words[self.offsets[n]:self.offsets[n + 1]], 'utf-8')
+
+    def find(self, word:str)->int:
+        # first gram not sorting before word
+        low, high = 0, self.meta['grams']
+        while low < high:
+            middle = (low + high) // 2
+            if self.word(middle) < word: low = middle + 1
+            else: high = middle
+        return low
+
+    def hotwords(self, depth:int, limit:int)->List[Tuple[str, int]]:
+        if depth < 1: return []
+        rank_list = self.arrays['rank-{}'.format(depth)]
+        word_list = []
+        for n in rank_list[:limit] if limit > 0 else rank_list:
+            word = self.word(n)
+            word_list.append((word, self.rests[n] if len(word) <= depth else self.counts[n]))
+        return word_list
+
+    def close(self):
+        if hasattr(self, 'arrays'):
+            for view in list(self.arrays.values()) + [self.words, self.__view]: view.release()
+        self.data.close()
+        self.fp.close()
+
+def open_hotword_index(file_path:str, rebuild:bool = False)->HotwordIndex:
+    # the index answers for the corpus it was counted from, a changed corpus or a deeper --depth counts it again
+    corpus_hash = get_corpus_hash()
+    debug.log('hash')
+    if not rebuild and os.path.exists(file_path):
+        index = HotwordIndex(file_path)
+        if index.is_valid(corpus_hash, HOTWORD_SEARCH_DEPTH): return index
+        index.close()
+        print('{} is stale, counting the corpus again'.format(file_path), file=sys.stderr)
+    build_hotword_index(read_corpus_text(), HOTWORD_SEARCH_DEPTH, file_path, corpus_hash)
+    return HotwordIndex(file_path)
+
+def create_index_tree(index:HotwordIndex, char:str)->TreeNode:
+    # the grams after char as create_search_tree grows them: every continuation of a repeated gram,
+    # siblings in the order the text first shows them
+    root = TreeNode(char)
+    node_map = {char: root}
+    gram_list = []
+    for n in range(index.find(char), index.find(chr(ord(char) + 1))):
+        word = index.word(n)
+        if 2 <= len(word) <= HOTWORD_SEARCH_DEPTH + 1: gram_list.append((len(word), index.firsts[n], word))
+    gram_list.sort()
+    for _, _, word in gram_list:
+        parent = node_map.get(word[:-1])
+        if parent is None: continue
+        node = node_map[word] = TreeNode(word[-1])
+        node.parent = parent
+        parent.children.append(node)
+    return root
+
+def strip_redundants(data_list:List[Tuple[str, int]])->List[Tuple[str, int]]:
+    # a word is redundant when a longer word ending with it is counted at least as often. with the words
+    # reversed and sorted every such longer word follows its suffix in one run, a stack of the open suffixes
+    # hands the best num of a run back to its owner, [reversed word, num, best num after it]
+    result, stack = [], []
+    def close(entry:List):
+        if stack:
+            parent = stack[-1]
+            parent[2] = max(parent[2], entry[1], entry[2])
+        if entry[2] < entry[1]: result.append((entry[0][::-1], entry[1]))
+    for reversed_word, num in sorted([(x[0][::-1], x[1]) for x in data_list]):
+        while stack and not reversed_word.startswith(stack[-1][0]): close(stack.pop())
+        stack.append([reversed_word, num, 0])
+    while stack: close(stack.pop())
     return result
 
 def iterate_search(data_list:typing.List[str], hotword:str):
@@ -276,8 +912,22 @@ def create_search_tree(data_list:typing.List[str], parent:TreeNode):
 if __name__ == '__main__':
     arguments = argparse.ArgumentParser()
     arguments.add_argument('--command', '-c', default=commands.dump_hotword, choices=commands.option_choices())
-    arguments.add_argument('--text-path', '-p', required=True)
+    arguments.add_argument('--text-path', '-p')
+    arguments.add_argument('--database', '-b', help='read the text rows of a crawl database instead of --text-path')
+    arguments.add_argument('--table', default='comment', choices=list(corpus_tables.keys()), help='poem lives in b.sqlite')
+    arguments.add_argument('--subject', '-s', nargs='+', help='subject ids or links of the review comments')
+    arguments.add_argument('--review', nargs='+', help='review ids, or topic ids of discuss rows')
+    arguments.add_argument('--author', '-u', nargs='+', help='author uids')
+    arguments.add_argument('--since', help='first day of the rows, YYYY-MM-DD')
+    arguments.add_argument('--until', help='day after the last one of the rows, YYYY-MM-DD')
+    arguments.add_argument('--per-subject', action='store_true', help='hotwords of every subject in one scan, discuss goes by topic and poem by author')
+    arguments.add_argument('--index-path', '-i', help='n-gram index of the corpus that dump-hotword and dump-graph answer from, counted again when the corpus changes')
     arguments.add_argument('--webpage', '-w', action='store_true')
+    arguments.add_argument('--engine', '-e', default=engines.tree, choices=engines.option_choices())
+    arguments.add_argument('--chunk-size', '-k', type=int, default=0, help='MB per chunk, counts a memory-mapped text file chunk by chunk in a process pool')
+    arguments.add_argument('--jobs', '-j', type=int, default=os.cpu_count())
+    arguments.add_argument('--approximate', '-a', action='store_true', help='stream the text through fixed size sketches, counts come with an error bound')
+    arguments.add_argument('--capacity', type=int, default=20000, help='grams tracked by --approximate')
     arguments.add_argument('--max-num', '-m', type=int, default=0)
     arguments.add_argument('--depth', '-d', type=int, default=10)
     arguments.add_argument('--debug', '-g', action='store_true')
@@ -286,6 +936,15 @@ if __name__ == '__main__':
     arguments.add_argument('--svg-name', '-n')
     global debug, options
     options = ArgumentOptions(data=arguments.parse_args(sys.argv[1:]))
+    if options.depth < 1: arguments.error('--depth needs at least 1 char')
+    if options.engine == engines.numpy and not numpy: arguments.error('the numpy engine needs numpy')
+    if not options.text_path and not options.database: arguments.error('--text-path or --database is required')
+    if options.database and (options.webpage or options.chunk_size > 0): arguments.error('--webpage and --chunk-size read --text-path, not a database')
+    if options.per_subject and not (options.database and options.command == commands.dump_hotword):
+        arguments.error('--per-subject dumps hotwords of a --database')
+    if options.command == commands.build_index and not options.index_path: arguments.error('--index-path is required for {}'.format(options.command))
+    if options.index_path and (options.webpage or options.approximate or options.chunk_size > 0 or options.per_subject or options.command == commands.compare_engines):
+        arguments.error('--index-path holds the exact counts of a --text-path or --database corpus')
     text_path = options.text_path
     debug = elapse_dubugger()
     debug.enabled = options.debug
@@ -294,10 +953,24 @@ if __name__ == '__main__':
     HOTWORD_SEARCH_DEPTH = options.depth
     MAX_RESULT_NUM = options.max_num
 
-    assert options.text_path
-    buffer = None # type: io.StringIO
-    if options.webpage:
-        response = requests.get(url=text_path)
+    buffer, index = None, None # type: io.StringIO, HotwordIndex
+    if options.index_path:
+        try:
+            index = open_hotword_index(options.index_path, rebuild=options.command == commands.build_index)
+        except (ValueError, sqlite3.OperationalError) as error:
+            arguments.error(str(error))
+    elif options.database:
+        try:
+            cursor = open_corpus(sqlite3.connect(options.database), grouped=options.per_subject)
+        except (ValueError, sqlite3.OperationalError) as error:
+            arguments.error(str(error))
+        # rows go straight into the counting, streamed for --approximate and joined in memory otherwise
+        if not options.per_subject:
+            buffer = CorpusReader(cursor)
+            if not (options.approximate and options.command == commands.dump_hotword): buffer = io.StringIO(buffer.read())
+            debug.log('read')
+    elif options.webpage:
+        response = http_session().get(url=text_path)
         if response.status_code == 200:
             html = pyquery.PyQuery(response.text)
             douban_article_content = html.find('div.article div.main')
@@ -312,14 +985,29 @@ if __name__ == '__main__':
         else:
             print(pyquery.PyQuery(response.text).find('body').text())
             sys.exit(1)
+    elif options.approximate and options.command == commands.dump_hotword:
+        assert os.path.exists(text_path)
+        buffer = open(text_path, 'r')
+    elif options.chunk_size > 0 and options.command == commands.dump_hotword:
+        assert os.path.exists(text_path)
     else:
         assert os.path.exists(text_path)
         with open(text_path, 'r+') as fp:
             buffer = io.StringIO(fp.read())
             debug.log('read')
 
-    if options.command == commands.dump_graph:
+    if options.command == commands.build_index:
+        print('{} grams up to depth {} in {}, {:,}B'.format(index.meta['grams'], index.depth, options.index_path, os.path.getsize(options.index_path)))
+    elif options.command == commands.dump_graph:
         assert options.char
-        create_hotword_network(buffer)
+        if index: draw_hotword_network(create_index_tree(index, options.char))
+        else: create_hotword_network(buffer)
     elif options.command == commands.dump_hotword:
-        caculate_hotwords(buffer)
+        if index:
+            for word, num in reversed(index.hotwords(HOTWORD_SEARCH_DEPTH, MAX_RESULT_NUM)): print(word, num)
+            debug.log('query')
+        elif options.per_subject: caculate_subject_hotwords(cursor)
+        else: caculate_hotwords(buffer)
+    elif options.command == commands.compare_engines:
+        compare_engines(buffer)
+    if index: index.close()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import time, json, threading, contextlib, sys, os
+from typing import List, Tuple, Dict
+
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram(object):
+    def __init__(self, buckets:Tuple[float] = latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value:float):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]: index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q:float)->float:
+        # upper bound of the bucket holding the q-th observation, good enough for a progress line
+        if not self.count: return 0.0
+        rank, total = q * self.count, 0
+        for index, num in enumerate(self.counts):
+            total += num
+            if total >= rank: return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+class Metrics(object):
+    def __init__(self, prefix:str = 'douban'):
+        self.prefix = prefix
+        self.started = time.monotonic()
+        self.counters = {} # type: Dict[Tuple[str, Tuple], float]
+        self.histograms = {} # type: Dict[Tuple[str, Tuple], Histogram]
+        self.gauges = {} # type: Dict[Tuple[str, Tuple], float]
+        self.__lock = threading.Lock() # fed from the writer thread and the download executor too
+
+    def count(self, name:str, value:float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name:str, value:float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.gauges[key] = value
+
+    def observe(self, name:str, value:float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name:str, **labels):
+        elapse = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - elapse, **labels)
+
+    def total(self, name:str)->float:
+        with self.__lock:
+            return sum([v for k, v in self.counters.items() if k[0] == name])
+
+    def histogram(self, name:str)->Histogram:
+        # all label sets of one histogram merged together
+        merged = Histogram()
+        with self.__lock:
+            for key, histogram in self.histograms.items():
+                if key[0] != name: continue
+                merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+                merged.sum += histogram.sum
+                merged.count += histogram.count
+        return merged
+
+    def progress_line(self)->str:
+        elapse = time.monotonic() - self.started
+        parse = self.histogram('parse_seconds')
+        network = self.histogram('network_seconds')
+        hit_num, miss_num = self.total('cache_hits_total'), self.total('cache_misses_total')
+        return '[{:.0f}s] pages={} {:.1f}/s cache={:.0f}% rows={:.0f} net={:.1f}s p90<={}s wait={:.1f}s parse={:.1f}s commit={:.1f}s retries={:.0f} errors={:.0f}'.format(
+            elapse, parse.count, parse.count / max(elapse, 1e-6), 100 * hit_num / max(1, hit_num + miss_num),
+            self.total('rows_total'), network.sum, network.quantile(0.9), self.histogram('ratelimit_wait_seconds').sum,
+            parse.sum, self.histogram('commit_seconds').sum, self.total('retries_total'), self.total('fetch_errors_total'))
+
+    def snapshot(self)->Dict:
+        with self.__lock:
+            counters = [{'name': k[0], 'labels': dict(k[1]), 'value': v} for k, v in sorted(self.counters.items())]
+            gauges = [{'name': k[0], 'labels': dict(k[1]), 'value': v} for k, v in sorted(self.gauges.items())]
+            histograms = [{'name': k[0], 'labels': dict(k[1]), 'count': v.count, 'sum': v.sum,
+                           'buckets': dict(zip([str(x) for x in v.buckets] + ['+Inf'], v.counts))}
+                          for k, v in sorted(self.histograms.items(), key=lambda x: x[0])]
+        return {'prefix': self.prefix, 'time': time.time(), 'uptime': time.monotonic() - self.started,
+                'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+    def to_prometheus(self)->str:
+        def format_labels(labels:Tuple, extra:List[Tuple[str, str]] = ())->str:
+            pairs = list(labels) + list(extra)
+            if not pairs: return ''
+            return '{' + ','.join(['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs]) + '}'
+        lines, declared = [], set()
+        with self.__lock:
+            for metric_type, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for (name, labels), value in sorted(values.items()):
+                    metric = '{}_{}'.format(self.prefix, name)
+                    if metric not in declared:
+                        lines.append('# TYPE {} {}'.format(metric, metric_type))
+                        declared.add(metric)
+                    lines.append('{}{} {}'.format(metric, format_labels(labels), value))
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda x: x[0]):
+                metric = '{}_{}'.format(self.prefix, name)
+                if metric not in declared:
+                    lines.append('# TYPE {} histogram'.format(metric))
+                    declared.add(metric)
+                total = 0
+                for bound, num in zip([str(x) for x in histogram.buckets] + ['+Inf'], histogram.counts):
+                    total += num # prometheus buckets are cumulative
+                    lines.append('{}_bucket{} {}'.format(metric, format_labels(labels, [('le', bound)]), total))
+                lines.append('{}_sum{} {}'.format(metric, format_labels(labels), histogram.sum))
+                lines.append('{}_count{} {}'.format(metric, format_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, file_path:str):
+        # *.json gets a json snapshot, anything else the prometheus text format for node_exporter's textfile collector
+        content = json.dumps(self.snapshot(), indent=2, ensure_ascii=False) if file_path.endswith('.json') else self.to_prometheus()
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'w') as fp:
+            fp.write(content)
+        os.replace(temp_path, file_path)
+
+class ProgressReporter(object):
+    def __init__(self, metrics:Metrics, interval:float = 10.0, file_path:str = None, stream = sys.stderr):
+        self.metrics = metrics
+        self.interval = interval # type: float
+        self.file_path = file_path # type: str
+        self.stream = stream
+        self.__time = time.monotonic()
+
+    def __call__(self, force:bool = False):
+        now = time.monotonic()
+        # a non-positive interval only reports when forced at the end of a run
+        if not force and (self.interval <= 0 or now - self.__time < self.interval): return
+        self.__time = now
+        print(self.metrics.progress_line(), file=self.stream, flush=True)
+        if self.file_path: self.metrics.dump(self.file_path)
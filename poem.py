@@ -1,12 +1,24 @@
 #!/usr/bin/env python3
-import sqlite3, requests, time, re
-from pyquery import PyQuery
-from spider import WebpageSpider
-from typing import Dict
+import sqlite3, time, re, argparse, sys, asyncio, functools, itertools, collections
+from concurrent.futures import ThreadPoolExecutor, Future
+from lxml.html import HtmlElement
+from spider import WebpageSpider, FetchError, codecs, zstandard
+from frontier import CrawlFrontier
+from metrics import Metrics, ProgressReporter
+from search import IndexSync
+from extract import FieldMap, Field, Text, Attr, compile_selector, parse_html, get_text, drop_elements
+from typing import Dict, List, Tuple
+
+database_name = 'b.sqlite'
+index_sync = IndexSync()
 
 class tables(object):
     song = 'song'
     poem = 'poem'
+    author = 'author'
+
+class kinds(object):
+    author_poems = 'author-poems'
 
 class commands(object):
     dump_poem = 'dump-poem'
@@ -33,14 +45,37 @@ def create_sqlite_tables():
         'title text NOT NULL',
         'author text NOT NULL',
         'poem text NOT NULL',
-        'tags text'
+        'tags text',
+        'pid text',
+        'uid text'
+    ])
+    spider.upgrade_table(name=tables.poem, fields=['pid text', 'uid text'])
+    # completed stays NULL until the last poem page of the author is stored
+    spider.create_table(name=tables.author, fields=[
+        'uid text NOT NULL UNIQUE ON CONFLICT REPLACE',
+        'name text',
+        'poem_count integer',
+        'pages integer',
+        'completed integer'
     ])
 
 class ArgumentOptions(object):
     def __init__(self, data):
         self.sleep_time = data.sleep_time
+        self.rate = data.rate
+        if not self.rate: self.rate = 1 / self.sleep_time if self.sleep_time > 0 else 0
+        self.max_rate = data.max_rate
+        self.retries = data.retries
+        self.burst = data.burst
+        self.concurrency = data.concurrency
         self.dont_cache = data.dont_cache
+        self.retry_failed = data.retry_failed
+        self.offline = data.offline
+        self.codec = data.codec
         self.command = data.command
+        self.verbose = data.verbose
+        self.metrics = data.metrics
+        self.progress = data.progress
 
 def get_request_headers(referer:str):
     return {
@@ -48,34 +83,74 @@ def get_request_headers(referer:str):
         'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/12.0 Safari/605.1.15'
     }
 
-def dump_songs():
-    book = spider.fetch_html_document(url='https://www.gushiwen.org/guwen/shijing.aspx')
-    book = PyQuery(book.html())
-    for item in book.find('div.sons span a'):
-        node = PyQuery(item)
-        poem_url = node.attr('href')
-        if not poem_url: continue
-        print(poem_url)
-        poem_html = spider.fetch_html_document(url=poem_url)
-        content = poem_html.find('div.main3 div.sons div.cont')
-        title = content.find('h1').text()
-        author = PyQuery(content.find('p.source')[0]).text()
-        poem_text = content.find('div.contson').text()
+song_fields = FieldMap(item=None, fields=[
+    ('title', Text('div.main3 div.sons div.cont h1')),
+    ('author', Field('div.main3 div.sons div.cont p.source', convert=lambda x: get_text([x[0]]))),
+    ('poem', Text('div.main3 div.sons div.cont div.contson'))
+])
+
+poem_fields = FieldMap(item='div.main3 div.left div.sons', fields=[
+    ('title', Field('div.cont div.yizhu', convert=lambda x: get_text([e for e in [x[0].getnext()] if e is not None]))),
+    ('author', Field('div.cont p.source', convert=lambda x: get_text([x[0]]).replace('：','-'))),
+    ('poem', Field('div.cont div.contson', convert=lambda x: get_text([x[0]]))),
+    ('tags', Field('div.tag', convert=lambda x: get_text([x[0]]).replace(' ', '').replace('，', ';') if x else None)),
+    ('id', Attr('onclick', 'div.yizhu img', convert=lambda x: x.split('\'')[1]))
+])
+
+song_links_xpath = compile_selector('div.sons span a')
+author_links_xpath = compile_selector('div.main3 div.right div.cont a')
+author_cards_xpath = compile_selector('div.main3 div.left div.sonspic div.cont')
+author_name_xpath = compile_selector('p b')
+author_count_xpath = compile_selector('a[href*="authorvsw"]')
+poem_count_pattern = re.compile(r'(\d+)\s*篇')
+annotation_xpath = compile_selector('div.contyishang')
+anchor_xpath = compile_selector('a')
+poem_next_xpath = compile_selector('div.pagesright a.amore')
+changed_authors = set()
+annotation_urls = ('https://so.gushiwen.org/shiwen2017/ajaxfanyi.aspx?id=1', 'https://so.gushiwen.org/shiwen2017/ajaxshangxi.aspx?id=4')
+
+def parse_annotation(html_content:str)->str:
+    nodes = annotation_xpath(parse_html(html_content))
+    for node in nodes: drop_elements(anchor_xpath(node))
+    return get_text(nodes)
+
+def get_annotation_key(url:str, referer:str)->str:
+    # both ajax urls are the same for every song, the referer picks the song they answer for
+    return '{} referer={}'.format(url, referer)
+
+async def fetch_songs_async(poem_urls:List[str]):
+    semaphore = asyncio.Semaphore(options.concurrency)
+    tasks = []
+    for poem_url in poem_urls:
         headers = get_request_headers(referer=poem_url)
-        response = requests.get('https://so.gushiwen.org/shiwen2017/ajaxfanyi.aspx?id=1', headers=headers)
-        note_node = PyQuery(response.text).find('div.contyishang')
-        note_node.find('a').remove()
-        note_text = note_node.text()
-        time.sleep(1)
-        response = requests.get('https://so.gushiwen.org/shiwen2017/ajaxshangxi.aspx?id=4', headers=headers)
-        review_node = PyQuery(response.text).find('div.contyishang')
-        review_node.find('a').remove()
-        review_text = review_node.text()
-        print('{} {}\n{}'.format(title, author, poem_text))
-        spider.insert_table(name=tables.song, data_rows=[
-            (title, author, poem_text, note_text, review_text)
-        ])
+        tasks.append(spider.fetch_html_content_async(poem_url, dont_cache=options.dont_cache, semaphore=semaphore))
+        for url in annotation_urls:
+            tasks.append(spider.fetch_html_content_async(url, headers=headers, dont_cache=options.dont_cache, semaphore=semaphore,
+                                                         cache_key=get_annotation_key(url, poem_url)))
+    await asyncio.gather(*tasks)
+
+def dump_songs():
+    book = parse_html(spider.fetch_html_content(url='https://www.gushiwen.org/guwen/shijing.aspx'))
+    poem_urls = [x.get('href') for x in song_links_xpath(book)]
+    poem_urls = [x for x in poem_urls if x]
+    batch_size = options.concurrency * 2
+    for offset in range(0, len(poem_urls), batch_size):
+        # song pages and their annotations download together, paced by the rate limiter of each host
+        asyncio.run(fetch_songs_async(poem_urls[offset:offset + batch_size]))
+        for poem_url in poem_urls[offset:offset + batch_size]:
+            if options.verbose: print(poem_url)
+            html_content = spider.fetch_html_content(url=poem_url, dont_cache=options.dont_cache)
+            with metrics.timer('parse_seconds', kind=tables.song):
+                title, author, poem_text = song_fields.extract(parse_html(html_content))
+            headers = get_request_headers(referer=poem_url)
+            note_text, review_text = [parse_annotation(spider.fetch_html_content(url=x, headers=headers, dont_cache=options.dont_cache,
+                                                                                 cache_key=get_annotation_key(x, poem_url))) for x in annotation_urls]
+            if options.verbose > 1: print('{} {}\n{}'.format(title, author, poem_text))
+            spider.insert_table(name=tables.song, data_rows=[
+                (title, author, poem_text, note_text, review_text)
+            ])
         spider.commit()
+        reporter()
 
 def decode_params(url:str)->Dict[str, str]:
     result = {}
@@ -83,85 +158,178 @@ def decode_params(url:str)->Dict[str, str]:
         result[name] = value
     return result
 
-def dump_author_poems(url:str):
+def get_author_page(url:str)->Tuple[str, str]:
     if url.rfind('?') > 0:
         params = decode_params(url)
-        uid = params['id']
-        pid = params['page']
-    else:
-        data = url.split('/')[-1].split('_')[-1].split('.')[0]
-        pattern = re.compile(r'A(\d+)$')
-        uid = pattern.sub('', data)
-        pid = pattern.search(data).group(1)
-
-    html = spider.fetch_html_document(url=url)
-    for item in html.find('div.main3 div.left div.sons'):
-        node = PyQuery(item)
-        content_node = node.find('div.cont')
-        title = PyQuery(content_node.find('div.yizhu')[0]).next().text()
-        author = PyQuery(content_node.find('p.source')[0]).text().replace('：','-')
-        poem_text = PyQuery(content_node.find('div.contson')[0]).text()
-        tags_node = node.find('div.tag')
-        if tags_node:
-            tags = PyQuery(tags_node[0]).text().replace(' ', '').replace('，', ';')
-        else:
-            tags = None
-        id = node.find('div.yizhu img').attr('onclick').split('\'')[1]
-        print(title, author, tags, id)
-        spider.insert_table(name=tables.poem, data_rows=[
-            (id, title, author, poem_text, tags, pid, uid)
-        ])
-    spider.commit()
-    paginator = html.find('div.pagesright a.amore')
-    if paginator and paginator.attr('href'):
-        next_page_link = paginator.attr('href') # type: str
+        return params['id'], params['page']
+    data = url.split('/')[-1].split('_')[-1].split('.')[0]
+    pattern = re.compile(r'A(\d+)$')
+    match = pattern.search(data)
+    return pattern.sub('', data), match.group(1) if match else None
+
+def parse_authors(root:HtmlElement)->List[Tuple[str, str, int]]:
+    # author cards list the poem count next to the poems link, authors only in the side list have none
+    author_list, uid_set = [], set()
+    for node in author_cards_xpath(root):
+        links = author_count_xpath(node)
+        if not links: continue
+        uid, _ = get_author_page(links[0].get('href'))
+        match = poem_count_pattern.search(get_text([links[0]]))
+        author_list.append((uid, get_text(author_name_xpath(node)[:1]), int(match.group(1)) if match else None))
+        uid_set.add(uid)
+    for node in author_links_xpath(root):
+        uid, _ = get_author_page(node.get('href'))
+        if uid in uid_set: continue
+        author_list.append((uid, get_text([node]), None))
+        uid_set.add(uid)
+    return author_list
+
+def parse_author_poems(url:str, root:HtmlElement)->Tuple[List[Tuple], List[str]]:
+    uid, pid = get_author_page(url)
+    poem_list = []
+    for title, author, poem_text, tags, id in poem_fields.rows(root):
+        poem_list.append((id, title, author, poem_text, tags, pid, uid))
+    links = []
+    paginator = poem_next_xpath(root)
+    if paginator and paginator[0].get('href'):
+        next_page_link = paginator[0].get('href') # type: str
         if not next_page_link.startswith('http'):
             next_page_link = 'https://so.gushiwen.org' + next_page_link
-        dump_author_poems(url=next_page_link)
+        links.append(next_page_link)
+    return poem_list, links
+
+def is_changed_author(url:str)->bool:
+    return options.dont_cache or get_author_page(url)[0] in changed_authors
+
+def prefetch_author_poems(links:List[str]):
+    # cached pages of changed authors are stale, they have to be downloaded again
+    spider.prefetch([x for x in links if is_changed_author(x)], dont_cache=True)
+    spider.prefetch([x for x in links if not is_changed_author(x)])
+
+def dump_author_poems(url:str)->List[Tuple[str, str]]:
+    if options.verbose: print('>>> {}'.format(url))
+    html_content = spider.fetch_html_content(url=url, dont_cache=is_changed_author(url))
+    with metrics.timer('parse_seconds', kind=kinds.author_poems):
+        poem_list, links = parse_author_poems(url, parse_html(html_content))
+    if options.verbose > 1:
+        for id, title, author, _, tags, _, _ in poem_list:
+            print(title, author, tags, id)
+    index_sync.drop_replaced(tables.poem, connection.cursor(), poem_list)
+    spider.insert_table(name=tables.poem, data_rows=poem_list)
+    index_sync.sync(tables.poem, connection.cursor())
+    if not links:
+        # checkpoint, committed by the frontier together with the last page
+        uid, pid = get_author_page(url)
+        connection.execute('UPDATE {} SET pages=?,completed=? WHERE uid=?'.format(tables.author), (pid, int(time.time()), uid))
+    return [(x, kinds.author_poems) for x in links]
 
 def dump_poems():
-    html = spider.fetch_html_document(url='https://so.gushiwen.org/authors/')
-    for item in html.find('div.main3 div.right div.cont a'):
-        node = PyQuery(item)
-        author_url = node.attr('href') # type: str
-        author_name = node.text()
-        print(author_name, author_url)
-        author_uid = author_url.split('_')[-1].split('.')[0]
-        dump_author_poems(url='https://so.gushiwen.org/authors/authorvsw.aspx?page=1&id={}'.format(author_uid))
-        spider.commit()
+    # revalidated on every run, the poem counts on it decide which authors are crawled again
+    root = parse_html(spider.fetch_html_content(url='https://so.gushiwen.org/authors/', dont_cache=True))
+    checkpoints = dict([(x[0], x[1:]) for x in connection.execute('SELECT uid,poem_count,completed FROM {}'.format(tables.author))])
+    skip_num = 0
+    for uid, name, poem_count in parse_authors(root):
+        link = 'https://so.gushiwen.org/authors/authorvsw.aspx?page=1&id={}'.format(uid)
+        record = checkpoints.get(uid)
+        if record and record[1]:
+            # finished authors are only crawled again when their listed poem count moved,
+            # authors of the side list come without a count and are always crawled again
+            if poem_count is not None and poem_count == record[0]:
+                skip_num += 1
+                continue
+            frontier.push(link, kind=kinds.author_poems, revisit=True)
+            changed_authors.add(uid)
+        else:
+            # unfinished authors resume at their pending page in the frontier
+            if options.retry_failed: frontier.retry_failed(seed=link)
+            frontier.push(link, kind=kinds.author_poems)
+        connection.execute('INSERT INTO {} VALUES (?,?,?,?,?)'.format(tables.author), (uid, name, poem_count, None, None))
+    if options.verbose: print('{} authors unchanged since their last crawl'.format(skip_num))
+    spider.commit()
+    # pages of different authors share each batch, downloaded concurrently under the per-host rate limit
+    frontier.drain(handlers={kinds.author_poems: dump_author_poems},
+                   prefetch=prefetch_author_poems, batch_size=options.concurrency * 2, fatal_errors=(FetchError,), progress=reporter, revisit=True)
+
+@functools.lru_cache(maxsize=None)
+def get_author_file_name(author:str)->str:
+    from pypinyin import lazy_pinyin as pinyin
+    return '{}.txt'.format('_'.join(pinyin(author)))
+
+def write_author_poems(file_path:str, mode:str, poem_list:List[str]):
+    with open(file_path, mode) as fp:
+        for poem_text in poem_list:
+            fp.write(poem_text)
+            fp.write('\n\n')
 
 def dump_poems_to_disk():
     import os
-    from pypinyin import lazy_pinyin as pinyin
     connection = sqlite3.connect('poem.sqlite')
-    cursor = connection.cursor()
     output_path = 'poem'
     if not os.path.exists(output_path): os.mkdir(output_path)
-    os.chdir(output_path)
-    for author, uid in cursor.execute('SELECT DISTINCT author,uid FROM poem').fetchall():
-        author = author.split('-')[-1]
-        file_name = '{}.txt'.format('_'.join(pinyin(author)))
-        fp = open(file_name, 'w+')
-        for poem_text, in cursor.execute('SELECT poem FROM poem WHERE uid=?', (uid,)).fetchall():
-            fp.write(poem_text)
-            fp.write('\n\n')
-        fp.close()
-        print(author, os.path.abspath(file_name))
+    # one scan grouped by author instead of a full scan per author, uid has no index
+    cursor = connection.execute('SELECT uid,author,poem FROM poem ORDER BY uid,rowid')
+    futures = collections.deque()
+    written = {} # type: Dict[str, Future]
+    with ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+        for uid, data_rows in itertools.groupby(cursor, key=lambda x: x[0]):
+            data_rows = list(data_rows)
+            author = data_rows[0][1].split('-')[-1]
+            file_path = os.path.join(output_path, get_author_file_name(author))
+            # authors sharing a pinyin name go to the same file, appended after the earlier write finished
+            previous = written.get(file_path)
+            if previous: previous.result()
+            futures.append(executor.submit(write_author_poems, file_path, 'a' if previous else 'w', [x[2] for x in data_rows]))
+            written[file_path] = futures[-1]
+            print(author, os.path.abspath(file_path))
+            # bounds the poems held in memory while the writers catch up
+            while len(futures) > options.concurrency * 2: futures.popleft().result()
+        for future in futures: future.result()
+    connection.close()
 
-if __name__ == '__main__':
-    import argparse, sys
+def create_argument_parser()->argparse.ArgumentParser:
     arguments = argparse.ArgumentParser()
     arguments.add_argument('--command', '-c', default=commands.dump_poem, choices=commands.option_chocies())
     arguments.add_argument('--dont-cache', '-d', action='store_true')
-    arguments.add_argument('--sleep-time', '-t', default=0, type=float)
-    options = ArgumentOptions(data=arguments.parse_args(sys.argv[1:]))
-    global spider
-    spider = WebpageSpider(connection=sqlite3.connect('b.sqlite'))
+    arguments.add_argument('--offline', action='store_true', help='only crawl pages already in the page cache')
+    arguments.add_argument('--codec', '-z', choices=codecs.option_chocies(), help='codec of newly cached pages, defaults to zstd once spider.py -c compress trained a dictionary')
+    arguments.add_argument('--sleep-time', '-t', type=float, default=0.5)
+    arguments.add_argument('--rate', '-r', type=float, help='requests per second for each host, defaults to 1/sleep-time')
+    arguments.add_argument('--max-rate', type=float, help='let the rate climb up to this while the host answers without throttling')
+    arguments.add_argument('--retries', type=int, default=3, help='retries for 403/429/5xx responses and network errors')
+    arguments.add_argument('--burst', '-b', type=int, default=1)
+    arguments.add_argument('--concurrency', '-j', type=int, default=4)
+    arguments.add_argument('--retry-failed', action='store_true', help='crawl the failed pages of unfinished authors again')
+    arguments.add_argument('--verbose', '-v', action='count', default=0, help='-v prints crawled pages, -vv every stored poem')
+    arguments.add_argument('--metrics', help='metrics file rewritten with each progress line, *.json or prometheus text')
+    arguments.add_argument('--progress', type=float, default=10.0, help='seconds between progress lines, 0 disables them')
+    return arguments
+
+def open_database(data:ArgumentOptions):
+    global options, connection, spider, frontier, metrics, reporter
+    options = data
+    metrics = Metrics()
+    reporter = ProgressReporter(metrics, interval=options.progress, file_path=options.metrics)
+    connection = sqlite3.connect(database_name)
+    spider = WebpageSpider(connection=connection, rate=options.rate, burst=options.burst, concurrency=options.concurrency, codec=options.codec, offline=options.offline, max_rate=options.max_rate, retries=options.retries, metrics=metrics)
+    frontier = CrawlFrontier(connection=connection)
     create_sqlite_tables()
-    if options.command == commands.dump_poem:
-        dump_poems()
-    elif options.command == commands.dump_song:
-        dump_songs()
-    elif options.command == commands.dump_disk:
-        dump_poems_to_disk()
+
+if __name__ == '__main__':
+    arguments = create_argument_parser()
+    data = arguments.parse_args(sys.argv[1:])
+    if data.codec == codecs.zstd and not zstandard: arguments.error('the zstd codec needs zstandard')
+    open_database(ArgumentOptions(data=data))
+    try:
+        if options.command == commands.dump_poem:
+            dump_poems()
+        elif options.command == commands.dump_song:
+            dump_songs()
+        elif options.command == commands.dump_disk:
+            dump_poems_to_disk()
+    except FetchError as error:
+        print(error)
+        spider.commit(True)
+        reporter(force=True)
+        sys.exit(1)
     spider.commit(True)
+    reporter(force=True)
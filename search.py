@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import sqlite3, time, re, argparse, sys
+from typing import List, Tuple, Dict
+
+class commands(object):
+    build = 'build'
+    search = 'search'
+
+    @classmethod
+    def option_chocies(cls):
+        choice_list = []
+        for name, value in vars(cls).items():
+            if name.replace('_', '-') == value: choice_list.append(value)
+        return choice_list
+
+# table -> (indexed column, columns shown with a hit)
+indexes = {
+    'comment': ('text', ['id', 'date', 'author_name', 'review_aid']),
+    'discuss': ('text', ['id', 'date', 'author_name', 'discuss_cid']),
+    'poem': ('poem', ['id', 'title', 'author'])
+}
+
+cjk_pattern = re.compile(r'([぀-ヿ㐀-䶿一-鿿가-힯豈-﫿])')
+
+def tokenize(text:str)->str:
+    # unicode61 keeps a run of CJK characters as one token, spacing them out indexes every character
+    # on its own, a phrase query over those unigrams then matches any substring
+    return cjk_pattern.sub(r' \1 ', text) if text else ''
+
+def get_index_name(name:str)->str:
+    return '{}_fts'.format(name)
+
+def has_index(cursor:sqlite3.Cursor, name:str)->bool:
+    result = cursor.execute('SELECT name FROM sqlite_master WHERE type=\'table\' AND name=?', (get_index_name(name),))
+    return result.fetchone() is not None
+
+def create_index(cursor:sqlite3.Cursor, name:str, rebuild:bool = False):
+    if rebuild: cursor.execute('DROP TABLE IF EXISTS {}'.format(get_index_name(name)))
+    if has_index(cursor, name): return
+    # contentless, the text stays in the source table and fts rowids are the source rowids
+    cursor.execute('CREATE VIRTUAL TABLE {} USING fts5(body, content=\'\', tokenize=\'unicode61 remove_diacritics 2\')'.format(get_index_name(name)))
+
+def get_indexed_rowid(cursor:sqlite3.Cursor, name:str)->int:
+    record = cursor.connection.execute('SELECT rowid FROM {} ORDER BY rowid DESC LIMIT 1'.format(get_index_name(name))).fetchone()
+    return record[0] if record else 0
+
+def sync_index(name:str, cursor:sqlite3.Cursor, chunk_size:int = 5000)->int:
+    # indexes source rows newer than the newest indexed rowid
+    if name not in indexes or not has_index(cursor, name): return 0
+    connection = cursor.connection
+    index_name = get_index_name(name)
+    reader = connection.execute('SELECT rowid,{} FROM {} WHERE rowid>? ORDER BY rowid'.format(indexes[name][0], name), (get_indexed_rowid(cursor, name),))
+    row_num = 0
+    while True:
+        data_rows = reader.fetchmany(chunk_size)
+        if not data_rows: break
+        connection.executemany('INSERT INTO {}(rowid,body) VALUES (?,?)'.format(index_name), [(x[0], tokenize(x[1])) for x in data_rows])
+        row_num += len(data_rows)
+    return row_num
+
+class IndexSync(object):
+    # keeps the indexes of a crawl database in step with its inserts. whether a table has an index is
+    # looked up once, an index built while a crawl runs is picked up by the next one
+    def __init__(self):
+        self.__indexed = {} # type: Dict[str, bool]
+
+    def reset(self):
+        self.__indexed = {}
+
+    def is_indexed(self, name:str, cursor:sqlite3.Cursor)->bool:
+        if name not in indexes: return False
+        if name not in self.__indexed: self.__indexed[name] = has_index(cursor, name)
+        return self.__indexed[name]
+
+    def drop_replaced(self, name:str, cursor:sqlite3.Cursor, data_rows:List[Tuple], chunk_size:int = 500):
+        # runs before the rows go in. a row replaced on its unique id leaves with its rowid, contentless fts5
+        # only drops an entry given the text it was indexed with, which is gone after the insert. rows past
+        # the newest indexed rowid have no entry yet
+        if not self.is_indexed(name, cursor): return
+        column = indexes[name][0]
+        replaced = []
+        for n in range(0, len(data_rows), chunk_size):
+            id_list = list(set([x[0] for x in data_rows[n:n + chunk_size]]))
+            command = 'SELECT rowid,{} FROM {} WHERE id IN ({})'.format(column, name, ','.join(['?'] * len(id_list)))
+            replaced.extend(cursor.execute(command, id_list).fetchall())
+        if not replaced: return
+        indexed_rowid = get_indexed_rowid(cursor, name)
+        index_name = get_index_name(name)
+        cursor.executemany('INSERT INTO {0}({0},rowid,body) VALUES (\'delete\',?,?)'.format(index_name),
+                           [(x[0], tokenize(x[1])) for x in replaced if x[0] <= indexed_rowid])
+
+    def sync(self, name:str, cursor:sqlite3.Cursor)->int:
+        if not self.is_indexed(name, cursor): return 0
+        return sync_index(name, cursor)
+
+def build_query(text:str)->str:
+    # every whitespace separated term has to match as a phrase
+    terms = []
+    for term in text.split():
+        tokens = tokenize(term).split()
+        if tokens: terms.append('"{}"'.format(' '.join(tokens).replace('"', '""')))
+    return ' AND '.join(terms)
+
+def highlight(text:str, terms:List[str], width:int = 40)->str:
+    spans = []
+    lower_text = text.lower()
+    for term in terms:
+        position = lower_text.find(term.lower())
+        while position >= 0:
+            spans.append((position, position + len(term)))
+            position = lower_text.find(term.lower(), position + len(term))
+    if not spans: return text[:width * 2]
+    spans.sort()
+    merged = [spans[0]]
+    for start, end in spans[1:]:
+        if start <= merged[-1][1]: merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else: merged.append((start, end))
+    begin = max(0, merged[0][0] - width)
+    finish = min(len(text), merged[-1][1] + width)
+    pieces, cursor = [], begin
+    for start, end in merged:
+        if start < begin or end > finish: continue
+        pieces.append(text[cursor:start])
+        pieces.append('[{}]'.format(text[start:end]))
+        cursor = end
+    pieces.append(text[cursor:finish])
+    return ('...' if begin > 0 else '') + ''.join(pieces).replace('\n', ' ') + ('...' if finish < len(text) else '')
+
+def search_table(connection:sqlite3.Connection, name:str, text:str, limit:int = 10)->List[Tuple[float, Tuple, str]]:
+    query = build_query(text)
+    if not query: return []
+    column, fields = indexes[name]
+    command = 'SELECT rowid,bm25({0}) AS score FROM {0} WHERE {0} MATCH ? ORDER BY score LIMIT ?'.format(get_index_name(name))
+    hits = connection.execute(command, (query, limit)).fetchall()
+    if not hits: return []
+    command = 'SELECT rowid,{},{} FROM {} WHERE rowid IN ({})'.format(column, ','.join(fields), name, ','.join(['?'] * len(hits)))
+    row_map = dict([(x[0], x[1:]) for x in connection.execute(command, [x[0] for x in hits])])
+    terms = text.split()
+    result = []
+    for rowid, score in hits:
+        if rowid not in row_map: continue # written by a crawl without IndexSync, -c build --rebuild drops it
+        row = row_map[rowid]
+        result.append((score, row[1:], highlight(row[0], terms)))
+    return result
+
+def build_indexes(connection:sqlite3.Connection, names:List[str], rebuild:bool = False):
+    cursor = connection.cursor()
+    for name in names:
+        if not cursor.execute('SELECT name FROM sqlite_master WHERE type=\'table\' AND name=?', (name,)).fetchone():
+            print('no table named {}'.format(name))
+            continue
+        elapse = time.perf_counter()
+        create_index(cursor, name, rebuild=rebuild)
+        row_num = sync_index(name, cursor)
+        connection.commit()
+        print('{} {} rows indexed in {:.2f}s'.format(name, row_num, time.perf_counter() - elapse))
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser()
+    arguments.add_argument('--command', '-c', default=commands.search, choices=commands.option_chocies())
+    arguments.add_argument('--database', '-d', default='douban.sqlite')
+    arguments.add_argument('--table', '-t', nargs='+', choices=list(indexes.keys()), default=['comment', 'discuss'], help='poem lives in b.sqlite')
+    arguments.add_argument('--query', '-q')
+    arguments.add_argument('--limit', '-n', type=int, default=10)
+    arguments.add_argument('--rebuild', action='store_true', help='drop and rebuild the index, also drops entries of rows replaced without the crawl scripts')
+    arguments.add_argument('--compare', action='store_true', help='time a LIKE scan for the same query')
+    options = arguments.parse_args(sys.argv[1:])
+    connection = sqlite3.connect(options.database)
+    if options.command == commands.build:
+        build_indexes(connection, options.table, rebuild=options.rebuild)
+    elif options.command == commands.search:
+        if not options.query: arguments.error('--query is required for {}'.format(options.command))
+        for name in options.table:
+            if not has_index(connection.cursor(), name):
+                print('{} has no index, run -c build first'.format(name))
+                continue
+            elapse = time.perf_counter()
+            result = search_table(connection, name, options.query, limit=options.limit)
+            elapse = time.perf_counter() - elapse
+            print('=== {} {} hits in {:.2f}ms'.format(name, len(result), elapse * 1000))
+            for score, fields, snippet in result:
+                print('{:8.3f} {} {}'.format(-score, ' '.join([str(x) for x in fields]), snippet))
+            if options.compare:
+                column = indexes[name][0]
+                elapse = time.perf_counter()
+                command = 'SELECT count(*) FROM {} WHERE {}'.format(name, ' AND '.join(['{} LIKE ?'.format(column)] * len(options.query.split())))
+                like_num, = connection.execute(command, ['%{}%'.format(x) for x in options.query.split()]).fetchone()
+                print('LIKE scan {} rows in {:.2f}ms'.format(like_num, (time.perf_counter() - elapse) * 1000))
+    connection.close()
@@ -1,17 +1,236 @@
 #!/usr/bin/env python3
 
-import sqlite3, pyquery, time, requests, sys
+import sqlite3, pyquery, time, requests, sys, asyncio, threading, zlib, random, email.utils
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 from typing import List, Tuple, Dict
+from writer import SqliteWriter
+from metrics import Metrics
+
+default_headers = {'User-Agent':'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/12.0 Safari/605.1.15'}
+
+try:
+    import brotli
+    accept_encoding = 'gzip, deflate, br'
+except ImportError:
+    accept_encoding = 'gzip, deflate'
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+session_local = threading.local()
+
+def http_session(pool_size:int = 8)->requests.Session:
+    # requests.Session is not thread safe, keep one keep-alive pool per thread
+    session = getattr(session_local, 'session', None) # type: requests.Session
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update(default_headers)
+        session.headers['Accept-Encoding'] = accept_encoding
+        session_local.session = session
+    return session
+
+class codecs(object):
+    plain = 'plain'
+    zlib = 'zlib'
+    zstd = 'zstd'
+
+    @classmethod
+    def option_chocies(cls):
+        choice_list = []
+        for name, value in vars(cls).items():
+            if name == value: choice_list.append(value)
+        return choice_list
+
+class PageCodec(object):
+    zstd_magic = b'\x28\xb5\x2f\xfd'
+
+    def __init__(self, name:str = codecs.zlib, level:int = 6, dictionaries:Dict[int, bytes] = None):
+        if name == codecs.zstd and not zstandard:
+            raise RuntimeError('zstd page codec requires the zstandard package')
+        self.name = name
+        self.level = level
+        self.dictionaries = dictionaries if dictionaries else {} # type: Dict[int, bytes]
+        self.dictionary_id = max(self.dictionaries.keys()) if self.dictionaries else 0
+        self.__local = threading.local()
+
+    def __zstd_dictionary(self, dictionary_id:int):
+        if not dictionary_id: return None
+        return zstandard.ZstdCompressionDict(self.dictionaries[dictionary_id])
+
+    def __compressor(self):
+        # zstd contexts are not thread safe, decoding also runs in pool threads
+        if not hasattr(self.__local, 'compressor'):
+            self.__local.compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self.__zstd_dictionary(self.dictionary_id))
+        return self.__local.compressor
+
+    def __decompressor(self, dictionary_id:int):
+        if not hasattr(self.__local, 'decompressors'): self.__local.decompressors = {}
+        decompressors = self.__local.decompressors
+        if dictionary_id not in decompressors:
+            decompressors[dictionary_id] = zstandard.ZstdDecompressor(dict_data=self.__zstd_dictionary(dictionary_id))
+        return decompressors[dictionary_id]
+
+    def encode(self, html:str):
+        if self.name == codecs.plain: return html
+        data = html.encode('utf-8')
+        if self.name == codecs.zstd: return self.__compressor().compress(data)
+        return zlib.compress(data, self.level)
+
+    def decode(self, data)->str:
+        # rows written before compression was enabled are still plain text
+        if isinstance(data, str): return data
+        if data[:4] == self.zstd_magic:
+            if not zstandard: raise RuntimeError('page cache holds zstd rows, install the zstandard package')
+            dictionary_id = zstandard.get_frame_parameters(data).dict_id
+            return self.__decompressor(dictionary_id).decompress(data).decode('utf-8')
+        return zlib.decompress(data).decode('utf-8')
+
+class FetchError(Exception):
+    def __init__(self, url:str, status_code:int):
+        super(FetchError, self).__init__('{} {}'.format(status_code, url))
+        self.url = url
+        self.status_code = status_code
+
+class TokenBucket(object):
+    def __init__(self, rate:float, burst:int = 1):
+        self.rate = rate # type: float
+        self.burst = max(1, burst) # type: int
+        self.__tokens = float(self.burst)
+        self.__time = time.monotonic()
+        self.__lock = threading.Lock()
+        self.decreased = 0.0 # last multiplicative decrease, see HostRateLimiter.throttle
+
+    def __refill(self):
+        now = time.monotonic()
+        self.__tokens = min(float(self.burst), self.__tokens + (now - self.__time) * self.rate)
+        self.__time = now
+
+    def reserve(self)->float:
+        # take a token now and return the delay before it may be spent, a negative balance queues callers
+        if self.rate <= 0: return 0
+        with self.__lock:
+            self.__refill()
+            self.__tokens -= 1
+            return 0 if self.__tokens >= 0 else -self.__tokens / self.rate
+
+    def set_rate(self, rate:float):
+        with self.__lock:
+            self.__refill()
+            # queued debt keeps its length in seconds
+            if self.__tokens < 0 and self.rate > 0: self.__tokens = self.__tokens / self.rate * rate
+            self.rate = rate
+
+    def pause(self, delay:float):
+        # nobody gets a token within the next delay seconds
+        if self.rate <= 0: return
+        with self.__lock:
+            self.__refill()
+            self.__tokens = min(self.__tokens, -delay * self.rate)
+
+    def acquire(self)->float:
+        delay = self.reserve()
+        if delay > 0: time.sleep(delay)
+        return delay
+
+    async def acquire_async(self)->float:
+        delay = self.reserve()
+        if delay > 0: await asyncio.sleep(delay)
+        return delay
+
+class HostRateLimiter(object):
+    def __init__(self, rate:float, burst:int = 1, max_rate:float = None, min_rate:float = None, step:float = 1.0, backoff:float = 0.5):
+        # AIMD: every success adds step/rate, so the rate climbs by about step per second of clean traffic,
+        # a throttled response multiplies it by backoff. rate <= 0 disables limiting altogether
+        self.rate = rate
+        self.burst = burst
+        self.max_rate = max(rate, max_rate) if max_rate else rate
+        self.min_rate = min_rate if min_rate else rate / 10
+        self.step = step
+        self.backoff = backoff
+        self.__buckets = {} # type: Dict[str, TokenBucket]
+        self.__lock = threading.Lock()
+
+    def bucket(self, url:str)->TokenBucket:
+        host = urlparse(url).netloc
+        with self.__lock:
+            if host not in self.__buckets:
+                self.__buckets[host] = TokenBucket(rate=self.rate, burst=self.burst)
+            return self.__buckets[host]
+
+    def succeed(self, url:str)->float:
+        bucket = self.bucket(url)
+        if bucket.rate <= 0 or bucket.rate >= self.max_rate: return bucket.rate
+        with self.__lock:
+            bucket.set_rate(min(self.max_rate, bucket.rate + self.step / bucket.rate))
+        return bucket.rate
+
+    def throttle(self, url:str, delay:float = 0)->float:
+        bucket = self.bucket(url)
+        if delay > 0: bucket.pause(delay)
+        if bucket.rate <= 0: return bucket.rate
+        with self.__lock:
+            # concurrent failures within one request interval are one congestion signal, not several
+            now = time.monotonic()
+            if now - bucket.decreased >= 1 / bucket.rate:
+                bucket.decreased = now
+                bucket.set_rate(max(self.min_rate, bucket.rate * self.backoff))
+        return bucket.rate
+
+def parse_retry_after(value:str)->float:
+    if not value: return None
+    value = value.strip()
+    if value.isdigit(): return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
 
 class WebpageSpider(object):
-    def __init__(self, connection:sqlite3.Connection):
+    retry_status_codes = (403, 429, 500, 502, 503, 504) # douban answers 403 when it thinks we crawl too fast
+
+    def __init__(self, connection:sqlite3.Connection, rate:float = 2.0, burst:int = 1, concurrency:int = 4, codec:str = None, writer:SqliteWriter = None, offline:bool = False, metrics:Metrics = None,
+                 max_rate:float = None, retries:int = 3, retry_backoff:float = 1.0, max_retry_wait:float = 600.0):
         self.__connection = connection
         self.__cursor = connection.cursor()
+        self.__writer = writer
+        self.__staged = {} # type: Dict[str, Tuple[int, Tuple[str, str, str]]]
         self.__table_name = 'page'
+        self.__executor = None # type: ThreadPoolExecutor
+        self.__refreshed = set()
+        self.limiter = HostRateLimiter(rate=rate, burst=burst, max_rate=max_rate)
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.max_retry_wait = max_retry_wait
+        self.concurrency = max(1, concurrency)
+        self.offline = offline
+        self.metrics = metrics if metrics else Metrics()
         self.create_table(name=self.__table_name, fields=[
             'link text NOT NULL UNIQUE ON CONFLICT REPLACE',
-            'html text NOT NULL'
+            'html text NOT NULL',
+            'etag text',
+            'modified text'
+        ])
+        self.upgrade_table(name=self.__table_name, fields=['etag text', 'modified text'])
+        self.create_table(name='codec', fields=[
+            'id integer NOT NULL UNIQUE ON CONFLICT REPLACE',
+            'dictionary blob NOT NULL'
         ])
+        self.codec = self.load_codec(name=codec)
+
+    def load_codec(self, name:str = None, level:int = 6)->PageCodec:
+        # every trained zstd dictionary is kept, frames name the dictionary id they were written with.
+        # without a name new pages go to zstd once a dictionary was trained, to zlib before that
+        dictionaries = dict(self.__cursor.execute('SELECT id,dictionary FROM codec').fetchall())
+        if not name: name = codecs.zstd if dictionaries else codecs.zlib
+        if name == codecs.zstd and not zstandard: name = codecs.zlib
+        return PageCodec(name=name, level=level, dictionaries=dictionaries)
 
     def create_table(self, name:str, fields:List[str]):
         create_command = '''
@@ -21,6 +240,12 @@ class WebpageSpider(object):
         if not result.fetchall():
             self.__cursor.execute(create_command)
 
+    def upgrade_table(self, name:str, fields:List[str]):
+        columns = [x[1] for x in self.__cursor.execute('PRAGMA table_info({})'.format(name)).fetchall()]
+        for field in fields:
+            if field.split(' ')[0] not in columns:
+                self.__cursor.execute('ALTER TABLE {} ADD COLUMN {}'.format(name, field))
+
     def search_table(self, name: str, id: int) -> List[Tuple]:
         search_command = '''
         SELECT * FROM {} WHERE id=?
@@ -29,39 +254,227 @@ class WebpageSpider(object):
 
     def insert_table(self, name: str, data_rows: List[Tuple]):
         if not data_rows: return
+        if self.__writer:
+            self.__writer.insert(name, data_rows)
+            return
         insert_command = '''
         INSERT INTO {} VALUES ({})
         '''.format(name, ','.join(['?'] * len(data_rows[0])))
-        self.__cursor.executemany(insert_command, data_rows)
+        with self.metrics.timer('insert_seconds', table=name):
+            self.__cursor.executemany(insert_command, data_rows)
+        self.metrics.count('rows_total', len(data_rows), table=name)
 
     def commit(self, close_sqlite:bool = False):
-        self.__connection.commit()
-        if close_sqlite: self.__connection.close()
-
-    def fetch_html_document(self, url:str, headers:Dict[str, str] = None, dont_cache:bool = False, sleep_time:float = 0.5)->pyquery.PyQuery:
-        command = 'SELECT html FROM {} WHERE link=?'.format(self.__table_name)
-        result = self.__cursor.execute(command, (url,))
-        record = result.fetchone()
-        if not record or dont_cache:
-            time.sleep(sleep_time) # douban security restriction
-            if not headers:
-                headers = {'User-Agent':'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/12.0 Safari/605.1.15'}
-            response = requests.get(url, headers=headers)
-            if response.status_code != 200:
-                print(response.status_code, response.headers)
-                print(response.text)
-                self.commit()
-                sys.exit(1)
-            html_content = response.text
-            self.insert_table(name=self.__table_name, data_rows=[
-                (url, html_content)
-            ])
+        if self.__writer:
+            if close_sqlite: self.__writer.close()
+            else: self.__writer.flush()
+            self.__connection.commit()
+        else:
+            with self.metrics.timer('commit_seconds'):
+                self.__connection.commit()
+        if close_sqlite:
+            if self.__executor: self.__executor.shutdown()
+            self.__connection.close()
+
+    def __lookup_cache(self, url:str)->Tuple[str, str, str]:
+        # pages handed to the writer are served from memory until they are committed
+        if url in self.__staged: return self.__staged[url][1]
+        command = 'SELECT html,etag,modified FROM {} WHERE link=?'.format(self.__table_name)
+        record = self.__cursor.execute(command, (url,)).fetchone()
+        if not record: return None
+        return self.codec.decode(record[0]), record[1], record[2]
+
+    def __download(self, url:str, headers:Dict[str, str], record:Tuple[str, str, str])->requests.Response:
+        if self.offline: raise FetchError(url, status_code=0)
+        headers = dict(headers) if headers else {}
+        if record:
+            # revalidate the cached page so an unchanged document costs a 304 without body
+            if record[1]: headers['If-None-Match'] = record[1]
+            if record[2]: headers['If-Modified-Since'] = record[2]
+        host = urlparse(url).netloc
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                delay = self.limiter.bucket(url).acquire()
+                self.metrics.observe('ratelimit_wait_seconds', delay, host=host)
+            elapse = time.perf_counter()
+            try:
+                response = http_session(pool_size=self.concurrency).get(url, headers=headers)
+            except requests.RequestException as error:
+                if attempt >= self.retries:
+                    self.metrics.count('fetch_errors_total', host=host, status='0')
+                    raise FetchError(url, status_code=0) from error
+                status, retry_after = '0', None
+            else:
+                status = str(response.status_code)
+                self.metrics.count('responses_total', host=host, status=status)
+                if response.status_code not in self.retry_status_codes:
+                    self.metrics.set('request_rate', self.limiter.succeed(url), host=host)
+                    return response
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                if attempt >= self.retries:
+                    self.metrics.set('request_rate', self.limiter.throttle(url, delay=min(retry_after or 0, self.max_retry_wait)), host=host)
+                    return response # rejected by __accept
+            finally:
+                self.metrics.observe('network_seconds', time.perf_counter() - elapse, host=host)
+            self.metrics.count('retries_total', host=host, status=status)
+            if retry_after is not None:
+                # Retry-After holds back every request to the host, the next acquire() waits it out
+                self.metrics.set('request_rate', self.limiter.throttle(url, delay=min(retry_after, self.max_retry_wait)), host=host)
+                if self.limiter.bucket(url).rate <= 0: time.sleep(min(retry_after, self.max_retry_wait))
+            else:
+                # a network error says nothing about the server's load, only its pushback slows the host down
+                if status != '0': self.metrics.set('request_rate', self.limiter.throttle(url), host=host)
+                time.sleep(min(self.max_retry_wait, self.retry_backoff * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+    def __accept(self, url:str, response:requests.Response, record:Tuple[str, str, str], key:str)->str:
+        self.__refreshed.add(key)
+        if response.status_code == 304 and record:
+            self.metrics.count('cache_revalidated_total')
+            return record[0]
+        if response.status_code != 200:
+            print(response.status_code, response.headers)
+            print(response.text)
+            self.metrics.count('fetch_errors_total', host=urlparse(url).netloc, status=str(response.status_code))
+            raise FetchError(url, response.status_code)
+        self.metrics.count('cache_misses_total')
+        html_content = response.text
+        command = 'INSERT OR REPLACE INTO {} VALUES (?,?,?,?)'.format(self.__table_name)
+        etag, modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+        if self.__writer:
+            ticket = self.__writer.execute(command, (key, self.codec.encode(html_content), etag, modified))
+            self.__staged[key] = ticket, (html_content, etag, modified)
+            if len(self.__staged) >= 256:
+                committed = self.__writer.committed
+                self.__staged = {k: v for k, v in self.__staged.items() if v[0] > committed}
         else:
-            html_content = record[0]
+            self.__cursor.execute(command, (key, self.codec.encode(html_content), etag, modified))
+        return html_content
+
+    def __serve_cache(self, url:str, record:Tuple[str, str, str], dont_cache:bool)->bool:
+        return record is not None and (not dont_cache or self.offline or url in self.__refreshed)
+
+    def fetch_html_content(self, url:str, headers:Dict[str, str] = None, dont_cache:bool = False, cache_key:str = None)->str:
+        # cache_key stores responses that depend on more than the url, e.g. ajax fragments answering by referer
+        key = cache_key if cache_key else url
+        record = self.__lookup_cache(key)
+        if self.__serve_cache(key, record, dont_cache):
+            # hits are counted where pages are consumed, prefetched and downloaded pages count once as misses
+            if key not in self.__refreshed: self.metrics.count('cache_hits_total')
+            return record[0]
+        delay = self.limiter.bucket(url).acquire() # douban security restriction
+        self.metrics.observe('ratelimit_wait_seconds', delay, host=urlparse(url).netloc)
+        return self.__accept(url, self.__download(url, headers, record), record, key)
+
+    def fetch_html_document(self, url:str, headers:Dict[str, str] = None, dont_cache:bool = False)->pyquery.PyQuery:
+        return pyquery.PyQuery(self.fetch_html_content(url, headers=headers, dont_cache=dont_cache))
+
+    async def fetch_html_content_async(self, url:str, headers:Dict[str, str] = None, dont_cache:bool = False, semaphore:asyncio.Semaphore = None, cache_key:str = None)->str:
+        key = cache_key if cache_key else url
+        record = self.__lookup_cache(key)
+        if self.__serve_cache(key, record, dont_cache): return record[0]
+        if not self.__executor:
+            self.__executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        if not semaphore: semaphore = asyncio.Semaphore(self.concurrency)
+        async with semaphore:
+            delay = await self.limiter.bucket(url).acquire_async()
+            self.metrics.observe('ratelimit_wait_seconds', delay, host=urlparse(url).netloc)
+            response = await asyncio.get_running_loop().run_in_executor(self.__executor, self.__download, url, headers, record)
+        # cache lookups and writes stay on the event loop thread that owns the sqlite connection
+        return self.__accept(url, response, record, key)
+
+    async def fetch_html_document_async(self, url:str, headers:Dict[str, str] = None, dont_cache:bool = False, semaphore:asyncio.Semaphore = None)->pyquery.PyQuery:
+        html_content = await self.fetch_html_content_async(url, headers=headers, dont_cache=dont_cache, semaphore=semaphore)
         return pyquery.PyQuery(html_content)
 
+    async def __fetch_html_contents(self, urls:List[str], headers:Dict[str, str], dont_cache:bool)->List[str]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        task_map = {}
+        for url in urls:
+            if url in task_map: continue
+            task_map[url] = asyncio.ensure_future(self.fetch_html_content_async(url, headers=headers, dont_cache=dont_cache, semaphore=semaphore))
+        await asyncio.gather(*task_map.values())
+        return [task_map[url].result() for url in urls]
+
+    def fetch_html_contents(self, urls:List[str], headers:Dict[str, str] = None, dont_cache:bool = False)->List[str]:
+        if not urls: return []
+        return asyncio.run(self.__fetch_html_contents(urls, headers=headers, dont_cache=dont_cache))
+
+    def fetch_html_documents(self, urls:List[str], headers:Dict[str, str] = None, dont_cache:bool = False)->List[pyquery.PyQuery]:
+        return [pyquery.PyQuery(x) for x in self.fetch_html_contents(urls, headers=headers, dont_cache=dont_cache)]
+
+    def prefetch(self, urls:List[str], headers:Dict[str, str] = None, dont_cache:bool = False):
+        self.fetch_html_contents(urls, headers=headers, dont_cache=dont_cache)
+
+def compress_page_cache(connection:sqlite3.Connection, codec:str, level:int, dict_size:int, sample_num:int, batch_size:int = 500):
+    # load_codec falls back to zlib without zstandard, training a dictionary can not
+    if codec == codecs.zstd and not zstandard: raise RuntimeError('zstd page codec requires the zstandard package')
+    cursor = connection.cursor()
+    spider = WebpageSpider(connection=connection, codec=codec) # upgrades page/codec tables
+    links = [x for x, in cursor.execute('SELECT link FROM page').fetchall()]
+    if not links: return
+    sample_links = random.sample(links, min(sample_num, len(links)))
+    def measure_read(reader:PageCodec)->float:
+        elapse = time.perf_counter()
+        for link in sample_links:
+            reader.decode(cursor.execute('SELECT html FROM page WHERE link=?', (link,)).fetchone()[0])
+        return (time.perf_counter() - elapse) / len(sample_links)
+    reader = spider.codec
+    before_latency = measure_read(reader)
+    if codec == codecs.zstd:
+        samples = [reader.decode(cursor.execute('SELECT html FROM page WHERE link=?', (x,)).fetchone()[0]).encode('utf-8') for x in sample_links]
+        dictionary = zstandard.train_dictionary(dict_size, samples)
+        cursor.execute('INSERT INTO codec VALUES (?,?)', (dictionary.dict_id(), dictionary.as_bytes()))
+        connection.commit()
+        print('trained {:,}B zstd dictionary #{} from {} pages'.format(len(dictionary.as_bytes()), dictionary.dict_id(), len(samples)))
+    writer = spider.load_codec(name=codec, level=level)
+    plain_size, stored_size, rowid = 0, 0, 0
+    while True:
+        rows = cursor.execute('SELECT rowid,html FROM page WHERE rowid>? ORDER BY rowid LIMIT ?', (rowid, batch_size)).fetchall()
+        if not rows: break
+        update_rows = []
+        for rowid, data in rows:
+            html = writer.decode(data)
+            encoded = writer.encode(html)
+            plain_size += len(html.encode('utf-8'))
+            stored_size += len(encoded.encode('utf-8') if isinstance(encoded, str) else encoded)
+            update_rows.append((encoded, rowid))
+        cursor.executemany('UPDATE page SET html=? WHERE rowid=?', update_rows)
+        connection.commit()
+        print('{:6.2f}% rowid={}'.format(100 * stored_size / max(1, plain_size), rowid))
+    connection.execute('VACUUM')
+    after_latency = measure_read(writer)
+    print('pages={} plain={:,}B stored={:,}B ratio={:.2f}x'.format(len(links), plain_size, stored_size, plain_size / max(1, stored_size)))
+    print('read latency before={:.3f}ms after({})={:.3f}ms'.format(before_latency * 1000, codec, after_latency * 1000))
+    connection.close()
+
+class commands(object):
+    fetch = 'fetch'
+    compress = 'compress'
+
+    @classmethod
+    def option_chocies(cls):
+        choice_list = []
+        for name, value in vars(cls).items():
+            if name.replace('_', '-') == value: choice_list.append(value)
+        return choice_list
+
 if __name__ == '__main__':
-    spider = WebpageSpider(connection=sqlite3.connect('spider.sqlite'))
-    html = spider.fetch_html_document('https://movie.douban.com/review/9434975/')
-    print(html.text())
-    spider.commit(close_sqlite=True)
\ No newline at end of file
+    import argparse
+    arguments = argparse.ArgumentParser()
+    arguments.add_argument('--command', '-c', default=commands.fetch, choices=commands.option_chocies())
+    arguments.add_argument('--database', '-d', default='spider.sqlite')
+    arguments.add_argument('--url', '-u', default='https://movie.douban.com/review/9434975/')
+    arguments.add_argument('--codec', '-z', default=codecs.zlib, choices=codecs.option_chocies())
+    arguments.add_argument('--level', '-l', type=int, default=6)
+    arguments.add_argument('--dict-size', type=int, default=112640)
+    arguments.add_argument('--sample-num', type=int, default=1000)
+    options = arguments.parse_args(sys.argv[1:])
+    if options.command == commands.compress and options.codec == codecs.zstd and not zstandard: arguments.error('zstd compression needs zstandard')
+    if options.command == commands.compress:
+        compress_page_cache(connection=sqlite3.connect(options.database), codec=options.codec, level=options.level,
+                            dict_size=options.dict_size, sample_num=options.sample_num)
+    else:
+        spider = WebpageSpider(connection=sqlite3.connect(options.database), codec=options.codec)
+        html = spider.fetch_html_document(options.url)
+        print(html.text())
+        spider.commit(close_sqlite=True)
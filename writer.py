@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import sqlite3, threading, queue, time
+from typing import List, Tuple, Dict, Callable
+from metrics import Metrics
+
+def enable_wal(connection:sqlite3.Connection)->sqlite3.Connection:
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+class SqliteWriter(object):
+    def __init__(self, database:str, schema:Callable[[str, sqlite3.Cursor], None] = None, batch_size:int = 5000, interval:float = 1.0, metrics:Metrics = None,
+                 before_insert:Callable[[str, sqlite3.Cursor, List[Tuple]], None] = None, before_commit:Callable[[str, sqlite3.Cursor], None] = None):
+        self.database = database
+        self.metrics = metrics if metrics else Metrics()
+        self.schema = schema
+        # hooks run in the writer thread inside the transaction, before_commit once for every table written since the last commit
+        self.before_insert = before_insert
+        self.before_commit = before_commit
+        self.batch_size = batch_size # type: int
+        self.interval = interval # type: float
+        self.committed = 0 # type: int
+        self.rows = {} # type: Dict[str, int]
+        self.commit_num = 0
+        self.commit_time = 0.0
+        self.busy_time = 0.0
+        self.__ticket = 0
+        self.__queue = queue.Queue()
+        self.__condition = threading.Condition()
+        self.__error = None # type: BaseException
+        self.__thread = threading.Thread(target=self.__run, name='sqlite-writer', daemon=True)
+        self.__thread.start()
+
+    def __submit(self, operation:Tuple)->int:
+        if self.__error: raise self.__error
+        with self.__condition:
+            self.__ticket += 1
+            ticket = self.__ticket
+            self.__queue.put((ticket,) + operation)
+        return ticket
+
+    def insert(self, name:str, data_rows:List[Tuple])->int:
+        if not data_rows: return self.__ticket
+        return self.__submit(('insert', name, data_rows))
+
+    def execute(self, command:str, params:Tuple = ())->int:
+        return self.__submit(('execute', command, [params]))
+
+    def execute_many(self, command:str, params_list:List[Tuple])->int:
+        if not params_list: return self.__ticket
+        return self.__submit(('execute', command, params_list))
+
+    def flush(self):
+        ticket = self.__submit(('flush', None, None))
+        with self.__condition:
+            while self.committed < ticket and not self.__error:
+                self.__condition.wait()
+        if self.__error: raise self.__error
+
+    def close(self):
+        self.flush()
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __run(self):
+        connection = enable_wal(sqlite3.connect(self.database, timeout=60))
+        cursor = connection.cursor()
+        created, written = set(), set()
+        pending_rows, pending_ticket, deadline = 0, 0, None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self.__queue.get(timeout=timeout)
+            except queue.Empty:
+                item = ('timeout', 'flush', None, None)
+            if item is None: break
+            ticket, operation, target, data_rows = item
+            busy = time.perf_counter()
+            try:
+                if operation == 'insert':
+                    if target not in created:
+                        # schema is resolved once per table instead of before every batch
+                        if self.schema: self.schema(target, cursor)
+                        created.add(target)
+                    if self.before_insert: self.before_insert(target, cursor, data_rows)
+                    command = 'INSERT INTO {} VALUES ({})'.format(target, ','.join(['?'] * len(data_rows[0])))
+                    with self.metrics.timer('insert_seconds', table=target):
+                        cursor.executemany(command, data_rows)
+                    self.rows[target] = self.rows.get(target, 0) + len(data_rows)
+                    self.metrics.count('rows_total', len(data_rows), table=target)
+                    written.add(target)
+                    pending_rows += len(data_rows)
+                elif operation == 'execute':
+                    cursor.executemany(target, data_rows)
+                    pending_rows += len(data_rows)
+                if ticket != 'timeout':
+                    pending_ticket = ticket
+                    if deadline is None: deadline = time.monotonic() + self.interval
+                if operation == 'flush' or pending_rows >= self.batch_size:
+                    if self.before_commit:
+                        for name in written: self.before_commit(name, cursor)
+                    written.clear()
+                    elapse = time.perf_counter()
+                    connection.commit()
+                    elapse = time.perf_counter() - elapse
+                    self.commit_num += 1
+                    self.commit_time += elapse
+                    self.metrics.observe('commit_seconds', elapse)
+                    pending_rows, deadline = 0, None
+                    with self.__condition:
+                        self.committed = max(self.committed, pending_ticket)
+                        self.__condition.notify_all()
+                self.busy_time += time.perf_counter() - busy
+            except BaseException as error:
+                connection.rollback()
+                with self.__condition:
+                    self.__error = error
+                    self.__condition.notify_all()
+                break
+        if not self.__error: connection.commit()
+        connection.close()